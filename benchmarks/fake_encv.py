@@ -0,0 +1,44 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+class FakeENCVServer:
+    """
+    Serves canned stats payloads as the ENCV admin API would, from a thread on a free local port. The payload served
+    depends on the request's x-api-key header, so each realm's target can be given its own key.
+    """
+
+    def __init__(self, payloads_by_api_key: Dict[str, Dict[str, object]]):
+        bodies = {api_key: json.dumps(payload).encode() for api_key, payload in payloads_by_api_key.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = bodies.get(self.headers.get("x-api-key"))
+                if not self.path.startswith("/api/stats/") or body is None:
+                    self.send_error(404 if body is not None else 401)
+                    return
+                self.send_response(200)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> "FakeENCVServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
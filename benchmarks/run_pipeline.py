@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the whole pipeline end to end against local stand-ins, so throughput can be measured and compared
+between changes without touching ENCV, BigQuery, Postgres or Google Sheets:
+
+    generate -> fake ENCV server -> query_encv -> encv_to_db -> db_to_json -> json_to_sheets (fake Sheets)
+
+Payloads are generated from encv_to_db's StatFactory (see its tests), with one entry per day for each realm.
+encv_to_db writes to SQLite by default, or to --encv-database-url (e.g. a scratch Postgres database), and db_to_json
+exports from the same database, summing each day's stats over realms.
+
+Each stage runs its handler in a process of its own (see stage.py), recording its import time, handler latency,
+rows per second and peak RSS. Results are compared against benchmarks/baseline.json when it was recorded with the
+same payload size, and the run fails if any stage got slower or bigger by more than --tolerance.
+
+    python benchmarks/run_pipeline.py --days 365 --realms 4
+    python benchmarks/run_pipeline.py --save-baseline
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from fake_encv import FakeENCVServer
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+FUNCTIONS_DIR = BENCHMARKS_DIR.parent / "functions"
+STAGE_SCRIPT = BENCHMARKS_DIR / "stage.py"
+DEFAULT_BASELINE = BENCHMARKS_DIR / "baseline.json"
+# Lower is better for both, and differences under these floors are treated as noise
+COMPARED_METRICS = {"seconds": 0.05, "peak_rss_mb": 5.0}
+# Settings that would send a stage somewhere other than the local stand-ins
+CLEARED_SETTINGS = ("ENCV_SNAPSHOT_LOCATION", "CLAIM_CHECK_LOCATION", "EXPORT_WATERMARK_NAME", "ENCV_API_KEY",
+                    "ENCV_SECRET_NAME", "DATABASE_URL")
+
+
+def run_stage(stage: str, function: str, event: object, workdir: Path,
+              env: Dict[str, str]) -> Tuple[Dict[str, float], object]:
+    """
+    Runs a stage's handler in its own process, returning its measurements and response
+    """
+    input_path = workdir / f"{stage}.in.json"
+    output_path = workdir / f"{stage}.out.json"
+    input_path.write_text(json.dumps(event))
+    stage_env = {name: value for name, value in os.environ.items() if name not in CLEARED_SETTINGS}
+    result = subprocess.run([sys.executable, str(STAGE_SCRIPT), stage, str(input_path), str(output_path)],
+                            cwd=FUNCTIONS_DIR / function, env={**stage_env, **env}, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{stage} failed:\n{result.stderr[-4000:]}")
+    return (json.loads(result.stdout.splitlines()[-1]), json.loads(output_path.read_text()))
+
+
+def run_pipeline(days: int, realms: int, buckets: int, seed: int, workdir: Path,
+                 encv_database_url: Optional[str] = None, log_level: str = "INFO") -> Dict[str, Dict[str, float]]:
+    encv_database_url = encv_database_url or f"sqlite:///{workdir / 'encv.db'}"
+    logging_env = {"LOGLEVEL": log_level, "LOG_LEVEL": log_level}
+    results = {}
+
+    (results["generate"], payloads) = run_stage(
+        "generate", "encv_to_db", {"days": days, "realms": realms, "buckets": buckets, "seed": seed}, workdir,
+        logging_env)
+    with FakeENCVServer(payloads) as server:
+        targets = [{"realm": realm, "api_key": realm, "base_url": server.base_url} for realm in payloads]
+        (results["query_encv"], collected) = run_stage(
+            "query_encv", "query_encv", None, workdir, {**logging_env, "ENCV_TARGETS": json.dumps(targets)})
+    (results["encv_to_db"], _) = run_stage(
+        "encv_to_db", "encv_to_db", collected, workdir, {**logging_env, "DATABASE_URL": encv_database_url})
+    (results["db_to_json"], exported) = run_stage(
+        "db_to_json", "db_to_json", {}, workdir, {**logging_env, "DATABASE_URL": encv_database_url})
+    (results["json_to_sheets"], _) = run_stage("json_to_sheets", "json_to_sheets", exported, workdir, logging_env)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[str]:
+    """
+    Returns a description of every metric that is worse than the baseline by more than tolerance (a fraction)
+    """
+    regressions = []
+    for stage, metrics in results.items():
+        for (metric, noise_floor) in COMPARED_METRICS.items():
+            previous = baseline.get(stage, {}).get(metric)
+            if previous and metrics[metric] > max(previous * (1 + tolerance), previous + noise_floor):
+                regressions.append(f"{stage} {metric}: {metrics[metric]:.3f} vs baseline {previous:.3f} "
+                                   f"(+{metrics[metric] / previous - 1:.0%})")
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]):
+    print(f"{'stage':<16}{'import s':>10}{'seconds':>10}{'baseline':>10}{'rows in':>9}{'rows out':>9}"
+          f"{'rows/s':>11}{'peak MB':>9}")
+    for stage, metrics in results.items():
+        previous = baseline.get(stage, {}).get("seconds")
+        print(f"{stage:<16}{metrics['import_seconds']:>10.3f}{metrics['seconds']:>10.3f}"
+              f"{previous if previous is not None else float('nan'):>10.3f}{metrics['rows_in']:>9}"
+              f"{metrics['rows_out']:>9}{metrics['rows_per_second']:>11.0f}{metrics['peak_rss_mb']:>9.1f}")
+
+
+def parse_arguments():
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('--days', action='store', type=int, default=365, dest='days')
+    my_parser.add_argument('--realms', action='store', type=int, default=4, dest='realms')
+    my_parser.add_argument('--buckets', action='store', type=int, default=8, dest='buckets',
+                           help="code claim age histogram buckets per day")
+    my_parser.add_argument('--seed', action='store', type=int, default=0, dest='seed')
+    my_parser.add_argument('--encv-database-url', action='store', default=None, dest='encv_database_url',
+                           help="where encv_to_db stores stats (default: SQLite in the work directory)")
+    my_parser.add_argument('--log-level', action='store', default="INFO", dest='log_level')
+    my_parser.add_argument('--baseline', action='store', type=Path, default=DEFAULT_BASELINE, dest='baseline')
+    my_parser.add_argument('--save-baseline', action='store_true', dest='save_baseline',
+                           help="record this run as the baseline instead of comparing against it")
+    my_parser.add_argument('--tolerance', action='store', type=float, default=0.5, dest='tolerance',
+                           help="fraction by which a stage may be slower or bigger than the baseline")
+    my_parser.add_argument('--json', action='store_true', dest='as_json', help="print the results as JSON")
+    return my_parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = {"days": args.days, "realms": args.realms, "buckets": args.buckets}
+    with tempfile.TemporaryDirectory(prefix="pipeline-benchmark-") as workdir:
+        results = run_pipeline(args.days, args.realms, args.buckets, args.seed, Path(workdir),
+                               encv_database_url=args.encv_database_url, log_level=args.log_level)
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps({"config": config, "stages": results}, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if baseline.get("config") != config:
+        if baseline:
+            print(f"Baseline was recorded with {baseline.get('config')}, not {config}, so it isn't compared")
+        baseline = {}
+    stages_baseline = baseline.get("stages", {})
+    if args.as_json:
+        print(json.dumps({"config": config, "stages": results}, indent=2))
+    else:
+        print_results(results, stages_baseline)
+    regressions = [] if args.save_baseline else compare(results, stages_baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Runs one pipeline stage in this process, on behalf of run_pipeline.py. Each stage gets a process of its own, since
+every function has its own app, settings and models modules, and so that each stage's peak RSS can be measured.
+Run it from the stage's function directory:
+
+    python ../../benchmarks/stage.py <stage> <input.json> <output.json>
+
+It reads the stage's event from the input file, writes the response to the output file, and prints its
+measurements as a JSON object on stdout.
+"""
+
+import datetime
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import time
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.getcwd())
+
+SHEET_HEADER = ["Row ID", "UTC", "# Codes Issued", "# Codes Claimed",
+                "# iOS activations (approximate)", "# Android downloads", "# Android Uninstalls"]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kilobytes on Linux
+
+
+def generate(app, event: Dict[str, object]) -> Tuple[object, int, int]:
+    """
+    Builds a raw ENCV stats payload per realm from encv_to_db's StatFactory, one entry per day
+    """
+    import factory
+    from tests.test_encv_to_db import StatFactory
+
+    random.seed(event["seed"])
+    factory.random.reseed_random(event["seed"])
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    payloads = {}
+    for realm in range(event["realms"]):
+        statistics = []
+        for day in range(event["days"]):
+            stat = factory.build(dict, FACTORY_CLASS=StatFactory, date=start + datetime.timedelta(days=day))
+            date = stat.pop("date")
+            stat["code_claim_age_distribution"] = [random.randint(0, 100) for bucket in range(event["buckets"])]
+            statistics.append({"date": date.strftime("%Y-%m-%dT%H:%M:%SZ"), "data": stat})
+        payloads[f"realm{realm}"] = {"statistics": statistics}
+    rows = event["realms"] * event["days"]
+    return (payloads, 0, rows)
+
+
+def query_encv(app, event: Dict[str, object]) -> Tuple[object, int, int]:
+    response = app.lambda_handler(event, None)
+    return (response, 0, len(response["body"]["data"]))
+
+
+def encv_to_db(app, event: Dict[str, object]) -> Tuple[object, int, int]:
+    data = event["body"]["data"]
+    response = app.lambda_handler(data, None)
+    return (response, len(data), response["body"]["inserted"] + response["body"]["updated"])
+
+
+def db_to_json(app, event: Dict[str, object]) -> Tuple[object, int, int]:
+    response = app.lambda_handler(event, None)
+    return (response, 0, len(response["body"]["data"]))
+
+
+def json_to_sheets(app, event: Dict[str, object]) -> Tuple[object, int, int]:
+    """
+    Writes to an in-memory fake of the Sheets API, with stand-in credentials that never need refreshing
+    """
+    import google.auth.credentials
+    from tests.utils import FakeSheetsService
+
+    class BenchmarkCredentials(google.auth.credentials.Credentials):
+        def __init__(self):
+            super().__init__()
+            self.token = "benchmark"
+            self.expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+        def refresh(self, request):
+            pass
+
+    service = FakeSheetsService(rows=[SHEET_HEADER])
+    app.cache.get("sheets_credentials", BenchmarkCredentials)
+    app.cache.get("sheets_service", lambda: service)
+    response = app.lambda_handler(event, None)
+    return (response, len(event["body"]["data"]), len(service.rows) - 1)
+
+
+STAGES = {
+    "generate": generate,
+    "query_encv": query_encv,
+    "encv_to_db": encv_to_db,
+    "db_to_json": db_to_json,
+    "json_to_sheets": json_to_sheets,
+}
+
+
+def main():
+    (stage, input_path, output_path) = sys.argv[1:4]
+    with open(input_path, "r") as infile:
+        event = json.load(infile)
+    started = time.perf_counter()
+    app = importlib.import_module("app")
+    imported = time.perf_counter()
+    (response, rows_in, rows_out) = STAGES[stage](app, event)
+    finished = time.perf_counter()
+    with open(output_path, "w") as outfile:
+        json.dump(response, outfile, default=str)
+    seconds = finished - imported
+    print(json.dumps({
+        "import_seconds": imported - started,
+        "seconds": seconds,
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        "rows_per_second": max(rows_in, rows_out) / seconds if seconds > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,77 +5,304 @@ This script pulls data from the postgres database, parses results as ENCVStat ob
 
 It relies on various environment variables / settings that can be seen below
 
+The lambda event may contain a "since" date, in which case only stats dated after it are returned. Otherwise, if
+EXPORT_WATERMARK_NAME is set, only stats newer than the last export under that name are returned, along with the
+watermark to advance it to. That watermark is only saved once it is passed back as {"commit_watermark": {...}}, which
+whatever runs the export should do once json_to_sheets has written the stats, so if the write fails they are exported
+again. Neither stage is part of the scheduled state machine yet (they need a database, spreadsheet and credentials
+configured first), so EXPORT_WATERMARK_NAME is unset by default, and nothing is committed unless it is opted into.
+If CLAIM_CHECK_LOCATION is set, results larger than CLAIM_CHECK_THRESHOLD_BYTES are written there and only a reference
+to them is returned (see claim_check.py), as Parquet if CLAIM_CHECK_FORMAT is "parquet".
+
 TODO: Potentially replace with per-update polling / kinesis data stream ?
 TODO: Potentially adopt filtering by command line arg
 """
 
+import argparse
+import datetime
 import json
 import logging
 import os
-from dataclasses import asdict
-from typing import Dict, List
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
-from models import ENCVStat
+from claim_check import PARQUET_FORMAT, offload_if_large
+from interchange import COLUMNAR_FORMATS, model_columns, to_parquet_bytes, to_table, write_table
+from metrics import metrics
+from models import ENCVStat, ExportWatermark
+from payload_log import Payload
+from resources import cache
 from settings import settings
-from sqlalchemy import create_engine
+from sqlalchemy import Integer, Table, cast, create_engine, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 
 logger = logging.getLogger()
 logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO"))
 
-def create_session() -> Session:
+# Exported stats are per day, so they have no realm (see stats_query)
+STAT_COLUMNS = {name: python_type for name, python_type in model_columns(ENCVStat).items() if name != "realm"}
+
+def create_db_engine() -> Engine:
     """
-    Creates a session with the configured database
+    Creates an engine for the configured database. Its connection pool checks each connection on checkout, so it
+    can be kept across warm invocations.
     """
-    logger.info("Creating session...")
+    logger.info("Creating engine...")
+    if settings.database_url:
+        return create_engine(settings.database_url, pool_pre_ping=True)
     user_pass_str = f"{settings.pguser}:{settings.pgpassword}@" if settings.pgpassword else ""
     path = f"postgresql://{user_pass_str}{settings.pghost}/{settings.pgdatabase}"
-    engine = create_engine(path)
-    Session = sessionmaker(bind=engine)
+    return create_engine(path, pool_pre_ping=True)
+
+
+def create_session() -> Session:
+    """
+    Creates a session with the configured database, reusing the cached engine and connection pool if there is one
+    """
+    logger.info("Creating session...")
+    Session = sessionmaker(bind=cache.get("engine", create_db_engine))
     session = Session()
     return session
 
 
-def clean_stats(data):
-    d = dict(data)
-    d["date"] = str(d["date"])
-    return d
+def day_total(column):
+    """
+    A day's value of a stat over the realms selected: the sum of a count, or for the mean code claim age, the mean
+    weighted by the codes claimed in each realm (or their plain mean, if none were)
+    """
+    if column.name == "code_claim_mean_age_seconds":
+        weighted = func.sum(column * ENCVStat.codes_claimed) / func.nullif(func.sum(ENCVStat.codes_claimed), 0)
+        return cast(func.coalesce(weighted, func.avg(column)), Integer).label(column.name)
+    return func.sum(column).label(column.name)
+
+
+def stats_query(since: Optional[datetime.datetime] = None, realm: Optional[str] = None):
+    """
+    Select of each day's stats (or, given since, of each day after it) in date order: those of the given realm, or
+    else totalled over all realms (see day_total), so that every day is exported once
+    """
+    values = [column for column in ENCVStat.__table__.columns if column.name in STAT_COLUMNS and column.name != "date"]
+    query = select([ENCVStat.date] + [day_total(column) for column in values])
+    if realm is not None:
+        query = query.where(ENCVStat.realm == realm)
+    if since is not None:
+        query = query.where(ENCVStat.date > since)
+    return query.group_by(ENCVStat.date).order_by(ENCVStat.date.asc())
+
+
+def stream_stats(session: Session, batch_size: int = settings.export_batch_size,
+                 since: Optional[datetime.datetime] = None) -> Iterator[Dict[str, object]]:
+    """
+    Yields each day's stats (or, given since, those of each day after it) in date order as a plain dict, for
+    EXPORT_REALM or summed over realms (see stats_query). Rows are read as core column tuples (no ORM entities)
+    through a server-side cursor, batch_size at a time, so memory stays flat however many rows there are.
+    """
+    logger.info("Streaming stats...")
+    names = list(STAT_COLUMNS)
+    query = stats_query(since=since, realm=settings.export_realm).execution_options(stream_results=True)
+    result = session.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                stat = dict(zip(names, row))
+                stat["date"] = str(stat["date"])
+                yield stat
+    finally:
+        result.close()
+
+
+def iter_ndjson(stats: Iterable[Dict[str, object]]) -> Iterator[str]:
+    """
+    Serializes stats incrementally as newline-delimited JSON, one line per stat
+    """
+    for stat in stats:
+        yield json.dumps(stat, default=str) + "\n"
+
+
+def iter_json_array(stats: Iterable[Dict[str, object]]) -> Iterator[str]:
+    """
+    Serializes stats incrementally as the chunks of a single JSON array, identical to json.dumps of the full list
+    """
+    yield "["
+    separator = ""
+    for stat in stats:
+        yield separator + json.dumps(stat, default=str)
+        separator = ", "
+    yield "]"
+
+
+EXPORT_FORMATS = {"ndjson": iter_ndjson, "json": iter_json_array}
 
 
-def query_stats(session: Session) -> List[ENCVStat]:
+def export_stats(session: Session, out: TextIO, export_format: str = "ndjson") -> int:
     """
-    Query our session to get all database ENCV Stat objects
+    Streams every stat to out in the given format (ndjson or json), returning the number of stats written
     """
-    logger.info("Querying stats...")
-    stats_objects = session.query(ENCVStat).order_by(
-        ENCVStat.date.asc())  # pylint disable=no-member
-    logger.debug(f"Returned objects: {stats_objects}")
-    stats = [asdict(stat_object, dict_factory=clean_stats)
-             for stat_object in stats_objects]
-    return stats
+    count = 0
 
+    def counted(stats):
+        nonlocal count
+        for stat in stats:
+            count += 1
+            yield stat
 
-def stats_json(session: Session) -> List[Dict[str, object]]:
+    for chunk in EXPORT_FORMATS[export_format](counted(stream_stats(session))):
+        out.write(chunk)
+    logger.info(f"Exported {count} stats as {export_format}")
+    return count
+
+
+@metrics.timer("db_query")
+def query_stats(session: Session, since: Optional[datetime.datetime] = None) -> List[Dict[str, object]]:
+    """
+    Query our session to get all database ENCV Stat objects, or only those dated after since
+    """
+    logger.info(f"Querying stats since {since}..." if since else "Querying stats...")
+    return list(stream_stats(session, since=since))
+
+
+def create_watermark_table(engine: Engine) -> Table:
+    """
+    Creates the watermark table if it doesn't exist yet
+    """
+    ExportWatermark.__table__.create(engine, checkfirst=True)
+    return ExportWatermark.__table__
+
+
+@metrics.timer("watermark_read")
+def read_watermark(session: Session, name: str) -> Optional[datetime.datetime]:
+    """
+    Returns the persisted watermark with the given name, or None if nothing has been exported under it yet
+    """
+    cache.get("watermark_table", lambda: create_watermark_table(session.get_bind()))
+    stored = session.query(ExportWatermark).get(name)
+    return stored.watermark if stored else None
+
+
+@metrics.timer("watermark_save")
+def save_watermark(session: Session, name: str, watermark: datetime.datetime):
+    logger.info(f"Advancing watermark {name} to {watermark}...")
+    session.merge(ExportWatermark(name=name, watermark=watermark))
+    session.commit()
+
+
+def query_stats_since_watermark(session: Session,
+                                name: str) -> Tuple[List[Dict[str, object]], Optional[Dict[str, str]]]:
+    """
+    Returns the stats dated after the named watermark, and the watermark to advance it to (the latest of their dates)
+    once they have been consumed, or None if there are none. Nothing is saved here (see commit_watermark), so
+    consumers must tolerate being re-sent rows, but never miss them; pass an explicit "since" to the lambda to
+    re-export from an earlier date.
+    """
+    since = read_watermark(session, name)
+    stats = query_stats(session, since=since)
+    watermark = {"name": name, "watermark": stats[-1]["date"]} if stats else None
+    return (stats, watermark)
+
+
+def commit_watermark(session: Session, watermark: Dict[str, str]) -> bool:
+    """
+    Saves a watermark returned by query_stats_since_watermark, once the stats it covers have been consumed. A
+    watermark never moves back, so committing an older one (e.g. a retried run's) changes nothing.
+    """
+    name = watermark["name"]
+    value = datetime.datetime.fromisoformat(watermark["watermark"])
+    current = read_watermark(session, name)
+    if current is not None and current >= value:
+        logger.info(f"Watermark {name} is already at {current}, not moving it back to {value}")
+        return False
+    save_watermark(session, name, value)
+    return True
+
+
+def stats_json(session: Session) -> str:
     """
     Returns a JSON representation of our stats data
     """
-    results = query_stats(session)
-    return json.dumps(results, default=str)
+    return "".join(iter_json_array(stream_stats(session)))
+
 
+def offload_stats(data: List[Dict[str, object]]) -> object:
+    """
+    Returns data, or a claim check for it if it's too large to pass to the next state
+    """
+    if settings.claim_check_format == PARQUET_FORMAT:
+        return offload_if_large(data, settings.claim_check_location, settings.claim_check_threshold_bytes,
+                                encode=lambda records: to_parquet_bytes(records, STAT_COLUMNS),
+                                blob_format=PARQUET_FORMAT)
+    return offload_if_large(data, settings.claim_check_location, settings.claim_check_threshold_bytes)
 
+
+@metrics.invocation("db_to_json")
 def lambda_handler(event, context):
-    logger.info(f"Incoming event: {event}")
+    logger.info("Incoming event: %s", Payload(event))
+    event = event or {}
     session = create_session()
+    watermark = None
+    try:
+        if "commit_watermark" in event:
+            # Nothing to commit when no watermark is configured, or nothing new was exported
+            committed = bool(event["commit_watermark"]) and commit_watermark(session, event["commit_watermark"])
+            return {"statusCode": 200, "body": {"committed": committed}}
+        if "since" in event:
+            since = datetime.datetime.fromisoformat(event["since"]) if event["since"] else None
+            data = query_stats(session, since=since)
+        elif settings.export_watermark_name:
+            (data, watermark) = query_stats_since_watermark(session, settings.export_watermark_name)
+        else:
+            data = query_stats(session)
+    except OperationalError:
+        # Most likely a rotated password or an unreachable host, so rebuild the engine next time
+        cache.invalidate()
+        raise
+    finally:
+        session.close()
+    metrics.add("rows_out", len(data))
     return {
         "statusCode": 200,
         "body": {
-            "data": query_stats(session)
+            "data": offload_stats(data),
+            "watermark": watermark
         }
     }
 
+def parse_arguments():
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('-f',
+                           '--format',
+                           action='store',
+                           choices=list(EXPORT_FORMATS) + list(COLUMNAR_FORMATS),
+                           default=None,
+                           dest='export_format',
+                           help="stream all stats in this format instead of printing a lambda response")
+    my_parser.add_argument('-o',
+                           '--output',
+                           action='store',
+                           type=argparse.FileType('w'),
+                           default=sys.stdout,
+                           dest='output')
+    return my_parser.parse_args()
+
+
 def main():
-    print(lambda_handler(None, None))
+    args = parse_arguments()
+    if args.export_format:
+        session = create_session()
+        try:
+            if args.export_format in COLUMNAR_FORMATS:
+                write_table(to_table(query_stats(session), STAT_COLUMNS), args.output.buffer, args.export_format)
+            else:
+                export_stats(session, args.output, args.export_format)
+        finally:
+            session.close()
+    else:
+        print(lambda_handler(None, None))
 
 if __name__ == "__main__":
     main()
@@ -2,20 +2,35 @@
 from dataclasses import dataclass
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy import Column, DateTime, Integer, String, TIMESTAMP
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+DEFAULT_REALM = "default"
+
 
 @dataclass
 class ENCVStat(Base):
     '''
-    Object representing ENCV stat - 
-    TODO: use for writing as well
+    Object representing ENCV stat, as encv_to_db stores it: one row per day and realm
     '''
     __tablename__ = "aphl_codes"
-    id: int = Column(Integer, primary_key=True)
-    date: datetime = Column(DateTime, unique=True)
+    date: datetime = Column(TIMESTAMP, nullable=False, primary_key=True)  # The key's index also serves "date > watermark" reads
+    realm: str = Column(String, nullable=False, primary_key=True, default=DEFAULT_REALM)
     codes_claimed: int = Column(Integer, nullable=False)
     codes_issued: int = Column(Integer, nullable=False)
+    codes_invalid: int = Column(Integer, nullable=False)
+    code_claim_mean_age_seconds: int = Column(Integer, nullable=False)
+    tokens_claimed: int = Column(Integer, nullable=False)
+    tokens_invalid: int = Column(Integer, nullable=False)
+
+
+@dataclass
+class ExportWatermark(Base):
+    '''
+    The date of the latest ENCV stat handed to a given consumer of the export
+    '''
+    __tablename__ = "export_watermarks"
+    name: str = Column(String, primary_key=True)
+    watermark: datetime = Column(DateTime, nullable=False)
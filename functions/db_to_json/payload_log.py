@@ -0,0 +1,56 @@
+import re
+from itertools import islice
+from typing import Optional
+
+# Values under keys matching this are never logged, e.g. a service account's private_key or an ENCV api_key
+REDACTED_KEYS = re.compile(
+    r"(private_key(_id)?|api[_-]?key|password|secret|token|authorization|credentials?(_info|_json)?)$", re.IGNORECASE)
+REDACTED = "[REDACTED]"
+
+
+def summarize(value: object, max_items: int = 5, max_chars: int = 200, max_depth: int = 4,
+              key: Optional[str] = None) -> object:
+    """
+    A copy of value that is cheap to print: lists and dicts are cut down to their first max_items entries (with a
+    note of how many were left out), strings to max_chars, nesting to max_depth, and anything under a credential-like
+    key is redacted. Frames, arrays and Arrow tables are reduced to their type and size.
+    """
+    if key is not None and REDACTED_KEYS.search(str(key)):
+        return REDACTED
+    if isinstance(value, (str, bytes)):
+        return value if len(value) <= max_chars else f"{value[:max_chars]!r}... ({len(value)} chars)"
+    if getattr(value, "ndim", 0) or hasattr(value, "num_rows"):
+        return f"<{type(value).__name__} {getattr(value, 'shape', None)}>"
+    if isinstance(value, (dict, list, tuple)) and max_depth == 0:
+        return f"<{type(value).__name__} of {len(value)}>"
+    if isinstance(value, dict):
+        summary = {item_key: summarize(item, max_items, max_chars, max_depth - 1, key=item_key)
+                   for item_key, item in islice(value.items(), max_items)}
+        if len(value) > max_items:
+            summary["..."] = f"{len(value) - max_items} more"
+        return summary
+    if isinstance(value, (list, tuple)):
+        summary = [summarize(item, max_items, max_chars, max_depth - 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            summary.append(f"... {len(value) - max_items} more")
+        return summary
+    return value
+
+
+class Payload:
+    """
+    Wraps a (possibly huge) structure for logging, e.g. logger.info("Incoming event: %s", Payload(event)). Logging
+    only formats its arguments once a record is actually emitted, so nothing is summarized or stringified unless the
+    level is enabled, and then only the summary (see summarize) is, once.
+    """
+
+    def __init__(self, value: object, **limits: int):
+        self.value = value
+        self.limits = limits
+        self.summary = None
+
+    def __str__(self) -> str:
+        # Each handler formats the record again, so only summarize once
+        if self.summary is None:
+            self.summary = str(summarize(self.value, **self.limits))
+        return self.summary
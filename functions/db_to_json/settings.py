@@ -1,14 +1,22 @@
 import os
 from pathlib import Path
+from typing import Optional
 
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
-    pghost: str
-    pgdatabase: str
-    pguser: str
-    pgpassword: str
+    pghost: Optional[str] = None
+    pgdatabase: Optional[str] = None
+    pguser: Optional[str] = None
+    pgpassword: Optional[str] = None
+    database_url: Optional[str] = None  # If supplied (e.g. sqlite:///stats.db), read from here rather than the PG* database
+    claim_check_location: Optional[str] = None  # If supplied (s3://bucket/prefix or a local directory), large payloads are offloaded here
+    claim_check_threshold_bytes: int = 128 * 1024  # ... once their serialized size exceeds this; Step Functions allows 256 KB
+    claim_check_format: str = "ndjson.gz"  # ... as gzipped NDJSON, or "parquet" to hand the next stage typed columns
+    export_watermark_name: Optional[str] = None  # If supplied, only stats newer than this persisted watermark are exported
+    export_realm: Optional[str] = None  # If supplied, only this realm's stats are exported; otherwise each day's are summed over realms
+    export_batch_size: int = 1000  # Rows fetched from the server-side cursor at a time when streaming stats
 
     class Config:
         env_file = Path('.') / '.env'
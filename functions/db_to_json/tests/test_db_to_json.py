@@ -2,6 +2,7 @@
 """
 
 import datetime
+import io
 import json
 
 import app as db_to_json
@@ -29,6 +30,10 @@ def stat_factory(mock_session):
             datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
         codes_claimed = fuzzy.FuzzyInteger(0, 42)
         codes_issued = fuzzy.FuzzyInteger(0, 10000)
+        codes_invalid = fuzzy.FuzzyInteger(0, 100)
+        code_claim_mean_age_seconds = fuzzy.FuzzyInteger(0, 86400)
+        tokens_claimed = fuzzy.FuzzyInteger(0, 42)
+        tokens_invalid = fuzzy.FuzzyInteger(0, 10)
 
     return ENCVStatFactory
 
@@ -54,11 +59,152 @@ def test_stats(mock_session, stat_factory) -> None:
     mock_session.commit()
     actual_result = db_to_json.stats_json(mock_session)
     expected_stats = [{
-        "id": stat.id,
         "date": str(stat.date),
         "codes_claimed": stat.codes_claimed,
-        "codes_issued": stat.codes_issued
+        "codes_issued": stat.codes_issued,
+        "codes_invalid": stat.codes_invalid,
+        "code_claim_mean_age_seconds": stat.code_claim_mean_age_seconds,
+        "tokens_claimed": stat.tokens_claimed,
+        "tokens_invalid": stat.tokens_invalid,
     } for stat in stats]
     expected_stats.sort(key=lambda x: x["date"])
     expected_result = json.dumps(expected_stats)
     assert actual_result == expected_result
+
+
+def test_export_stats(mock_session, stat_factory) -> None:
+    """
+    Streams stats in small batches in both export formats, and confirms the output matches a one-shot query
+    """
+    stats = stat_factory.create_batch(10)
+    mock_session.add_all([*stats])
+    mock_session.commit()
+    expected_stats = db_to_json.query_stats(mock_session)
+    assert len(expected_stats) == 10
+    assert list(db_to_json.stream_stats(mock_session, batch_size=3)) == expected_stats
+
+    out = io.StringIO()
+    assert db_to_json.export_stats(mock_session, out, "ndjson") == 10
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == expected_stats
+
+    out = io.StringIO()
+    db_to_json.export_stats(mock_session, out, "json")
+    assert out.getvalue() == json.dumps(expected_stats)
+
+
+def test_realms(mock_session, stat_factory, monkeypatch) -> None:
+    """
+    Exports each day once, totalled over realms, or only a single realm's stats when EXPORT_REALM is set
+    """
+    day = datetime.datetime(2021, 1, 1)
+    counts = {"codes_invalid": 1, "tokens_claimed": 2, "tokens_invalid": 3}
+    stat_factory.create(date=day, realm="a", codes_claimed=1, codes_issued=10, code_claim_mean_age_seconds=100, **counts)
+    stat_factory.create(date=day, realm="b", codes_claimed=3, codes_issued=20, code_claim_mean_age_seconds=500, **counts)
+    stat_factory.create(date=day + datetime.timedelta(days=1), realm="a", codes_claimed=0, codes_issued=30,
+                        code_claim_mean_age_seconds=0, **counts)
+    mock_session.commit()
+    assert db_to_json.query_stats(mock_session) == [
+        {"date": str(day), "codes_claimed": 4, "codes_issued": 30, "codes_invalid": 2,
+         "code_claim_mean_age_seconds": 400, "tokens_claimed": 4, "tokens_invalid": 6},
+        {"date": str(day + datetime.timedelta(days=1)), "codes_claimed": 0, "codes_issued": 30, "codes_invalid": 1,
+         "code_claim_mean_age_seconds": 0, "tokens_claimed": 2, "tokens_invalid": 3},
+    ]
+    monkeypatch.setattr(db_to_json.settings, "export_realm", "b")
+    assert db_to_json.query_stats(mock_session) == [
+        {"date": str(day), "codes_claimed": 3, "codes_issued": 20, "codes_invalid": 1,
+         "code_claim_mean_age_seconds": 500, "tokens_claimed": 2, "tokens_invalid": 3}]
+
+
+def test_query_stats_since_watermark(mock_session, stat_factory) -> None:
+    """
+    Exports stats incrementally, and confirms each export only contains stats newer than the last committed one
+    """
+    stats = stat_factory.create_batch(5, date=fuzzy.FuzzyDateTime(
+        datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)))
+    mock_session.commit()
+    (first_export, first_watermark) = db_to_json.query_stats_since_watermark(mock_session, "sheets")
+    assert [stat["date"] for stat in first_export] == sorted(str(stat.date) for stat in stats)
+    assert first_watermark == {"name": "sheets", "watermark": first_export[-1]["date"]}
+    # Until the consumer has written them and the watermark is committed, the same stats are exported again
+    assert db_to_json.read_watermark(mock_session, "sheets") is None
+    assert db_to_json.query_stats_since_watermark(mock_session, "sheets") == (first_export, first_watermark)
+    assert db_to_json.commit_watermark(mock_session, first_watermark)
+    assert db_to_json.query_stats_since_watermark(mock_session, "sheets") == ([], None)
+
+    newer = stat_factory.create(date=datetime.datetime(2021, 1, 1))
+    mock_session.commit()
+    (newer_export, newer_watermark) = db_to_json.query_stats_since_watermark(mock_session, "sheets")
+    assert [stat["date"] for stat in newer_export] == [str(newer.date)]
+    assert db_to_json.commit_watermark(mock_session, newer_watermark)
+    assert db_to_json.read_watermark(mock_session, "sheets") == datetime.datetime(2021, 1, 1)
+    # A late commit of an earlier export doesn't move the watermark back
+    assert not db_to_json.commit_watermark(mock_session, first_watermark)
+    assert db_to_json.read_watermark(mock_session, "sheets") == datetime.datetime(2021, 1, 1)
+    # Watermarks are tracked per name
+    assert len(db_to_json.query_stats_since_watermark(mock_session, "other")[0]) == 6
+    assert len(db_to_json.query_stats(mock_session, since=datetime.datetime(2020, 12, 31))) == 1
+
+
+def test_lambda_handler_commits_watermark_later(tmp_path, monkeypatch) -> None:
+    """
+    Confirms the handler only advances the watermark once its export is passed back to be committed
+    """
+    from resources import cache
+    monkeypatch.setattr(db_to_json.settings, "database_url", f"sqlite:///{tmp_path / 'stats.db'}")
+    monkeypatch.setattr(db_to_json.settings, "export_watermark_name", "sheets")
+    cache.invalidate()
+    engine = create_engine(db_to_json.settings.database_url)
+    Base.metadata.create_all(engine)
+    engine.execute(ENCVStat.__table__.insert(), [
+        {"date": datetime.datetime(2021, 1, day), "codes_claimed": 1, "codes_issued": 2, "codes_invalid": 0,
+         "code_claim_mean_age_seconds": 60, "tokens_claimed": 1, "tokens_invalid": 0} for day in (1, 2)])
+    try:
+        body = db_to_json.lambda_handler({}, None)["body"]
+        assert len(body["data"]) == 2
+        assert body["watermark"] == {"name": "sheets", "watermark": "2021-01-02 00:00:00"}
+        # e.g. json_to_sheets failed, so nothing was committed and the retry exports the same stats
+        assert db_to_json.lambda_handler({}, None)["body"] == body
+        assert db_to_json.lambda_handler({"commit_watermark": body["watermark"]}, None)["body"] == {"committed": True}
+        assert db_to_json.lambda_handler({}, None)["body"] == {"data": [], "watermark": None}
+        assert db_to_json.lambda_handler({"commit_watermark": None}, None)["body"] == {"committed": False}
+        # Without a watermark name there is nothing to commit, and every export is a full one
+        monkeypatch.setattr(db_to_json.settings, "export_watermark_name", None)
+        body = db_to_json.lambda_handler({}, None)["body"]
+        assert (len(body["data"]), body["watermark"]) == (2, None)
+    finally:
+        cache.invalidate()
+
+
+def test_columnar_export(mock_session, stat_factory, tmp_path, monkeypatch) -> None:
+    """
+    Round-trips stats through Parquet and Arrow files and a Parquet claim check, and confirms the schema is enforced
+    """
+    pytest.importorskip("pyarrow")
+    from claim_check import check_out
+    from interchange import conform, read_table, to_frame, to_table, write_table
+
+    stat_factory.create_batch(10)
+    mock_session.commit()
+    stats = db_to_json.query_stats(mock_session)
+    for table_format in ("parquet", "arrow"):
+        path = tmp_path / f"stats.{table_format}"
+        write_table(to_table(stats, db_to_json.STAT_COLUMNS), str(path))
+        df = to_frame(read_table(str(path), db_to_json.STAT_COLUMNS))
+        assert str(df.date.dtype) == "datetime64[ns, UTC]"
+        assert str(df.codes_claimed.dtype) == "int64"
+        assert df.codes_claimed.tolist() == [stat["codes_claimed"] for stat in stats]
+        assert [str(date.tz_localize(None)) for date in df.date] == [stat["date"] for stat in stats]
+
+    with pytest.raises(ValueError, match="Missing columns"):
+        to_table([{"date": "2021-01-01"}], db_to_json.STAT_COLUMNS)
+    with pytest.raises(ValueError, match="codes_issued"):
+        to_table([dict(stats[0], codes_issued="many")], db_to_json.STAT_COLUMNS)
+
+    monkeypatch.setattr(db_to_json.settings, "claim_check_location", str(tmp_path / "claim-checks"))
+    monkeypatch.setattr(db_to_json.settings, "claim_check_threshold_bytes", 0)
+    monkeypatch.setattr(db_to_json.settings, "claim_check_format", "parquet")
+    reference = db_to_json.offload_stats(stats)
+    assert reference["claim_check"]["format"] == "parquet"
+    df = to_frame(conform(check_out(reference), db_to_json.STAT_COLUMNS))
+    assert df.codes_issued.tolist() == [stat["codes_issued"] for stat in stats]
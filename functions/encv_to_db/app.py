@@ -13,19 +13,40 @@ It relies on the following configuration parameters:
   JSON string.
 * GOOGLE_CLOUD_PROJECT the name for the Google Cloud project in which your BigQuery database is hosted.
 * GOOGLE_CLOUD_DATASET the name of the dataset inside your BigQuery database.
+* DATABASE_URL [optional] a SQLAlchemy URL (e.g. sqlite:///stats.db) to store stats in instead of BigQuery.
 
+Run locally, it reads raw ENCV stats from data.json, or typed ENCVStat rows from a .parquet or .arrow file given with
+--data (see interchange.py).
 """
+import argparse
+import datetime
 import json
 import logging
-from typing import Dict
+import uuid
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, Iterator, List, Optional, Sequence, Union
 
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import (Column, DateTime, MetaData, Table as SQLTable, and_, bindparam, case, create_engine, func, or_,
+                        select, text)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.compiler import DDLCompiler
+from sqlalchemy.sql.elements import TextClause
 
-from models import Base, ENCVStat
+from claim_check import check_out
+from ingest import claim_age_histogram_to_df, statistics_to_df
+from interchange import columnar_format, model_columns, read_table, to_frame
+from metrics import metrics
+from models import Base, ENCVClaimAgeHistogram, ENCVStat
+from payload_log import Payload
+from resources import cache
+from schema import SchemaManager
 from secrets_manager import SecretsManager
 from settings import settings
 
@@ -34,11 +55,95 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+STAT_COLUMNS = model_columns(ENCVStat)
+
+STAGED_UPSERT_DIALECTS = ("bigquery", "postgresql")
+
+
+@compiles(CreateTable, "bigquery")
+def create_partitioned_table(element: CreateTable, compiler: DDLCompiler, **kw) -> str:
+    """
+    Adds PARTITION BY / CLUSTER BY clauses to BigQuery tables that declare partition_by / cluster_by in their info,
+    so queries filtering on those columns only scan the partitions and blocks they touch
+    """
+    table = element.element
+    quote = compiler.preparer.quote
+    ddl = compiler.visit_create_table(element, **kw).rstrip()
+    if table.info.get("partition_by"):
+        ddl += f"\nPARTITION BY DATE({quote(table.info['partition_by'])})"
+    if table.info.get("cluster_by"):
+        ddl += f"\nCLUSTER BY {', '.join(quote(name) for name in table.info['cluster_by'])}"
+    return ddl
+
+
+@dataclass
+class UpsertResult:
+    """
+    Outcome of an upsert: whether it succeeded, and how many rows were inserted and updated
+    """
+    success: bool = True
+    inserted: int = 0
+    updated: int = 0
+
+    def __bool__(self) -> bool:
+        return self.success
+
+
+@dataclass
+class StatsDiff:
+    """
+    Incoming rows split by how they compare to what is already stored
+    """
+    inserts: pd.DataFrame
+    updates: pd.DataFrame
+    unchanged: int = 0
+
+
+def with_key_defaults(df: pd.DataFrame, target: SQLTable) -> pd.DataFrame:
+    """
+    Fills in any primary key columns missing from df that have a scalar default, e.g. the realm of single-realm data
+    """
+    missing = {
+        column.name: column.default.arg for column in target.primary_key.columns
+        if column.name not in df.columns and column.default is not None and column.default.is_scalar
+    }
+    return df.assign(**missing) if missing else df
+
+
+def to_utc(dates: pd.Series) -> pd.Series:
+    """
+    Dates as UTC, whether the driver returned them with a timezone (e.g. BigQuery) or without one (e.g. SQLite)
+    """
+    dates = pd.to_datetime(dates)
+    return dates.dt.tz_localize("UTC") if dates.dt.tz is None else dates.dt.tz_convert("UTC")
+
+
+def key_index(df: pd.DataFrame, target: SQLTable) -> pd.Index:
+    """
+    Builds an index over the target table's primary key columns of df, suitable for hash lookups.
+    Timestamps are compared as naive UTC, since some backends (e.g. sqlite) drop the timezone.
+    """
+    arrays = []
+    for column in target.primary_key.columns:
+        values = df[column.name]
+        if isinstance(column.type, DateTime):
+            values = pd.to_datetime(values, utc=True).dt.tz_localize(None)
+        arrays.append(values)
+    if len(arrays) == 1:
+        return pd.Index(arrays[0])
+    return pd.MultiIndex.from_arrays(arrays)
+
 
 class SQLAlchemyDB:
-    def __init__(self, database_path: str, credentials_info: Dict[str, str] ):
+    upsert_batch_size = 500  # Rows per executemany on the batched upsert path
+    staging_batch_size = 500  # Rows per multi-row INSERT into the staging table, to keep each statement small
+
+    def __init__(self, database_path: str, credentials_info: Optional[Dict[str, str]] = None):
         self.database_path = database_path
-        self.engine = create_engine(self.database_path, credentials_info=credentials_info)
+        # Only the BigQuery dialect takes credentials
+        engine_options = {"credentials_info": credentials_info} if credentials_info is not None else {}
+        # pool_pre_ping checks each pooled connection on checkout, so long-lived engines survive dropped connections
+        self.engine = create_engine(self.database_path, pool_pre_ping=True, **engine_options)
         self.session = self.create_session()
 
     def create_session(self) -> Session:
@@ -50,93 +155,313 @@ class SQLAlchemyDB:
         session = Session()
         return session
 
-    def read(self, Table: DeclarativeMeta) -> pd.DataFrame:
-        """Read all data from DB"""
+    def read_query(self, Table: DeclarativeMeta, start: Optional[datetime.datetime] = None,
+                   end: Optional[datetime.datetime] = None, columns: Optional[Sequence[str]] = None):
+        """
+        Core select of the given columns (default: all) of the rows dated between start and end (inclusive, either
+        may be omitted), in key order
+        """
+        target = Table.__table__
+        query = select([target.c[name] for name in columns] if columns else list(target.columns))
+        if start is not None:
+            query = query.where(target.c.date >= start)
+        if end is not None:
+            query = query.where(target.c.date <= end)
+        return query.order_by(*target.primary_key.columns)
+
+    @metrics.timer("db_read")
+    def read(self, Table: DeclarativeMeta, start: Optional[datetime.datetime] = None,
+             end: Optional[datetime.datetime] = None, columns: Optional[Sequence[str]] = None,
+             chunksize: Optional[int] = None) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+        """
+        Reads rows from the DB into a DataFrame, straight from the result columns rather than through ORM objects.
+        Dates are returned in UTC.
+
+        start, end : [optional] only read rows dated in this (inclusive) range, which BigQuery uses to prune partitions
+        columns : [optional] only read these columns, e.g. ["date", "codes_issued"]
+        chunksize : [optional] instead, return an iterator of DataFrames of at most this many rows each, so that large
+            tables can be processed without holding all of them in memory
+        """
         logger.info("Fetching records...")
-        records = self.session.query(Table).all()
-        logger.info(f"Retrieved the following records: {records}")
+        query = self.read_query(Table, start=start, end=end, columns=columns)
+        if chunksize is None:
+            return self._typed_frame(pd.read_sql(query, self.session.connection()))
+        chunks = pd.read_sql(query, self.session.connection(), chunksize=chunksize)
+        return (self._typed_frame(chunk) for chunk in chunks)
 
-        df = pd.DataFrame.from_records([record.__dict__ for record in records])
-        df.date = pd.DatetimeIndex(df.date).tz_convert('UTC')
+    def _typed_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        logger.info(f"Retrieved {len(df)} records")
+        metrics.add("db_rows_read", len(df))
+        if "date" in df.columns:
+            df["date"] = to_utc(df["date"])
         return df
 
-    def upsert(self, stats_df: pd.DataFrame, Table: DeclarativeMeta) -> bool:
+    @metrics.timer("upsert")
+    def upsert(self, stats_df: pd.DataFrame, Table: DeclarativeMeta, bulk: bool = True) -> UpsertResult:
         """
         Adds or updates rows in the database.
 
         stats_df : A dictionary or list of dictionaries where the keys must at least include 'date'
+        bulk : If True (the default), apply the whole frame with set-based statements (see bulk_upsert).
+            Otherwise, query and update the database one row at a time.
         """
-        success = True
         logger.info("Upserting data...")
         supported_fields = set(f.name for f in Table.__table__.columns)
-        input_fields = set(stats_df.columns)
-        stats_df = stats_df.loc[:, supported_fields & input_fields]
+        stats_df = with_key_defaults(stats_df.loc[:, [field for field in stats_df.columns if field in supported_fields]],
+                                     Table.__table__)
         try:
-            data_objects = []
-            for index_row_pair in stats_df.iterrows():
-                row = index_row_pair[1]
-                db_row = self.session.query(Table).filter(
-                    Table.date == row.date).first()
-                row_dict = row.to_dict()
-                logger.debug(f"Processing {row_dict}...")
-                if db_row is None:
-                    # This date is not yet in the database. Add a new entry.
-                    data_obj = Table(**row_dict)
-                    logger.info(f"Adding {data_obj} to the session...")
-                    data_objects.append(data_obj)
-                else:
-                    # This date is already in the database. Update anything that has changed.
-                    for key in row.drop('date').keys():
-                        if row[key] != getattr(db_row, key):
-                            logger.info(
-                                f"Updating {row.date} {key} from {getattr(db_row, key)} to {row[key]}")
-                            setattr(db_row, key, row[key])
-            self.session.add_all(data_objects)
+            if bulk:
+                result = self.bulk_upsert(stats_df, Table)
+            else:
+                result = self.row_upsert(stats_df, Table)
             self.session.commit()
         except Exception as e:
             logger.error(f"Error writing to database: {e}")
-            success = False
-        return success
+            self.session.rollback()
+            return UpsertResult(success=False)
+        logger.info(f"Upsert complete: {result.inserted} rows inserted, {result.updated} rows updated")
+        metrics.add(f"{Table.__tablename__}_rows_inserted", result.inserted)
+        metrics.add(f"{Table.__tablename__}_rows_updated", result.updated)
+        return result
+
+    def row_upsert(self, stats_df: pd.DataFrame, Table: DeclarativeMeta) -> UpsertResult:
+        """
+        Adds or updates rows one at a time, issuing a query per row to look up the existing entry.
+        """
+        result = UpsertResult()
+        keys = [column.name for column in Table.__table__.primary_key.columns]
+        data_objects = []
+        for index_row_pair in stats_df.iterrows():
+            row = index_row_pair[1]
+            db_row = self.session.query(Table).filter_by(
+                **{key: row[key] for key in keys}).first()
+            row_dict = row.to_dict()
+            logger.debug("Processing %s...", row_dict)
+            if db_row is None:
+                # This date is not yet in the database. Add a new entry.
+                data_obj = Table(**row_dict)
+                logger.debug("Adding %s to the session...", data_obj)
+                data_objects.append(data_obj)
+                result.inserted += 1
+            else:
+                # This date is already in the database. Update anything that has changed.
+                changed = False
+                for key in row.drop(keys).keys():
+                    if row[key] != getattr(db_row, key):
+                        logger.info("Updating %s %s from %s to %s", row.date, key, getattr(db_row, key), row[key])
+                        setattr(db_row, key, row[key])
+                        changed = True
+                result.updated += changed
+        self.session.add_all(data_objects)
+        return result
+
+    @metrics.timer("db_diff")
+    def diff(self, stats_df: pd.DataFrame, Table: DeclarativeMeta) -> StatsDiff:
+        """
+        Classifies each incoming row as new, changed or unchanged relative to the database.
+
+        The existing rows for the incoming date range are fetched with one query and indexed by primary key, so
+        the classification is a vectorized lookup over the whole frame rather than a query per row.
+        """
+        target = Table.__table__
+        stats_df = with_key_defaults(stats_df, target)
+        keys = [column.name for column in target.primary_key.columns]
+        values = [name for name in stats_df.columns if name not in keys]
+        query = select([target.c[name] for name in keys + values]).where(
+            target.c.date.between(stats_df.date.min(), stats_df.date.max()))
+        if "realm" in target.c:
+            # Along with the date range, lets BigQuery prune to the partitions and clusters being written
+            query = query.where(target.c.realm.in_(stats_df.realm.unique().tolist()))
+        existing = pd.read_sql(query, self.session.connection())
+        existing.index = key_index(existing, target)
+        incoming = key_index(stats_df, target)
+        is_new = ~incoming.isin(existing.index)
+        aligned = existing[values].reindex(incoming)
+        is_changed = ~is_new & (aligned.to_numpy() != stats_df[values].to_numpy()).any(axis=1)
+        return StatsDiff(
+            inserts=stats_df[is_new],
+            updates=stats_df[is_changed],
+            unchanged=int((~is_new & ~is_changed).sum())
+        )
+
+    def bulk_upsert(self, stats_df: pd.DataFrame, Table: DeclarativeMeta) -> UpsertResult:
+        """
+        Adds or updates all rows of the frame with set-based statements. Rows are first diffed against the
+        database (see diff), and unchanged rows are dropped. The rest are written according to the engine's dialect:
+        * bigquery: load the rows into a staging table and apply them with a single MERGE
+        * postgresql: load the rows into a temporary table and apply them with a single INSERT ... ON CONFLICT
+        * anything else (e.g. sqlite): batched executemany inserts and updates
+        """
+        if stats_df.empty:
+            return UpsertResult()
+        diff = self.diff(stats_df, Table)
+        logger.info(f"{len(diff.inserts)} new, {len(diff.updates)} changed, {diff.unchanged} unchanged rows")
+        metrics.add(f"{Table.__tablename__}_rows_unchanged", diff.unchanged)
+        if self.engine.dialect.name in STAGED_UPSERT_DIALECTS:
+            changed = pd.concat([diff.inserts, diff.updates])
+            if not changed.empty:
+                self._staged_upsert(changed.to_dict("records"), Table.__table__)
+        else:
+            self._batched_upsert(diff.inserts.to_dict("records"), diff.updates.to_dict("records"), Table.__table__)
+        return UpsertResult(inserted=len(diff.inserts), updated=len(diff.updates))
+
+    def _staged_upsert(self, records: List[Dict[str, object]], target: SQLTable):
+        """
+        Loads records into a staging table with multi-row INSERTs of staging_batch_size rows, then applies them with one
+        statement. The staging table's name is unique to the call, so concurrent runs never share (or drop) each
+        other's.
+        """
+        dialect = self.engine.dialect.name
+        connection = self.session.connection()
+        staging_columns = [Column(column.name, column.type) for column in target.columns]
+        staging_name = f"{target.name}_staging_{uuid.uuid4().hex}"
+        if dialect == "postgresql":
+            # Temporary tables are private to this connection, and go away with the transaction
+            staging = SQLTable(staging_name, MetaData(), *staging_columns,
+                               prefixes=["TEMPORARY"], postgresql_on_commit="DROP")
+        else:
+            staging = SQLTable(staging_name, MetaData(), *staging_columns)
+        logger.info(f"Loading {len(records)} rows into {staging.name}...")
+        staging.create(bind=connection)
+        try:
+            for start in range(0, len(records), self.staging_batch_size):
+                connection.execute(staging.insert().values(records[start:start + self.staging_batch_size]))
+            if dialect == "bigquery":
+                statement = self._merge_statement(target, staging)
+            else:
+                statement = self._on_conflict_statement(target, staging)
+            connection.execute(statement)
+        finally:
+            if dialect == "bigquery":
+                staging.drop(bind=connection)
+
+    def _merge_statement(self, target: SQLTable, staging: SQLTable) -> TextClause:
+        """
+        MERGE statement applying the staging table to the target, only touching rows whose values changed
+        """
+        preparer = self.engine.dialect.identifier_preparer
+        quote = preparer.quote
+        columns = [column.name for column in target.columns]
+        keys = [column.name for column in target.primary_key.columns]
+        values = [name for name in columns if name not in keys]
+        match = " AND ".join(f"T.{quote(k)} = S.{quote(k)}" for k in keys)
+        changed = " OR ".join(f"T.{quote(v)} != S.{quote(v)}" for v in values)
+        assignments = ", ".join(f"{quote(v)} = S.{quote(v)}" for v in values)
+        return text(
+            f"MERGE {preparer.format_table(target)} T USING {preparer.format_table(staging)} S ON {match} "
+            f"WHEN MATCHED AND ({changed}) THEN UPDATE SET {assignments} "
+            f"WHEN NOT MATCHED THEN INSERT ({', '.join(quote(c) for c in columns)}) "
+            f"VALUES ({', '.join(f'S.{quote(c)}' for c in columns)})"
+        )
+
+    def _on_conflict_statement(self, target: SQLTable, staging: SQLTable) -> postgresql.Insert:
+        """
+        INSERT ... ON CONFLICT statement applying the staging table to the target, only touching rows whose
+        values changed
+        """
+        columns = [column.name for column in target.columns]
+        keys = [column.name for column in target.primary_key.columns]
+        values = [name for name in columns if name not in keys]
+        statement = postgresql.insert(target).from_select(columns, select([staging.c[c] for c in columns]))
+        return statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={v: statement.excluded[v] for v in values},
+            where=or_(*[target.c[v] != statement.excluded[v] for v in values])
+        )
+
+    def _batched_upsert(self, inserts: List[Dict[str, object]], updates: List[Dict[str, object]],
+                        target: SQLTable):
+        """
+        Writes already-classified rows with one executemany per batch of inserts and of updates
+        """
+        connection = self.session.connection()
+        keys = [column.name for column in target.primary_key.columns]
+        update = target.update().where(and_(*[target.c[k] == bindparam(f"_{k}") for k in keys]))
+        updates = [{**{f"_{k}": record.pop(k) for k in keys}, **record} for record in updates]
+        for start in range(0, len(inserts), self.upsert_batch_size):
+            connection.execute(target.insert(), inserts[start:start + self.upsert_batch_size])
+        for start in range(0, len(updates), self.upsert_batch_size):
+            connection.execute(update, updates[start:start + self.upsert_batch_size])
+
+    def claim_age_percentiles(self, start: datetime.datetime, end: datetime.datetime,
+                              percentiles: Sequence[float] = (0.5, 0.9, 0.99),
+                              realm: Optional[str] = None) -> Dict[float, Optional[int]]:
+        """
+        Returns, for each requested percentile, the code claim age bucket it falls in over the given date range,
+        for one realm or (by default) all of them.
+        The bucket totals, running sums and percentile lookups are all computed in the database in one query.
+        Percentiles are None if there is no histogram data in the range.
+        """
+        table = ENCVClaimAgeHistogram.__table__
+        in_range = table.c.date.between(start, end)
+        if realm is not None:
+            in_range = and_(in_range, table.c.realm == realm)
+        totals = (
+            select([table.c.bucket, func.sum(table.c.count).label("count")])
+            .where(in_range)
+            .group_by(table.c.bucket)
+            .alias("totals")
+        )
+        cumulative = select([
+            totals.c.bucket,
+            func.sum(totals.c.count).over(order_by=totals.c.bucket).label("running"),
+            func.sum(totals.c.count).over().label("total")
+        ]).alias("cumulative")
+        query = select([
+            func.min(case([(cumulative.c.running >= percentile * cumulative.c.total, cumulative.c.bucket)]))
+            .label(f"percentile_{i}")
+            for i, percentile in enumerate(percentiles)
+        ])
+        row = self.session.connection().execute(query).first()
+        return dict(zip(percentiles, row))
+
+    def dispose(self):
+        """Closes the session and releases all pooled connections"""
+        logger.info("Disposing of session and engine...")
+        self.session.close()
+        self.engine.dispose()
 
     def drop_table(self, Table: DeclarativeMeta):
         """Drops a given table"""
         logger.info(f"Dropping table {Table}...")
         Table.__table__.drop(self.engine)
 
+    @cached_property
+    def schema_manager(self) -> SchemaManager:
+        return SchemaManager(self.engine, Base.metadata)
+
+    @metrics.timer("create_tables")
     def create_tables(self):
-        """Create tables from this session"""
-        logger.info("Creating tables...")
-        Base.metadata.create_all(self.engine)
+        """
+        Creates missing tables and columns. Only the first call checks the database, later ones are free (see
+        SchemaManager), so this can be called before every write.
+        """
+        metrics.add("schema_changes", len(self.schema_manager.ensure()))
 
-    @property
     def row_count(self, Table: DeclarativeMeta) -> int:
         """Return number of rows"""
         logger.info(f"Obtaining row count for {Table}...")
-        return len(self.read(Table))
+        return self.session.execute(select([func.count()]).select_from(Table.__table__)).scalar()
 
 
-def push_to_db(db: SQLAlchemyDB, stats_df: pd.DataFrame) -> bool:
+def push_to_db(db: SQLAlchemyDB, stats_df: pd.DataFrame, histogram_df: pd.DataFrame = None) -> UpsertResult:
     """
-    Adds or updates rows in the database.
+    Adds or updates rows in the database, returning how many stats rows were inserted and updated.
 
     session : SQLAlchemy Session
     data : A dictionary or list of dictionaries where the keys must at least include 'date', and
         will typically also have at least 'codes_claimed' and 'codes_issued'.
+    histogram_df : [optional] code claim age histogram rows, as produced by claim_age_histogram_to_df.
+        If the histogram cannot be written, the result is marked unsuccessful.
     """
     db.create_tables()
-    success = db.upsert(stats_df=stats_df, Table=ENCVStat)
-    return success
-
-def flatten_data(entry: Dict[str, object]):
-    new_obj = {}
-    new_obj["date"] = entry["date"]
-    for data_point, val in entry["data"].items():
-        new_obj[data_point] = val
-    del new_obj["code_claim_age_distribution"]
-    return new_obj
+    result = db.upsert(stats_df=stats_df, Table=ENCVStat)
+    if histogram_df is not None:
+        histogram_result = db.upsert(stats_df=histogram_df, Table=ENCVClaimAgeHistogram)
+        result.success = result.success and histogram_result.success
+    return result
 
 def get_credentials_info() -> Dict[str, str] :
-    secrets_manager = SecretsManager()
     credentials_info = None
     if settings.google_application_credentials_json:
         logger.info("GOOGLE_APPLICATION_CREDENTIALS_JSON key found, loading directly from this")
@@ -147,31 +472,72 @@ def get_credentials_info() -> Dict[str, str] :
             credentials_info = json.load(f)
     else:
         logger.info("GOOGLE_APPLICATION_CREDENTIALS key not found, querying secrets manager...")
+        secrets_manager = cache.get(
+            "secrets_manager", lambda: SecretsManager(ttl_seconds=settings.secrets_ttl_seconds))
         credentials_info = secrets_manager.get(
-            secret_name=settings.GOOGLE_APPLICATION_CREDENTIALS_SECRET)
-    logger.debug(f"Credentials info: {credentials_info}")
+            secret_name=settings.google_application_credentials_secret)
+    logger.debug("Credentials info: %s", Payload(credentials_info))
     return credentials_info
 
-def lambda_handler(event, context):
-    logger.info(f"Incoming event: {event}")
-    data = map(flatten_data, event)
-    stats_df = pd.json_normalize(data)
-    project = settings.GOOGLE_CLOUD_PROJECT
-    dataset = settings.GOOGLE_CLOUD_DATASET
+def create_db() -> SQLAlchemyDB:
+    """
+    Builds a database connection from the configured project, dataset and credentials, or to DATABASE_URL if set
+    """
+    if settings.database_url:
+        return SQLAlchemyDB(database_path=settings.database_url)
+    project = settings.google_cloud_project
+    dataset = settings.google_cloud_dataset
     database_path = f"bigquery://{project}/{dataset}"
     credentials_info = get_credentials_info()
-    db = SQLAlchemyDB(database_path=database_path, credentials_info=credentials_info)
-    success = push_to_db(db, stats_df)
+    return SQLAlchemyDB(database_path=database_path, credentials_info=credentials_info)
+
+
+@metrics.invocation("encv_to_db")
+def lambda_handler(event, context):
+    logger.info("Incoming event: %s", Payload(event))
+    event = check_out(event)
+    with metrics.timer("parse"):
+        stats_df = statistics_to_df(event)
+        histogram_df = claim_age_histogram_to_df(event)
+    metrics.add("rows_in", len(stats_df))
+    if histogram_df is not None:
+        metrics.add("histogram_rows_in", len(histogram_df))
+    # Reused across warm invocations, so only a cold start reads credentials and builds the engine
+    db = cache.get("db", create_db, check=lambda db: db.session.is_active)
+    result = push_to_db(db, stats_df, histogram_df)
+    if not result.success:
+        # The failure may be down to rotated credentials or a broken connection, so rebuild everything next time
+        cache.invalidate()
     return {
         "statusCode": 200,
         "body": {
-            "success": success
+            "success": result.success,
+            "inserted": result.inserted,
+            "updated": result.updated
         }
     }
 
 
+def parse_arguments():
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('-d',
+                           '--data',
+                           action='store',
+                           default="data.json",
+                           type=str,
+                           dest='data',
+                           help="raw ENCV stats as JSON, or ENCVStat rows as a .parquet or .arrow file")
+    return my_parser.parse_args()
+
+
 def main():
-    with open("data.json", "r") as infile:
+    args = parse_arguments()
+    if columnar_format(args.data):
+        # Already typed ENCVStat columns, so there's nothing to parse. Histograms only come with raw stats.
+        stats_df = to_frame(read_table(args.data, STAT_COLUMNS))
+        print(push_to_db(create_db(), stats_df))
+        return
+    with open(args.data, "r") as infile:
         data = json.load(infile)
     print(lambda_handler(data, None))
 
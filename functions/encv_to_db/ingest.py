@@ -0,0 +1,60 @@
+from itertools import chain
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Integer
+
+from models import DEFAULT_REALM, ENCVStat
+
+# The integer-valued fields of each entry's "data" object that we store
+STAT_FIELDS = tuple(column.name for column in ENCVStat.__table__.columns if isinstance(column.type, Integer))
+# Collected entries are tagged with the endpoint they came from; untagged entries are realm stats
+REALM_ENDPOINT = "realm.json"
+
+
+def realm_statistics(statistics: List[Dict[str, object]]) -> List[Dict[str, object]]:
+    """
+    Returns the realm stats entries, dropping those collected from other endpoints (e.g. per-user stats)
+    """
+    return [entry for entry in statistics if entry.get("endpoint", REALM_ENDPOINT) == REALM_ENDPOINT]
+
+
+def statistics_to_df(statistics: List[Dict[str, object]]) -> pd.DataFrame:
+    """
+    Converts the `statistics` list returned by the ENCV stats API into a DataFrame.
+
+    Each entry's realm tag (see query_encv's collector) becomes the realm column, defaulting to DEFAULT_REALM.
+    Values are written straight into preallocated int64 columns in a single pass over the entries, and dates are
+    parsed once into a datetime64[ns, UTC] column, so no intermediate per-row dicts or normalization are needed.
+    Fields we don't store (e.g. code_claim_age_distribution) are never copied.
+    """
+    statistics = realm_statistics(statistics)
+    dates = np.empty(len(statistics), dtype=object)
+    realms = np.empty(len(statistics), dtype=object)
+    columns = {field: np.empty(len(statistics), dtype=np.int64) for field in STAT_FIELDS}
+    for i, entry in enumerate(statistics):
+        dates[i] = entry["date"]
+        realms[i] = entry.get("realm", DEFAULT_REALM)
+        data = entry["data"]
+        for field, column in columns.items():
+            column[i] = data[field]
+    return pd.DataFrame({"date": pd.to_datetime(dates, utc=True), "realm": realms, **columns})
+
+
+def claim_age_histogram_to_df(statistics: List[Dict[str, object]]) -> pd.DataFrame:
+    """
+    Converts the code_claim_age_distribution of each entry in the ENCV `statistics` list into a long
+    (date, realm, bucket, count) DataFrame. Each day's bucket counts are concatenated into one int64 array, with the dates
+    and bucket indices expanded alongside it, rather than building a record per bucket.
+    """
+    statistics = realm_statistics(statistics)
+    distributions = [entry["data"].get("code_claim_age_distribution") or [] for entry in statistics]
+    lengths = np.fromiter(map(len, distributions), dtype=np.int64, count=len(distributions))
+    total = int(lengths.sum())
+    counts = np.fromiter(chain.from_iterable(distributions), dtype=np.int64, count=total)
+    buckets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    dates = pd.to_datetime([entry["date"] for entry in statistics], utc=True)
+    realms = np.array([entry.get("realm", DEFAULT_REALM) for entry in statistics], dtype=object)
+    return pd.DataFrame({"date": dates.repeat(lengths), "realm": realms.repeat(lengths), "bucket": buckets,
+                         "count": counts})
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ExposureNotificationsMetrics")
+COUNT = "Count"
+BYTES = "Bytes"
+MILLISECONDS = "Milliseconds"
+
+
+class Metrics:
+    """
+    Collects numbers about an invocation (rows in and out, bytes, retries, and how long the HTTP calls, queries,
+    upserts and Sheets writes took) and emits them as a single CloudWatch Embedded Metric Format (EMF) line when it
+    ends, which CloudWatch turns into graphable metrics without any API calls.
+
+    Safe to use from several threads. Timers add up, so a stage that is called several times per invocation reports
+    its total time and call count.
+    """
+
+    def __init__(self, namespace: str = NAMESPACE, emit: Callable[[str], None] = None):
+        self.namespace = namespace
+        self.emit = emit or (lambda line: print(line, flush=True))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, **dimensions: str):
+        with self.lock:
+            self.dimensions = dimensions
+            self.values: Dict[str, float] = {}
+            self.units: Dict[str, str] = {}
+
+    def add(self, name: str, value: float = 1, unit: str = COUNT):
+        """
+        Adds value to the named metric
+        """
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Adds the time spent in the block to {name}_ms and counts the call in {name}_calls. Can also be used as a
+        decorator, e.g. @metrics.timer("upsert").
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_ms", (time.perf_counter() - started) * 1000, MILLISECONDS)
+            self.add(f"{name}_calls")
+
+    def document(self) -> Dict[str, object]:
+        """
+        The EMF document for the metrics collected so far
+        """
+        with self.lock:
+            return {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(self.dimensions)],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, unit in sorted(self.units.items())],
+                    }],
+                },
+                **self.dimensions,
+                **{name: round(value, 3) for name, value in self.values.items()},
+            }
+
+    def flush(self):
+        self.emit(json.dumps(self.document()))
+        self.reset(**self.dimensions)
+
+    def invocation(self, function_name: str) -> Callable:
+        """
+        Decorates a handler so that each call starts with fresh metrics, is timed as a whole, and ends by emitting
+        them, whether or not it succeeds
+        """
+        def decorator(handler: Callable) -> Callable:
+            @wraps(handler)
+            def wrapper(*args, **kwargs):
+                self.reset(function=function_name)
+                try:
+                    with self.timer("invocation"):
+                        return handler(*args, **kwargs)
+                except Exception:
+                    self.add("errors")
+                    raise
+                finally:
+                    self.flush()
+            return wrapper
+        return decorator
+
+
+metrics = Metrics()
@@ -1,12 +1,23 @@
 
 from dataclasses import dataclass
 from datetime import datetime
+from typing import Dict
 
-from sqlalchemy import Column, DateTime, Integer, String, TIMESTAMP
+from sqlalchemy import Column, Integer, String, TIMESTAMP
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+DEFAULT_REALM = "default"
+
+
+def partitioned_by_date_clustered_by_realm() -> Dict[str, Dict[str, object]]:
+    """
+    Table args that partition a table by day and cluster it by realm on BigQuery (see the CreateTable hook next to
+    SQLAlchemyDB). A new dict each time, since each table keeps its own info.
+    """
+    return {"info": {"partition_by": "date", "cluster_by": ["realm"]}}
+
 
 @dataclass
 class ENCVStat(Base):
@@ -14,7 +25,9 @@ class ENCVStat(Base):
     Object representing ENCV stat
     '''
     __tablename__ = "aphl_codes"
+    __table_args__ = partitioned_by_date_clustered_by_realm()
     date: datetime = Column(TIMESTAMP, nullable=False, primary_key=True)
+    realm: str = Column(String, nullable=False, primary_key=True, default=DEFAULT_REALM)
     codes_claimed: int = Column(Integer, nullable=False)
     codes_issued: int = Column(Integer, nullable=False)
     codes_invalid: int = Column(Integer, nullable=False)
@@ -22,3 +35,15 @@ class ENCVStat(Base):
     tokens_claimed: int = Column(Integer, nullable=False)
     tokens_invalid: int = Column(Integer, nullable=False)
 
+
+@dataclass
+class ENCVClaimAgeHistogram(Base):
+    '''
+    Object representing one bucket of an ENCV stat's code claim age distribution
+    '''
+    __tablename__ = "aphl_code_claim_age_histogram"
+    __table_args__ = partitioned_by_date_clustered_by_realm()
+    date: datetime = Column(TIMESTAMP, nullable=False, primary_key=True)
+    realm: str = Column(String, nullable=False, primary_key=True, default=DEFAULT_REALM)
+    bucket: int = Column(Integer, nullable=False, primary_key=True, autoincrement=False)
+    count: int = Column(Integer, nullable=False)
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import threading
+from typing import List, Optional, Set
+
+from sqlalchemy import Column, MetaData, Table, inspect, literal, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import column as sql_column, table as sql_table
+
+logger = logging.getLogger()
+
+
+def schema_fingerprint(metadata: MetaData) -> str:
+    """
+    Hash of every table's column names, types and nullability, which changes whenever a model gains or changes a field
+    """
+    parts = [f"{table.name}.{column.name}:{column.type!r}:{column.nullable}"
+             for table in metadata.sorted_tables for column in table.columns]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def needs_rebuild(column: Column) -> bool:
+    """
+    Whether a column missing from an existing table can't simply be added as a nullable column: it's part of the
+    primary key, or may not be NULL
+    """
+    return column.primary_key or not column.nullable
+
+
+def scalar_default(column: Column) -> Optional[object]:
+    return column.default.arg if column.default is not None and column.default.is_scalar else None
+
+
+class SchemaManager:
+    """
+    Brings a database up to the schema of the models: creates missing tables, and adds the columns that models have
+    gained since their tables were created. Nothing is ever dropped:
+    * nullable columns are added with ALTER TABLE ... ADD COLUMN
+    * key or NOT NULL columns are only added if they have a scalar default (e.g. realm). The table is then rebuilt
+      with the model's key, and existing rows are copied over with the default filled in.
+    * anything else (e.g. a NOT NULL column with no default) raises a ValueError, leaving the table as it was
+
+    The database is only checked the first time ensure is called. After that the manager just remembers that it did
+    (as a fingerprint of the models, held in memory and never compared against the database), so later calls in the
+    same warm process issue no DDL and no introspection queries at all. A new process checks again.
+    """
+
+    def __init__(self, engine: Engine, metadata: MetaData):
+        self.engine = engine
+        self.metadata = metadata
+        self.fingerprint: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def ensure(self) -> List[str]:
+        """
+        Migrates the database unless this manager already did so for the current models, returning the changes made
+        """
+        fingerprint = schema_fingerprint(self.metadata)
+        if fingerprint == self.fingerprint:
+            return []
+        with self.lock:
+            if fingerprint == self.fingerprint:
+                return []
+            changes = self.migrate()
+            self.fingerprint = fingerprint
+        return changes
+
+    def migrate(self) -> List[str]:
+        """
+        Creates missing tables and adds missing columns, returning a description of each change
+        """
+        logger.info("Checking schema...")
+        inspector = inspect(self.engine)
+        existing_tables = set(inspector.get_table_names())
+        changes = []
+        for table in self.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                logger.info(f"Creating table {table.name}...")
+                table.create(self.engine)
+                changes.append(f"created {table.name}")
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing_columns]
+            if any(needs_rebuild(column) for column in missing):
+                self.rebuild_table(table, existing_columns)
+                changes.extend(f"added {table.name}.{column.name}" for column in missing)
+                continue
+            for column in missing:
+                self.add_column(table, column)
+                changes.append(f"added {table.name}.{column.name}")
+        logger.info(f"Schema changes: {changes}" if changes else "Schema is up to date")
+        return changes
+
+    def add_column(self, table: Table, column: Column):
+        """
+        Adds a nullable column to an existing table
+        """
+        dialect = self.engine.dialect
+        preparer = dialect.identifier_preparer
+        logger.info(f"Adding column {table.name}.{column.name}...")
+        with self.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} "
+                                    f"ADD COLUMN {preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"))
+
+    def rebuild_table(self, table: Table, existing_columns: Set[str]):
+        """
+        Recreates table from its model, copying the existing rows over and filling the columns they lack with their
+        scalar defaults, so that key and NOT NULL columns can be added (and the model's primary key applied)
+        """
+        missing = [column for column in table.columns if column.name not in existing_columns]
+        without_default = [column.name for column in missing if scalar_default(column) is None]
+        if without_default:
+            raise ValueError(f"Can't add {without_default} to {table.name}: the rows already there would need a value, "
+                             f"but they have no scalar default. Migrate the table by hand.")
+        unknown = sorted(existing_columns - {column.name for column in table.columns})
+        if unknown:
+            raise ValueError(f"Can't rebuild {table.name} to add {[column.name for column in missing]}: it has columns "
+                             f"the model doesn't ({unknown}), which would be lost. Migrate the table by hand.")
+        preparer = self.engine.dialect.identifier_preparer
+        legacy_name = f"{table.name}_legacy"
+        logger.info(f"Rebuilding {table.name} to add {[column.name for column in missing]}...")
+        with self.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} "
+                                    f"RENAME TO {preparer.quote(legacy_name)}"))
+            table.create(connection)
+            self.copy_rows(connection, table, legacy_name, existing_columns)
+            connection.execute(text(f"DROP TABLE {preparer.quote(legacy_name)}"))
+
+    def copy_rows(self, connection: Connection, table: Table, legacy_name: str, existing_columns: Set[str]):
+        legacy = sql_table(legacy_name, *[sql_column(name) for name in existing_columns])
+        values = [legacy.c[column.name] if column.name in existing_columns
+                  else literal(scalar_default(column), column.type).label(column.name)
+                  for column in table.columns]
+        connection.execute(table.insert().from_select([column.name for column in table.columns], select(values)))
@@ -1,41 +1,83 @@
 import base64
 import json
 import logging
-
-import boto3
-from botocore.exceptions import ClientError
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
 
 
 class SecretsManager:
-    def __init__(self):
-        session = boto3.session.Session()
-        self.client = session.client(
-            service_name='secretsmanager',
-            region_name=session.region_name
-        )
-
-    def get(self, secret_name: str, secret_key: str = None):
-        result = None
+    """
+    Reads secrets from AWS Secrets Manager, keeping each one in an in-process cache for ttl_seconds.
+
+    Entries are cached per (secret name, version stage), so e.g. AWSCURRENT and AWSPENDING can be read side by side
+    while a secret rotates. Refreshes are single-flight: when an entry expires, one caller fetches it while any
+    concurrent callers for the same entry wait for that result rather than calling Secrets Manager themselves.
+    """
+
+    def __init__(self, client=None, ttl_seconds: float = 300, clock: Callable[[], float] = time.monotonic):
+        if client is None:
+            import boto3  # Deferred so that cold starts which never read a secret don't pay for importing it
+            session = boto3.session.Session()
+            client = session.client(
+                service_name='secretsmanager',
+                region_name=session.region_name
+            )
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._cache: Dict[Tuple[str, str], Tuple[float, object]] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def get(self, secret_name: str, secret_key: str = None, version_stage: str = "AWSCURRENT"):
+        secret = self._get_cached(secret_name, version_stage)
+        if secret_key:
+            return secret[secret_key]
+        return secret
+
+    def invalidate(self, secret_name: Optional[str] = None):
+        """
+        Drops cached values for the given secret (all version stages), or for every secret, e.g. after a rotation
+        """
+        for key in list(self._cache):
+            if secret_name is None or key[0] == secret_name:
+                self._cache.pop(key, None)
+
+    def _get_cached(self, secret_name: str, version_stage: str):
+        key = (secret_name, version_stage)
+        entry = self._cache.get(key)
+        if entry and entry[0] > self.clock():
+            return entry[1]
+        with self._lock_for(key):
+            # Another caller may have refreshed this entry while we were waiting for the lock
+            entry = self._cache.get(key)
+            if entry and entry[0] > self.clock():
+                return entry[1]
+            secret = self._fetch(secret_name, version_stage)
+            self._cache[key] = (self.clock() + self.ttl_seconds, secret)
+            return secret
+
+    def _lock_for(self, key: Tuple[str, str]) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _fetch(self, secret_name: str, version_stage: str):
+        from botocore.exceptions import ClientError
+        logging.info(f"Fetching secret {secret_name} ({version_stage}) from secrets manager...")
         try:
             get_secret_value_response = self.client.get_secret_value(
-                SecretId=secret_name
+                SecretId=secret_name,
+                VersionStage=version_stage
             )
         except ClientError as e:
             logging.error(
                 f"Encountered error in fetching secret {secret_name}: {e}")
             raise e
+        # Decrypts secret using the associated KMS CMK.
+        # Depending on whether the secret is a string or binary, one of these fields will be populated.
+        if 'SecretString' in get_secret_value_response:
+            secret = get_secret_value_response['SecretString']
         else:
-            # Decrypts secret using the associated KMS CMK.
-            # Depending on whether the secret is a string or binary, one of these fields will be populated.
-            if 'SecretString' in get_secret_value_response:
-                secret = get_secret_value_response['SecretString']
-                json_secret = json.loads(secret)
-                if secret_key:
-                    return json_secret[secret_key]
-                else:
-                    return json_secret
-            else:
-                decoded_binary_secret = base64.b64decode(
-                    get_secret_value_response['SecretBinary'])
-                result = decoded_binary_secret.password
-        return result
+            secret = base64.b64decode(get_secret_value_response['SecretBinary'])
+        return json.loads(secret)
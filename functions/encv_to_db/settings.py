@@ -8,6 +8,11 @@ from pydantic import BaseSettings
 class Settings(BaseSettings):
     google_application_credentials_json: Optional[str] = None  # If supplied, we will read this json blob right away as the credentials
     google_application_credentials: Optional[str] = None # If supplied, we read from this file to get the json. If even this is not supplied, we will query secrets manager for the value
+    google_application_credentials_secret: Optional[str] = None  # The name of the secret in secrets manager holding the json
+    google_cloud_project: Optional[str] = None
+    google_cloud_dataset: Optional[str] = None
+    database_url: Optional[str] = None  # If supplied (e.g. sqlite:///stats.db or postgresql://...), stats are stored there instead of in BigQuery
+    secrets_ttl_seconds: int = 300  # How long secrets are cached for between warm invocations
     log_level: str = "INFO"
 
     class Config:
@@ -3,31 +3,46 @@ Tests the data transformation logic in the code used for writing encv data to a
 """
 
 import datetime
+import json
+import logging
 
 import app as encv_to_db
 import factory
 import factory.fuzzy as fuzzy
 import pandas as pd
+import payload_log
 import pytest
-from models import ENCVStat
-from sqlalchemy import create_engine
+from claim_check import CLAIM_CHECK_KEY, check_out, offload_if_large
+from ingest import claim_age_histogram_to_df, statistics_to_df
+from metrics import metrics
+from models import ENCVClaimAgeHistogram, ENCVStat
+from payload_log import REDACTED, Payload, summarize
+from resources import ResourceCache
+from schema import SchemaManager
+from sqlalchemy import Column, Integer, MetaData, String, Table as SQLTable, create_engine, event, inspect, select
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+
+
+class StatFactory(factory.Factory):
+    """
+    Creates randomly-generated ENCVStat objects (also used to generate benchmark payloads, see benchmarks/)
+    """
+    class Meta:
+        model = ENCVStat
+
+    date = fuzzy.FuzzyDateTime(
+        datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+    codes_claimed = fuzzy.FuzzyInteger(0, 42)
+    codes_issued = fuzzy.FuzzyInteger(0, 10000)
+    codes_invalid = fuzzy.FuzzyInteger(0, 10000)
+    code_claim_mean_age_seconds = fuzzy.FuzzyInteger(0, 10000)
+    tokens_claimed = fuzzy.FuzzyInteger(0, 10000)
+    tokens_invalid = fuzzy.FuzzyInteger(0, 10000)
 
 
 @pytest.fixture
 def sample_df() -> pd.DataFrame:
-    class StatFactory(factory.Factory):
-        class Meta:
-            model = ENCVStat
-
-        date = fuzzy.FuzzyDateTime(
-            datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
-        codes_claimed = fuzzy.FuzzyInteger(0, 42)
-        codes_issued = fuzzy.FuzzyInteger(0, 10000)
-        codes_invalid = fuzzy.FuzzyInteger(0, 10000)
-        code_claim_mean_age_seconds = fuzzy.FuzzyInteger(0, 10000)
-        tokens_claimed = fuzzy.FuzzyInteger(0, 10000)
-        tokens_invalid = fuzzy.FuzzyInteger(0, 10000)
-
     sample_data_iterable = [factory.build(dict, FACTORY_CLASS=StatFactory) for x in range(5)]
     sample_data_df = pd.json_normalize(sample_data_iterable)
     sample_data_df.date = pd.to_datetime(sample_data_df.date)
@@ -97,3 +112,348 @@ def test_unknown_field(sample_df: pd.DataFrame) -> None:
     result_df = sqlite_compatible_read(db)
     result_df = result_df[sample_df.columns]  # Reorder columns to match expected data
     assert result_df.equals(sample_df)
+
+
+def test_db_upsert_counts(sample_df: pd.DataFrame) -> None:
+    """
+    Inserts several rows of sample data, then re-sends them with a single changed value.
+    Confirms that the reported counts reflect what was actually written.
+    """
+    db = SQLiteDB()
+    result = encv_to_db.push_to_db(db, sample_df)
+    assert (result.success, result.inserted, result.updated) == (True, len(sample_df), 0)
+    sample_df.loc[0, 'codes_claimed'] = 827
+    result = encv_to_db.push_to_db(db, sample_df)
+    assert (result.success, result.inserted, result.updated) == (True, 0, 1)
+
+
+def test_db_update_row_by_row(sample_df: pd.DataFrame) -> None:
+    """
+    Exercises the one-query-per-row upsert path, which should produce the same result as the bulk path.
+    """
+    db = SQLiteDB()
+    db.create_tables()
+    db.upsert(sample_df, ENCVStat, bulk=False)
+    sample_df.loc[0, 'codes_claimed'] = 827
+    result = db.upsert(sample_df, ENCVStat, bulk=False)
+    assert (result.inserted, result.updated) == (0, 1)
+    result_df = sqlite_compatible_read(db)
+    result_df = result_df[sample_df.columns]  # Reorder columns to match expected data
+    assert result_df.equals(sample_df)
+
+
+def test_staged_upsert(sample_df: pd.DataFrame, monkeypatch) -> None:
+    """
+    Loads the staging table in chunks, under a name unique to the call, then applies it to the target
+    """
+    db = SQLiteDB()
+    db.create_tables()
+    target = ENCVStat.__table__
+    monkeypatch.setattr(db, "staging_batch_size", 2)
+    # SQLite can't run the Postgres INSERT ... ON CONFLICT, so apply the staging table with a plain insert
+    monkeypatch.setattr(db, "_on_conflict_statement", lambda target, staging: target.insert().from_select(
+        [column.name for column in target.columns], select([staging.c[column.name] for column in target.columns])))
+    statements = []
+    event.listen(db.engine, "before_cursor_execute",
+                 lambda connection, cursor, statement, *args: statements.append(statement))
+    records = encv_to_db.with_key_defaults(sample_df, target).to_dict("records")
+    for _ in range(2):
+        db._staged_upsert(records, target)
+        db.session.rollback()
+    staging_inserts = [statement for statement in statements if statement.startswith("INSERT INTO aphl_codes_staging_")]
+    # Two calls, each loading its 5 rows 2 at a time into a table of its own
+    assert len(staging_inserts) == 2 * 3
+    assert len({statement.split()[2] for statement in staging_inserts}) == 2
+    db._staged_upsert(records, target)
+    db.session.commit()
+    assert db.session.query(ENCVStat).count() == len(records)
+
+
+def test_db_diff(sample_df: pd.DataFrame) -> None:
+    """
+    Inserts all but the last row of sample data, changes one stored value, and diffs the full frame.
+    Confirms that each row lands in the right category.
+    """
+    db = SQLiteDB()
+    encv_to_db.push_to_db(db, sample_df[:-1])
+    sample_df.loc[0, 'codes_claimed'] = 827
+    diff = db.diff(sample_df, ENCVStat)
+    assert diff.inserts[sample_df.columns].equals(sample_df[-1:])
+    assert diff.updates[sample_df.columns].equals(sample_df[:1])
+    assert diff.unchanged == len(sample_df) - 2
+
+
+@pytest.fixture
+def statistics() -> list:
+    """
+    A raw ENCV statistics payload, as returned by the stats API
+    """
+    return [
+        {"date": "2021-02-01T00:00:00Z",
+         "data": {"codes_issued": 10, "codes_claimed": 5, "codes_invalid": 1, "tokens_claimed": 4,
+                  "tokens_invalid": 0, "code_claim_mean_age_seconds": 300,
+                  "code_claim_age_distribution": [1, 2, 0, 1]}},
+        {"date": "2021-02-02T00:00:00Z",
+         "data": {"codes_issued": 20, "codes_claimed": 15, "codes_invalid": 2, "tokens_claimed": 14,
+                  "tokens_invalid": 1, "code_claim_mean_age_seconds": 600,
+                  "code_claim_age_distribution": [0, 2, 0, 0]}},
+    ]
+
+
+def test_statistics_to_df(statistics) -> None:
+    """
+    Converts a raw ENCV statistics payload and confirms the columns, dtypes and values of the result.
+    """
+    stats_df = statistics_to_df(statistics)
+    assert str(stats_df.date.dtype) == "datetime64[ns, UTC]"
+    assert (stats_df.drop(columns=["date", "realm"]).dtypes == "int64").all()
+    assert stats_df.realm.tolist() == ["default", "default"]
+    assert "code_claim_age_distribution" not in stats_df.columns
+    assert stats_df.date.tolist() == [pd.Timestamp("2021-02-01", tz="UTC"), pd.Timestamp("2021-02-02", tz="UTC")]
+    assert stats_df.codes_claimed.tolist() == [5, 15]
+    assert stats_df.code_claim_mean_age_seconds.tolist() == [300, 600]
+    # Entries collected from other endpoints are ignored
+    users = {"date": "2021-02-01T00:00:00Z", "endpoint": "realm/users.json", "data": {"user_id": 1}}
+    assert statistics_to_df(statistics + [users]).equals(stats_df)
+
+
+def test_claim_age_histogram(statistics) -> None:
+    """
+    Stores the claim age distributions of a raw payload, and confirms the stored rows and computed percentiles.
+    """
+    db = SQLiteDB()
+    histogram_df = claim_age_histogram_to_df(statistics)
+    result = encv_to_db.push_to_db(db, statistics_to_df(statistics), histogram_df)
+    assert result.success
+    stored = db.session.query(ENCVClaimAgeHistogram).order_by(
+        ENCVClaimAgeHistogram.date, ENCVClaimAgeHistogram.bucket).all()
+    assert [(stat.bucket, stat.count) for stat in stored] == [(0, 1), (1, 2), (2, 0), (3, 1),
+                                                              (0, 0), (1, 2), (2, 0), (3, 0)]
+    # Bucket totals over both days are [1, 4, 0, 1], so running sums are [1, 5, 5, 6]
+    percentiles = db.claim_age_percentiles(
+        datetime.datetime(2021, 2, 1), datetime.datetime(2021, 2, 2), percentiles=(0.1, 0.5, 0.9))
+    assert percentiles == {0.1: 0, 0.5: 1, 0.9: 3}
+    # Only the first day: [1, 2, 0, 1]
+    percentiles = db.claim_age_percentiles(
+        datetime.datetime(2021, 2, 1), datetime.datetime(2021, 2, 1), percentiles=(0.5,))
+    assert percentiles == {0.5: 1}
+
+
+def test_claim_check(statistics, tmp_path) -> None:
+    """
+    Offloads a payload to the local filesystem backend only once it exceeds the threshold, and reads it back.
+    """
+    location = str(tmp_path / "claim-checks")
+    assert offload_if_large(statistics, location, threshold_bytes=1 << 20) is statistics
+    assert offload_if_large(statistics, None, threshold_bytes=0) is statistics
+    reference = offload_if_large(statistics, location, threshold_bytes=0)
+    assert reference[CLAIM_CHECK_KEY]["count"] == len(statistics)
+    assert reference[CLAIM_CHECK_KEY]["uri"].startswith(location)
+    assert check_out(reference) == statistics
+    # Payloads that were never offloaded pass through untouched
+    assert check_out(statistics) is statistics
+    assert statistics_to_df(check_out(reference)).equals(statistics_to_df(statistics))
+
+
+def test_resource_cache() -> None:
+    """
+    Confirms that cached resources are built once, and rebuilt after a failed health check or an invalidation,
+    releasing the old resource each time.
+    """
+    class Resource:
+        disposed = False
+
+        def dispose(self):
+            self.disposed = True
+
+    cache = ResourceCache()
+    resource = cache.get("resource", Resource)
+    assert cache.get("resource", Resource) is resource
+
+    cache.invalidate()
+    assert resource.disposed
+    rebuilt = cache.get("resource", Resource)
+    assert rebuilt is not resource
+
+    assert cache.get("resource", Resource, check=lambda r: not r.disposed) is rebuilt
+    assert cache.get("resource", Resource, check=lambda r: False) is not rebuilt
+    assert rebuilt.disposed
+
+
+def test_db_realms(sample_df: pd.DataFrame) -> None:
+    """
+    Stores the same dates for two realms, then updates one realm, and confirms the other is left untouched.
+    """
+    db = SQLiteDB()
+    realms_df = pd.concat([sample_df.assign(realm="co"), sample_df.assign(realm="wa")], ignore_index=True)
+    result = encv_to_db.push_to_db(db, realms_df)
+    assert (result.inserted, result.updated) == (2 * len(sample_df), 0)
+    result = encv_to_db.push_to_db(db, sample_df.assign(realm="co", codes_claimed=827))
+    assert (result.inserted, result.updated) == (0, len(sample_df))
+    stored = {(stat.realm, stat.codes_claimed) for stat in db.session.query(ENCVStat)}
+    assert stored == {("co", 827)} | {("wa", codes_claimed) for codes_claimed in sample_df.codes_claimed}
+
+
+def test_columnar_stats(sample_df: pd.DataFrame, tmp_path) -> None:
+    """
+    Writes stats as Parquet, reads them back as typed ENCVStat columns, and stores them without re-parsing.
+    """
+    pytest.importorskip("pyarrow")
+    from interchange import read_table, to_frame, to_table, write_table
+
+    path = str(tmp_path / "stats.parquet")
+    write_table(to_table(sample_df.assign(realm="co"), encv_to_db.STAT_COLUMNS), path)
+    stats_df = to_frame(read_table(path, encv_to_db.STAT_COLUMNS))
+    assert stats_df.dtypes.equals(sample_df.assign(realm="co")[list(encv_to_db.STAT_COLUMNS)].dtypes)
+    db = SQLiteDB()
+    result = encv_to_db.push_to_db(db, stats_df)
+    assert (result.inserted, result.updated) == (len(sample_df), 0)
+    with pytest.raises(ValueError, match="Missing columns"):
+        to_table(sample_df, encv_to_db.STAT_COLUMNS)
+
+
+def test_partitioned_table_ddl() -> None:
+    """
+    Confirms that BigQuery tables are created partitioned by date and clustered by realm
+    """
+    element = CreateTable(ENCVStat.__table__)
+    compiler = sqlite.dialect().ddl_compiler(sqlite.dialect(), element)
+    ddl = encv_to_db.create_partitioned_table(element, compiler)
+    assert ddl.endswith("PARTITION BY DATE(date)\nCLUSTER BY realm")
+
+
+def test_handler_metrics(statistics, monkeypatch) -> None:
+    """
+    Runs the handler twice over the same payload, and confirms each run emits its own rows in / out counts.
+    """
+    lines = []
+    monkeypatch.setattr(metrics, "emit", lines.append)
+    db = SQLiteDB()
+    monkeypatch.setattr(encv_to_db, "create_db", lambda: db)
+    encv_to_db.cache.invalidate()
+    try:
+        encv_to_db.lambda_handler(statistics, None)
+        encv_to_db.lambda_handler(statistics, None)
+    finally:
+        encv_to_db.cache.invalidate()
+    (first, second) = [json.loads(line) for line in lines]
+    assert first["function"] == "encv_to_db"
+    assert (first["rows_in"], first["aphl_codes_rows_inserted"], first["aphl_codes_rows_updated"]) == (2, 2, 0)
+    assert (second["aphl_codes_rows_inserted"], second["aphl_codes_rows_unchanged"]) == (0, 2)
+    assert second["aphl_code_claim_age_histogram_rows_unchanged"] == 8
+    assert first["upsert_calls"] == 2  # Stats and claim age histograms
+
+
+def test_payload_log(statistics, caplog, monkeypatch) -> None:
+    """
+    Logs a large payload and a credential, and confirms they are only summarized when the level is enabled (and then
+    once, however many handlers format the record), cut down, and redacted.
+    """
+    payload = statistics * 100
+    summaries = []
+    monkeypatch.setattr(payload_log, "summarize", lambda value, *args, **kwargs: summaries.append(
+        value is payload) or summarize(value, *args, **kwargs))
+    caplog.set_level(logging.INFO)
+    logging.getLogger().debug("Payload: %s", Payload(payload))
+    assert not summaries and not caplog.records
+    logging.getLogger().info("Payload: %s", Payload(payload, max_items=2))
+    assert summaries.count(True) == 1
+    assert caplog.records[0].getMessage().endswith("'... 198 more']")
+
+    credentials_info = {"type": "service_account", "private_key_id": "abc", "private_key": "-----BEGIN",
+                        "client_email": "sa@example.com"}
+    assert summarize(credentials_info) == {"type": "service_account", "private_key_id": REDACTED,
+                                           "private_key": REDACTED, "client_email": "sa@example.com"}
+    # Stats whose names merely contain "token" are left alone
+    assert summarize(statistics[0])["data"]["tokens_claimed"] == 4
+    assert summarize(statistics_to_df(statistics)) == "<DataFrame (2, 8)>"
+
+
+def test_db_read(sample_df: pd.DataFrame) -> None:
+    """
+    Reads stored stats back as typed columns, whole, by date range, projected and in chunks, and counts them.
+    """
+    db = SQLiteDB()
+    encv_to_db.push_to_db(db, sample_df)
+    result_df = db.read(ENCVStat)
+    assert "_sa_instance_state" not in result_df.columns
+    assert str(result_df.date.dtype) == "datetime64[ns, UTC]"
+    assert result_df[sample_df.columns].equals(sample_df)
+
+    (start, end) = (sample_df.date[1], sample_df.date[3])
+    ranged_df = db.read(ENCVStat, start=start, end=end, columns=["date", "codes_issued"])
+    assert list(ranged_df.columns) == ["date", "codes_issued"]
+    assert ranged_df.equals(sample_df.loc[1:3, ["date", "codes_issued"]].reset_index(drop=True))
+
+    chunks = list(db.read(ENCVStat, chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert pd.concat(chunks, ignore_index=True).equals(result_df)
+    assert db.row_count(ENCVStat) == len(sample_df)
+
+
+def test_schema_bootstrap(sample_df: pd.DataFrame) -> None:
+    """
+    Creates the tables on the first write only, then migrates a table created before a model gained a column.
+    """
+    db = SQLiteDB()
+    statements = []
+    event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    encv_to_db.push_to_db(db, sample_df)
+    assert any(statement.strip().startswith("CREATE TABLE") for statement in statements)
+    statements.clear()
+    db.create_tables()
+    assert statements == []  # Steady state: no DDL and no introspection
+
+    # Nullable columns a model gains are simply added
+    old_metadata = MetaData()
+    SQLTable("notes", old_metadata, Column("id", Integer, primary_key=True))
+    new_metadata = MetaData()
+    SQLTable("notes", new_metadata, Column("id", Integer, primary_key=True), Column("note", String, nullable=True))
+    engine = create_engine("sqlite://")
+    old_metadata.create_all(engine)
+    manager = SchemaManager(engine, new_metadata)
+    assert manager.ensure() == ["added notes.note"]
+    assert "note" in {column["name"] for column in inspect(engine).get_columns("notes")}
+    assert manager.ensure() == []
+
+
+def test_schema_migrates_legacy_table(sample_df: pd.DataFrame) -> None:
+    """
+    Starts from a legacy aphl_codes table keyed by date alone, with no realm column, and confirms the migration
+    rebuilds it with realm (backfilled with its default) in the key, so upserts keep working.
+    """
+    db = SQLiteDB()
+    legacy_metadata = MetaData()
+    SQLTable("aphl_codes", legacy_metadata, *[
+        Column(column.name, column.type, primary_key=column.name == "date", nullable=False)
+        for column in ENCVStat.__table__.columns if column.name != "realm"])
+    legacy_metadata.create_all(db.engine)
+    db.engine.execute(legacy_metadata.tables["aphl_codes"].insert(),
+                      sample_df.drop(columns=["realm"], errors="ignore").to_dict("records"))
+
+    assert db.schema_manager.ensure() == ["created aphl_code_claim_age_histogram", "added aphl_codes.realm"]
+    assert inspect(db.engine).get_pk_constraint("aphl_codes")["constrained_columns"] == ["date", "realm"]
+    assert db.row_count(ENCVStat) == len(sample_df)
+    assert set(db.read(ENCVStat).realm) == {"default"}
+
+    sample_df.loc[0, "codes_claimed"] = 827
+    result = encv_to_db.push_to_db(db, sample_df)
+    assert (result.success, result.inserted, result.updated) == (True, 0, 1)
+    assert db.read(ENCVStat)[sample_df.columns].equals(sample_df)
+
+
+def test_schema_refuses_unsafe_migration() -> None:
+    """
+    A NOT NULL column without a default can't be added to existing rows, so the migration stops with a clear error
+    and leaves the table alone.
+    """
+    old_metadata = MetaData()
+    SQLTable("aphl_codes", old_metadata, *[Column(column.name, column.type, primary_key=column.primary_key)
+                                           for column in ENCVStat.__table__.columns if column.name != "tokens_invalid"])
+    engine = create_engine("sqlite://")
+    old_metadata.create_all(engine)
+    manager = SchemaManager(engine, ENCVStat.metadata)
+    with pytest.raises(ValueError, match="tokens_invalid"):
+        manager.ensure()
+    assert "tokens_invalid" not in {column["name"] for column in inspect(engine).get_columns("aphl_codes")}
+    assert "aphl_codes" in inspect(engine).get_table_names()
@@ -2,7 +2,8 @@
 
 """
 This script accepts JSON-formatted data (the output of db_to_json.py), and inputs this data to a specified Google Sheets
-spreadsheet, taking the newest date since last update.
+spreadsheet, taking the newest date since last update. It also accepts typed stats as a .parquet or .arrow file given
+with --data, or a Parquet claim check, as written by db_to_json (see interchange.py).
 
 TODO: Integrate with Kinesis or other data stream to do data diff for us, focus only on updated records
 
@@ -15,47 +16,123 @@ import logging
 import os.path
 import sys
 import argparse
-from pprint import pformat
-from typing import Dict, List, Tuple, cast
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union, cast
 
 import pandas as pd
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.auth.exceptions import RefreshError
+
+from claim_check import check_out
+from interchange import columnar_format, conform, read_table, to_frame
+from metrics import metrics
+from payload_log import Payload
+from resources import cache
+from sheets_writer import Block, ColumnMap, Grid, SheetsBatchWriter, range_start
+
+if TYPE_CHECKING:
+    from google.oauth2 import service_account  # Only imported to load credentials (see load_credentials)
 
 logger = logging.getLogger()
 logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO"))
 
+# Developer metadata key (suffixed with the sheet name) under which the last written row is recorded
+LATEST_ROW_MARKER_KEY = "encv_latest_row"
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+# A static copy of the Sheets v4 discovery document (the one shipped with google-api-python-client 2.0.2, as locked in
+# poetry.lock, which the tests check), so building the service needs no discovery fetch. Set SHEETS_DISCOVERY_DOCUMENT
+# to use another copy, or to "" to fetch the live one instead.
+SHEETS_DISCOVERY_DOCUMENT = os.environ.get(
+    "SHEETS_DISCOVERY_DOCUMENT", str(Path(__file__).parent / "discovery" / "sheets.v4.json"))
+credentials_lock = threading.Lock()
+
+# Where each ENCV stat goes in the sheet. Column A (row ID) and E:G (app install metrics) are filled in separately.
+DEFAULT_SHEET_COLUMN_MAP = {"date": "B", "codes_issued": "C", "codes_claimed": "D"}
+# Every ENCVStat metric db_to_json exports, placing the ones beyond the defaults after the separately filled columns
+ALL_STATS_SHEET_COLUMN_MAP = {
+    **DEFAULT_SHEET_COLUMN_MAP,
+    "codes_invalid": "H",
+    "code_claim_mean_age_seconds": "I",
+    "tokens_claimed": "J",
+    "tokens_invalid": "K",
+}
+# SHEET_COLUMN_MAP may be set to a JSON object of field to column letter, to write any other subset of stats
+SHEET_COLUMN_MAP = ColumnMap.compile(
+    json.loads(os.environ["SHEET_COLUMN_MAP"]) if os.environ.get("SHEET_COLUMN_MAP") else DEFAULT_SHEET_COLUMN_MAP)
+# The types of the fields written to the sheet, to validate columnar input against
+SHEET_COLUMNS = {field: datetime.datetime if field == "date" else int for field in SHEET_COLUMN_MAP.fields}
+
+
+def load_credentials() -> "service_account.Credentials":
+    """
+    Reads the service account credentials. Their token is fetched on first use (see fresh_credentials).
+    """
+    from google.oauth2 import service_account
+    logger.info("Loading credentials...")
+    # See https://developers.google.com/identity/protocols/oauth2/service-account#python
+    return service_account.Credentials.from_service_account_file("service.json", scopes=SCOPES)
+
+
+def fresh_credentials() -> "service_account.Credentials":
+    """
+    Returns the credentials cached for this process, refreshing their token only if there isn't one yet or it is
+    about to expire (google-auth counts a token as invalid shortly before its expiry)
+    """
+    credentials = cache.get("sheets_credentials", load_credentials)
+    with credentials_lock:
+        if not credentials.valid:
+            from google.auth.transport.requests import Request  # Pulls in requests, so only imported to refresh
+            logger.info("Credentials missing a token or expiring - refreshing...")
+            credentials.refresh(Request())
+            logger.debug(f"Refreshed credentials, valid until {credentials.expiry}")
+    return credentials
+
+
+def build_sheets_service():
+    """
+    Builds a Sheets service from the static discovery document if there is one, otherwise from the live one. The
+    service refreshes the shared credentials itself before any request made once their token has expired.
+    """
+    from googleapiclient.discovery import build, build_from_document
+    credentials = fresh_credentials()
+    if SHEETS_DISCOVERY_DOCUMENT and os.path.exists(SHEETS_DISCOVERY_DOCUMENT):
+        logger.info(f"Building Sheets service from {SHEETS_DISCOVERY_DOCUMENT}...")
+        with open(SHEETS_DISCOVERY_DOCUMENT, "r") as infile:
+            return build_from_document(infile.read(), credentials=credentials)
+    logger.info("Building Sheets service from the discovery service...")
+    return build("sheets", "v4", credentials=credentials, cache_discovery=False)
+
 
 class GoogleSheetsAPIHelper:
-    def __init__(self, spreadsheet_id: str = "", sheet_id: str = ""):
-        self.credentials = self.init_creds()
-        self.service = build(
-            "sheets", "v4", credentials=self.credentials, cache_discovery=False)
+    def __init__(self, spreadsheet_id: str = "", sheet_id: str = "", service=None,
+                 column_map: ColumnMap = SHEET_COLUMN_MAP):
+        """
+        service : [optional] an already built Sheets service (e.g. a fake, in tests), used instead of building one
+        column_map : [optional] where write_encv_values puts each stat, if not SHEET_COLUMN_MAP
+        """
+        if service is None:
+            # Both are cached for the life of the process, so only a cold start reads, refreshes and builds them
+            self.credentials = self.init_creds()
+            service = cache.get("sheets_service", build_sheets_service)
+        self.service = service
+        self.writer = SheetsBatchWriter(self.service)
+        self.column_map = column_map
         self.spreadsheet_id = spreadsheet_id
         self.sheet_id = sheet_id
         self._latest_sheet_row_and_date = None
+        self._latest_row_marker_exists = None  # Not known until read_latest_row_marker has looked
+        self.grid = None  # Read along with the marker, so that appends can be written together with it
+        self.tail_window_rows = 200  # Rows of the date column read per request when probing for the last row
         self.source_date_format = '%Y-%m-%d %H:%M:%S'
         self.destination_date_format = '%Y-%m-%d %H:%M %p'
 
     def init_creds(self):
         """
-        Initialize credentials, checking for a pickled version
+        Initialize credentials, reusing this process's unless their token has expired
         """
-        logger.info("Initializing credentials...")
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets"]
-        # See https://developers.google.com/identity/protocols/oauth2/service-account#python
-        creds = service_account.Credentials.from_service_account_file(
-            "service.json", scopes=scopes
-        )
-        if not creds.valid:
-            logger.info("Credentials invalid - refreshing...")
-            creds.refresh(Request())
-        logger.debug(
-            f"Credentials response: {creds.__dict__} . Is valid?: {creds.valid}")
-        return creds
+        return fresh_credentials()
 
+    @metrics.timer("sheets_read")
     def read(self, cell_range: str) -> List[List[object]]:
         """
         Read data from the selected sheet at the given range
@@ -70,7 +147,7 @@ class GoogleSheetsAPIHelper:
             .get(spreadsheetId=self.spreadsheet_id, range=range_name)
             .execute()
         )
-        logger.debug(f"Read result: {result}")
+        logger.debug("Read result: %s", Payload(result))
         values = result.get("values", [])
         return values
 
@@ -81,14 +158,75 @@ class GoogleSheetsAPIHelper:
         e.g for 'Sheet1!A2:E2', "A2:E2"
         :param values: list of lists of values to insert
         """
-        range_name = f"{self.sheet_id}!{cell_range}"
-        logger.debug(f"Writing values {values} to range {range_name}...")
-        body = {"values": values}
-        result = self.service.spreadsheets().values().update(spreadsheetId=self.spreadsheet_id,
-                                                             range=range_name,
-                                                             valueInputOption="RAW",
-                                                             body=body).execute()
-        logger.debug(f"Write result: {result}")
+        logger.debug("Writing values %s to range %s!%s...", Payload(values), self.sheet_id, cell_range)
+        (start_row, start_column) = range_start(cell_range)
+        result = self.writer.write_blocks(self.spreadsheet_id, [
+            Block(sheet_id=self.sheet_id, start_row=start_row, start_column=start_column, rows=values)])
+        logger.debug("Write result: %s", result)
+
+    @property
+    def latest_row_marker_key(self) -> str:
+        return f"{LATEST_ROW_MARKER_KEY}:{self.sheet_id}"
+
+    def read_latest_row_marker(self) -> Optional[int]:
+        """
+        Returns the last row recorded by the developer metadata marker written on each append, if there is one. The
+        sheet's grid is read in the same request.
+        """
+        result = self.writer.send(lambda: self.service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id, ranges=[self.sheet_id],
+            fields="developerMetadata(metadataKey,metadataValue),sheets.properties(sheetId,gridProperties.rowCount)"))
+        properties = result["sheets"][0]["properties"]
+        # Like any default value, a sheetId of 0 (the first sheet's) is left out of the response
+        self.grid = Grid(grid_id=properties.get("sheetId", 0), row_count=properties["gridProperties"]["rowCount"])
+        matches = [metadata for metadata in result.get("developerMetadata", [])
+                   if metadata["metadataKey"] == self.latest_row_marker_key]
+        self._latest_row_marker_exists = bool(matches)
+        if not matches:
+            return None
+        return int(matches[0]["metadataValue"])
+
+    def latest_row_marker_request(self, latest_row: int) -> Dict[str, object]:
+        """
+        The spreadsheets.batchUpdate request that records latest_row in the marker, creating it if it doesn't exist
+        (only looked up if read_latest_row_marker hasn't already)
+        """
+        if self._latest_row_marker_exists is None:
+            self.read_latest_row_marker()
+        marker = {"metadataKey": self.latest_row_marker_key, "metadataValue": str(latest_row)}
+        if not self._latest_row_marker_exists:
+            return {"createDeveloperMetadata": {
+                "developerMetadata": {**marker, "location": {"spreadsheet": True}, "visibility": "DOCUMENT"}}}
+        return {"updateDeveloperMetadata": {
+            "dataFilters": [{"developerMetadataLookup": {"metadataKey": self.latest_row_marker_key}}],
+            "developerMetadata": marker,
+            "fields": "metadataValue"}}
+
+    def write_latest_row_marker(self, latest_row: int, latest_date: datetime.datetime):
+        """
+        Records the last row in a developer metadata marker, so the next run can find it without reading the column,
+        and updates the cached row and date to match. Appends made by write_encv_values record it as they write.
+        """
+        self.writer.update_spreadsheet(self.spreadsheet_id, [self.latest_row_marker_request(latest_row)])
+        self._latest_row_marker_exists = True
+        self._latest_sheet_row_and_date = (latest_row, latest_date)
+
+    def probe_latest_row(self) -> Tuple[int, List[List[object]]]:
+        """
+        Finds the last non-empty row of the date column by reading windows of it backwards from the end of the grid,
+        returning the row and the values read from it (or 0 and [] for an empty sheet)
+        """
+        if self.grid is None:
+            self.read_latest_row_marker()
+        end = self.grid.row_count
+        while end > 0:
+            start = max(1, end - self.tail_window_rows + 1)
+            window = self.read(f"B{start}:B{end}")
+            # Trailing empty rows are left out of the response, so its last row is the last non-empty one
+            if window:
+                return (start + len(window) - 1, window[-1:])
+            end = start - 1
+        return (0, [])
 
     @property
     def latest_sheet_row_and_date(self) -> Tuple[int, datetime.datetime]:
@@ -97,98 +235,85 @@ class GoogleSheetsAPIHelper:
         """
         logger.debug("Getting latest sheet row and date...")
         if not self._latest_sheet_row_and_date:
-            all_date_rows = self.read("B:B")
-            if len(all_date_rows) == 0:
-                self._latest_sheet_row_and_date = latest_date = datetime.datetime(
-                    1, 1, 1)
-            else:
-                latest_date = all_date_rows[-1][0]
-                self._latest_sheet_row_and_date = datetime.datetime.strptime(
-                    latest_date, self.destination_date_format)
-        # Note, while we would ordinarily subtract 1, rows are not 0-indexed, so we can use len here
-        latest_row = len(all_date_rows)
-        latest_date = self._latest_sheet_row_and_date
+            latest_row = self.read_latest_row_marker()
+            values = []
+            if latest_row is not None:
+                # The marker is only trusted if its row is the last one, i.e. nobody has appended rows by hand since
+                values = self.read(f"B{latest_row}:B{latest_row + 1}") if latest_row > 0 else []
+                if len(values) > 1 or (latest_row > 0 and not values):
+                    logger.info(f"Latest row marker ({latest_row}) is stale")
+                    latest_row = None
+            if latest_row is None:
+                with metrics.timer("sheets_probe"):
+                    (latest_row, values) = self.probe_latest_row()
+            latest_date = datetime.datetime(1, 1, 1)
+            if values and values[0]:
+                try:
+                    latest_date = datetime.datetime.strptime(values[0][0], self.destination_date_format)
+                except ValueError:
+                    logger.debug("Row %s has no date (is it the header?): %s", latest_row, Payload(values[0]))
+            self._latest_sheet_row_and_date = (latest_row, latest_date)
+        (latest_row, latest_date) = self._latest_sheet_row_and_date
         logger.debug(f"Latest row: {latest_row}, latest date: {latest_date}")
         return (latest_row, latest_date)
 
     def write_encv_values(self, cell_range: str, encv_data: pd.DataFrame):
         """
-        Write new values to the sheet, beginning with the newest data
+        Write the values dated after the sheet's latest date, appending them oldest first
         """
-        # Data is retrieved in reverse chronological order
+        if encv_data.empty:
+            # e.g. an incremental export with nothing new, which has no columns either
+            logger.info("No values to write")
+            return True
         (latest_sheet_row, latest_sheet_date) = self.latest_sheet_row_and_date
 
-        # We start with the assumption that we should use none of the new data
-        first_new_date_index = len(encv_data)
-        encv_data["date"] = encv_data["date"].map(
-            lambda d: datetime.datetime.strptime(d, self.source_date_format))
-
-        for i, data_point in encv_data.iterrows():
-            curr_date = data_point["date"]
-            if curr_date > latest_sheet_date:
-                logger.debug(f"first new data point: {curr_date}")
-                first_new_date_index = i
-                break
-
-        remaining_data = encv_data[first_new_date_index:]
-
-        codes_issued_col = "C"
-        codes_issued_values = [
-            None, None, remaining_data["codes_issued"].tolist(), None, None, None, None]
-        codes_claimed_col = "D"
-        codes_claimed_values = [None, None, None,
-                                remaining_data["codes_claimed"].tolist(), None, None, None]
-        date_col = "B"
-        date_values = [
-            remaining_data["date"].map(lambda d: datetime.datetime.strftime(d, self.destination_date_format)).tolist(
-            ), None, None, None, None, None, None
-        ]
-        '''
-        This API expects us to send rows as an array of arrays, one array for each row. If you specify "COLUMNS" for the
-        "majorDimension", however, you can instead refer to the values for the specified column instead, which makes it
-        easier to do a bulk insert that only touches the specified columns.
-        '''
-        data = [
-            {
-                "range": f"{self.sheet_id}!{codes_issued_col}{latest_sheet_row+1}:{codes_issued_col}",
-                "values": codes_issued_values,
-                "majorDimension": "COLUMNS"
-            },
-            {
-                "range": f"{self.sheet_id}!{codes_claimed_col}{latest_sheet_row+1}:{codes_claimed_col}",
-                "values": codes_claimed_values,
-                "majorDimension": "COLUMNS"
-            },
-            {
-                "range": f"{self.sheet_id}!{date_col}{latest_sheet_row+1}:{date_col}",
-                "values": date_values,
-                "majorDimension": "COLUMNS"
-            }
-        ]
-        body = {"valueInputOption": "RAW",
-                "data": data}
-        logger.debug(f"BODY: {body}")
-        response = self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheet_id,
-                                                                    body=body).execute()
-        logger.debug("Cell update response: " + pformat(response))
-        num_updated_cells = response.get("totalUpdatedCells")
-        logger.info(f"{num_updated_cells} cells updated")
-        if len(response.get("responses")) > 0:
-            success = True
+        dates = encv_data["date"]
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, format=self.source_date_format)
+        elif dates.dt.tz is not None:
+            # Typed columns are in UTC, while the dates in the sheet are naive
+            dates = dates.dt.tz_localize(None)
+        # Data may arrive in any order (e.g. reverse chronological), but rows are appended oldest first
+        encv_data = encv_data.assign(date=dates).sort_values("date", kind="mergesort", ignore_index=True)
+
+        if latest_sheet_date < pd.Timestamp.min:
+            # An empty sheet's latest date predates anything pandas can represent, so all of the data is new
+            first_new_date_index = 0
         else:
-            success = False
+            first_new_date_index = encv_data["date"].searchsorted(pd.Timestamp(latest_sheet_date), side="right")
+        remaining_data = encv_data.iloc[first_new_date_index:]
+        logger.debug(f"{len(remaining_data)} of {len(encv_data)} data points are new")
+
+        if len(remaining_data) == 0:
+            logger.info("No new values to write")
+            return True
+        metrics.add("rows_out", len(remaining_data))
+        sheet_data = remaining_data.assign(date=remaining_data["date"].dt.strftime(self.destination_date_format))
+        latest_row = latest_sheet_row + len(remaining_data)
+        marker_request = self.latest_row_marker_request(latest_row)
+        # The marker is updated in the same request as the last of the values, or after them if the grid isn't known
+        result = self.writer.write_frame(self.spreadsheet_id, self.sheet_id, latest_sheet_row + 1, sheet_data,
+                                         self.column_map, grid=self.grid, requests=[marker_request])
+        success = result.responses > 0
+        if success:
+            self._latest_row_marker_exists = True
+            self._latest_sheet_row_and_date = (latest_row, remaining_data["date"].max())
         return success
 
 
-def populate_sheet(spreadsheet_id: str, sheet_id: str, data: List[Dict[str, object]]) -> bool:
+def populate_sheet(spreadsheet_id: str, sheet_id: str, data: Union[List[Dict[str, object]], pd.DataFrame]) -> bool:
     """
-    Takes input JSON and writes to the specified sheet
+    Takes input JSON (or an already typed DataFrame) and writes to the specified sheet
     """
+    if len(data) == 0:
+        # Nothing new was exported, so there is no need to load credentials or touch the sheet
+        logger.info("No stats to write")
+        return True
     logger.info("Initializing sheet...")
     service = GoogleSheetsAPIHelper(
         spreadsheet_id=spreadsheet_id, sheet_id=sheet_id)
     logger.info("Initialized service. Serializing data...")
-    df = pd.DataFrame.from_dict(data)
+    df = data if isinstance(data, pd.DataFrame) else pd.DataFrame.from_dict(data)
     logger.info("Writing values...")
     success = service.write_encv_values("A:G", df)
     return success
@@ -207,19 +332,30 @@ def parse_arguments():
                            action='store',
                            default=sys.stdin,
                            type=str,
-                           dest='data')
+                           dest='data',
+                           help="stats as JSON, or as a .parquet or .arrow file written by db_to_json")
 
     return my_parser.parse_args()
 
 
+@metrics.invocation("json_to_sheets")
 def lambda_handler(event, context):
-    logger.info(f"Incoming event: {event}")
-    data = event.get("body").get("data")
-    success = populate_sheet(
-        spreadsheet_id="",
-        sheet_id="Source Data",
-        data=data
-    )
+    logger.info("Incoming event: %s", Payload(event))
+    data = check_out(event.get("body").get("data"))
+    if not isinstance(data, list):
+        # A Parquet claim check, checked out as an Arrow table
+        data = to_frame(conform(data, SHEET_COLUMNS))
+    metrics.add("rows_in", len(data))
+    try:
+        success = populate_sheet(
+            spreadsheet_id="",
+            sheet_id="Source Data",
+            data=data
+        )
+    except RefreshError:
+        # Most likely a rotated service account key, so reload the credentials and rebuild the service next time
+        cache.invalidate()
+        raise
     return {
         "statusCode": 200,
         "body": {
@@ -228,10 +364,14 @@ def lambda_handler(event, context):
     }
 
 def main():
-    sample_data = {"statusCode": 200, "body": {"data": [{"id": 1, "date": "2021-01-22 00:00:00", "codes_claimed": 111, "codes_issued": 222}, {
-        "id": 2, "date": "2020-01-23 00:00:00", "codes_claimed": 333, "codes_issued": 444}]}}
+    sample_data = {"statusCode": 200, "body": {"data": [{"date": "2021-01-22 00:00:00", "codes_claimed": 111, "codes_issued": 222}, {
+        "date": "2020-01-23 00:00:00", "codes_claimed": 333, "codes_issued": 444}]}}
     args = parse_arguments()
-    logger.info(f"Arguments: {args}")
+    logger.info("Arguments: %s", args)
+    if isinstance(args.data, str) and columnar_format(args.data):
+        data = to_frame(read_table(args.data, SHEET_COLUMNS))
+        print(populate_sheet(spreadsheet_id=args.spreadsheet_id, sheet_id="Source Data", data=data))
+        return
     args.data = sample_data
     print(lambda_handler(sample_data, None))
 
@@ -0,0 +1,100 @@
+import gzip
+import io
+import json
+import logging
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from metrics import BYTES, metrics
+
+logger = logging.getLogger()
+
+# Payloads that have been offloaded are replaced by {CLAIM_CHECK_KEY: {"uri": ..., "count": ..., "format": ...}}
+CLAIM_CHECK_KEY = "claim_check"
+NDJSON_FORMAT = "ndjson.gz"
+PARQUET_FORMAT = "parquet"
+
+
+@lru_cache(maxsize=None)
+def s3_client():
+    import boto3  # Only needed when offloading to S3; the lambda runtime always provides it
+    return boto3.client("s3")
+
+
+@metrics.timer("claim_check_write")
+def write_blob(uri: str, body: bytes):
+    metrics.add("claim_check_bytes_written", len(body), BYTES)
+    parsed = urlparse(uri)
+    if parsed.scheme == "s3":
+        s3_client().put_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"), Body=body)
+    else:
+        path = Path(uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body)
+
+
+@metrics.timer("claim_check_read")
+def read_blob(uri: str) -> bytes:
+    parsed = urlparse(uri)
+    if parsed.scheme == "s3":
+        body = s3_client().get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))["Body"].read()
+    else:
+        body = Path(uri).read_bytes()
+    metrics.add("claim_check_bytes_read", len(body), BYTES)
+    return body
+
+
+def to_ndjson(records: List[Dict[str, object]]) -> bytes:
+    return "".join(json.dumps(record, default=str) + "\n" for record in records).encode()
+
+
+def check_in(records: List[Dict[str, object]], location: str, body: bytes = None,
+             blob_format: str = NDJSON_FORMAT) -> Dict[str, object]:
+    """
+    Writes records to a new object under location (an s3://bucket/prefix URL, or a local directory), returning a
+    reference to it that is small enough to pass between Step Functions states. By default records are stored as
+    gzipped NDJSON; otherwise body must hold them already encoded in blob_format.
+    """
+    uri = f"{location.rstrip('/')}/{uuid.uuid4().hex}.{blob_format}"
+    if blob_format == NDJSON_FORMAT:
+        body = gzip.compress(body if body is not None else to_ndjson(records))
+    logger.info(f"Checking {len(records)} records ({len(body)} bytes) in to {uri}...")
+    write_blob(uri, body)
+    return {CLAIM_CHECK_KEY: {"uri": uri, "count": len(records), "format": blob_format}}
+
+
+def check_out(payload: object) -> object:
+    """
+    Returns the records a claim check refers to, or the payload itself if it isn't a claim check. Parquet claim checks
+    are returned as a pyarrow Table, for the caller to validate and convert (see interchange.py).
+    """
+    if not (isinstance(payload, dict) and CLAIM_CHECK_KEY in payload):
+        return payload
+    uri = payload[CLAIM_CHECK_KEY]["uri"]
+    logger.info(f"Checking out records from {uri}...")
+    if payload[CLAIM_CHECK_KEY].get("format") == PARQUET_FORMAT:
+        import pyarrow.parquet as pq  # Optional; only needed by stages that produce Parquet
+        return pq.read_table(io.BytesIO(read_blob(uri)))
+    body = gzip.decompress(read_blob(uri))
+    return [json.loads(line) for line in body.splitlines() if line]
+
+
+def offload_if_large(records: List[Dict[str, object]], location: Optional[str], threshold_bytes: int,
+                     encode: Optional[Callable[[List[Dict[str, object]]], bytes]] = None,
+                     blob_format: str = NDJSON_FORMAT) -> object:
+    """
+    Returns records unchanged, unless a location is configured and their serialized size exceeds threshold_bytes,
+    in which case they are checked in there (encoded by encode as blob_format, if given) and a claim check is
+    returned instead
+    """
+    if not location:
+        return records
+    body = to_ndjson(records)
+    if len(body) <= threshold_bytes:
+        return records
+    if encode is not None:
+        return check_in(records, location, body=encode(records), blob_format=blob_format)
+    return check_in(records, location, body=body)
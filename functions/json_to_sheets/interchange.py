@@ -0,0 +1,129 @@
+"""
+Arrow-based interchange format for ENCV stats, as an alternative to passing lists of dicts between stages.
+
+Tables are validated against a typed column mapping (see model_columns) and written as Parquet or Arrow IPC files,
+chosen by file suffix. pyarrow is an optional dependency, only imported once a columnar file is actually used.
+"""
+import datetime
+import io
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+PARQUET_FORMAT = "parquet"
+ARROW_FORMAT = "arrow"
+COLUMNAR_FORMATS = (PARQUET_FORMAT, ARROW_FORMAT)
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError("The Parquet/Arrow interchange format requires pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+
+def model_columns(model) -> Dict[str, type]:
+    """
+    Maps each column of a declarative model to its Python type, e.g. {"date": datetime.datetime, "codes_claimed": int}
+    """
+    return {column.name: column.type.python_type for column in model.__table__.columns}
+
+
+def arrow_schema(columns: Dict[str, type]):
+    pa = require_pyarrow()
+    arrow_types = {
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        datetime.datetime: pa.timestamp("ns", tz="UTC"),
+    }
+    return pa.schema([pa.field(name, arrow_types[python_type]) for name, python_type in columns.items()])
+
+
+def columnar_format(path: Union[str, Path]) -> Optional[str]:
+    """
+    Returns the columnar format implied by a file's suffix, or None for anything else (e.g. JSON)
+    """
+    suffix = Path(str(path)).suffix.lstrip(".")
+    return suffix if suffix in COLUMNAR_FORMATS else None
+
+
+def conform(table, columns: Dict[str, type]):
+    """
+    Projects table onto columns and casts it to their types, raising a ValueError if any are missing or can't be cast
+    """
+    pa = require_pyarrow()
+    missing = [name for name in columns if name not in table.column_names]
+    if missing:
+        raise ValueError(f"Missing columns {missing}")
+    schema = arrow_schema(columns)
+    arrays = []
+    for field in schema:
+        column = table.column(field.name)
+        try:
+            if pa.types.is_timestamp(field.type) and pa.types.is_string(column.type):
+                # Dates serialized without an offset (e.g. by str(datetime)) are naive UTC
+                column = column.cast(pa.timestamp(field.type.unit))
+            arrays.append(column.cast(field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f"Column {field.name} ({column.type}) does not match {field.type}: {e}") from e
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_table(data, columns: Dict[str, type]):
+    """
+    Builds a validated table from a list of records or a pandas DataFrame
+    """
+    pa = require_pyarrow()
+    if isinstance(data, list):
+        table = pa.Table.from_pylist(data)
+    else:
+        table = pa.Table.from_pandas(data, preserve_index=False)
+    return conform(table, columns)
+
+
+def to_frame(table):
+    """
+    Converts a table to a pandas DataFrame. Blocks aren't consolidated, so null-free numeric columns aren't copied.
+    """
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def write_table(table, destination, table_format: Optional[str] = None):
+    """
+    Writes table to a path or binary file in the given format, or the one implied by the path's suffix
+    """
+    pa = require_pyarrow()
+    table_format = table_format or columnar_format(destination)
+    if table_format == PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+        pq.write_table(table, destination)
+    elif table_format == ARROW_FORMAT:
+        with pa.ipc.new_file(destination, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown columnar format {table_format}; expected one of {COLUMNAR_FORMATS}")
+
+
+def read_table(source, columns: Dict[str, type], table_format: Optional[str] = None):
+    """
+    Reads and validates a table from a path or binary file in the given format, or the one implied by the path's suffix
+    """
+    pa = require_pyarrow()
+    table_format = table_format or columnar_format(source)
+    if table_format == PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+        table = pq.read_table(source)
+    elif table_format == ARROW_FORMAT:
+        if isinstance(source, (str, Path)):
+            source = pa.memory_map(str(source))  # Lets to_frame reference the file's buffers rather than copies
+        table = pa.ipc.open_file(source).read_all()
+    else:
+        raise ValueError(f"Unknown columnar format {table_format}; expected one of {COLUMNAR_FORMATS}")
+    return conform(table, columns)
+
+
+def to_parquet_bytes(records: List[Dict[str, object]], columns: Dict[str, type]) -> bytes:
+    buffer = io.BytesIO()
+    write_table(to_table(records, columns), buffer, PARQUET_FORMAT)
+    return buffer.getvalue()
@@ -0,0 +1,58 @@
+import logging
+import threading
+from typing import Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+
+class ResourceCache:
+    """
+    Keeps expensive resources (engines, sessions, boto3 clients, credentials) alive at module level, so warm Lambda
+    invocations reuse them rather than rebuilding them on every call.
+
+    Resources are built on first use by a factory. An optional health check runs whenever a cached resource is
+    handed out, and anything that fails it is discarded and rebuilt. Resources can also be invalidated explicitly,
+    e.g. when credentials rotate or a write fails.
+    """
+
+    def __init__(self):
+        self._resources: Dict[str, object] = {}
+        self._lock = threading.RLock()
+
+    def get(self, name: str, factory: Callable[[], T], check: Optional[Callable[[T], bool]] = None) -> T:
+        """
+        Returns the cached resource with the given name, building it with factory if it is missing or unhealthy
+        """
+        with self._lock:
+            resource = self._resources.get(name)
+            if resource is not None and check is not None and not check(resource):
+                logger.info(f"Cached {name} failed its health check, rebuilding...")
+                self.invalidate(name)
+                resource = None
+            if resource is None:
+                logger.info(f"No cached {name}, building...")
+                resource = self._resources[name] = factory()
+            return resource
+
+    def invalidate(self, name: Optional[str] = None):
+        """
+        Drops the named resource, or every resource if no name is given, releasing any connections it holds
+        """
+        with self._lock:
+            names = [name] if name else list(self._resources)
+            for resource_name in names:
+                resource = self._resources.pop(resource_name, None)
+                if resource is None:
+                    continue
+                logger.info(f"Invalidating cached {resource_name}...")
+                release = getattr(resource, "dispose", None) or getattr(resource, "close", None)
+                if release is not None:
+                    try:
+                        release()
+                    except Exception as e:
+                        logger.warning(f"Error releasing {resource_name}: {e}")
+
+
+cache = ResourceCache()
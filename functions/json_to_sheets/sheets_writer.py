@@ -0,0 +1,323 @@
+import logging
+import numbers
+import random
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from metrics import MILLISECONDS, metrics
+
+if TYPE_CHECKING:
+    import pandas as pd  # Only imported where a frame is built (see write_columns), to keep it off the cold start
+
+logger = logging.getLogger()
+
+RETRY_STATUSES = frozenset({429, 500, 503})
+
+
+def column_index(letters: str) -> int:
+    """
+    0-based index of a sheet column, e.g. "A" -> 0, "AA" -> 26
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter.upper()) - ord("A") + 1
+    return index - 1
+
+
+def column_letters(index: int) -> str:
+    """
+    Sheet column for a 0-based index, e.g. 0 -> "A", 26 -> "AA"
+    """
+    letters = ""
+    index += 1
+    while index > 0:
+        (index, remainder) = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def range_start(cell_range: str) -> Tuple[int, int]:
+    """
+    The 1-based row and 0-based column at which an A1 range (without a sheet name) begins, e.g. "A:G" -> (1, 0),
+    "C5:D" -> (5, 2)
+    """
+    (letters, row) = re.match(r"([A-Za-z]+)(\d*)", cell_range).groups()
+    return (int(row) if row else 1, column_index(letters))
+
+
+def cell_data(value: object) -> Dict[str, object]:
+    """
+    The CellData that enters value as the RAW value input option would, e.g. 5 -> a numberValue (None leaves the cell
+    empty)
+    """
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, numbers.Number):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+@dataclass
+class Grid:
+    '''
+    The numeric ID and row count of a sheet's grid. Writes made with spreadsheets.batchUpdate need both, since unlike
+    value writes they address the sheet by ID and don't grow the grid themselves.
+    '''
+    grid_id: int
+    row_count: int
+
+
+@dataclass
+class Block:
+    '''
+    A rectangle of values to write, starting at a 1-based row and 0-based column
+    '''
+    sheet_id: str
+    start_row: int
+    start_column: int
+    rows: List[List[object]]
+
+    @property
+    def width(self) -> int:
+        return max((len(row) for row in self.rows), default=0)
+
+    def value_range(self, offset: int, count: int) -> Dict[str, object]:
+        """
+        The ValueRange for count of this block's rows, beginning offset rows in
+        """
+        rows = self.rows[offset:offset + count]
+        first_row = self.start_row + offset
+        cells = (f"{column_letters(self.start_column)}{first_row}:"
+                 f"{column_letters(self.start_column + self.width - 1)}{first_row + len(rows) - 1}")
+        return {"range": f"{self.sheet_id}!{cells}", "values": rows, "majorDimension": "ROWS"}
+
+    def update_cells(self, grid_id: int, offset: int, count: int) -> Dict[str, object]:
+        """
+        The UpdateCellsRequest for count of this block's rows, beginning offset rows in, in the grid with grid_id
+        """
+        rows = self.rows[offset:offset + count]
+        first_row_index = self.start_row + offset - 1
+        return {"updateCells": {
+            "range": {"sheetId": grid_id, "startRowIndex": first_row_index, "endRowIndex": first_row_index + len(rows),
+                      "startColumnIndex": self.start_column, "endColumnIndex": self.start_column + self.width},
+            "rows": [{"values": [cell_data(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue"}}
+
+
+@dataclass(frozen=True)
+class ColumnMap:
+    '''
+    Declarative mapping from DataFrame field to sheet column, compiled once into runs of adjacent columns so that a
+    frame goes out as the fewest contiguous ranges, e.g. {"date": "B", "codes_issued": "C", "tokens_claimed": "H"}
+    becomes a B:C range and an H range
+    '''
+    runs: Tuple[Tuple[int, Tuple[str, ...]], ...]  # (0-based first column, fields in column order)
+
+    @classmethod
+    def compile(cls, columns: Dict[str, str]) -> "ColumnMap":
+        placed = sorted((column_index(letters), name) for name, letters in columns.items())
+        runs = []
+        for (index, name) in placed:
+            if runs and index == runs[-1][0] + len(runs[-1][1]):
+                runs[-1][1].append(name)
+            elif runs and index < runs[-1][0] + len(runs[-1][1]):
+                raise ValueError(f"{name} and {runs[-1][1][-1]} are both mapped to column {column_letters(index)}")
+            else:
+                runs.append((index, [name]))
+        return cls(runs=tuple((index, tuple(fields)) for index, fields in runs))
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for _, fields in self.runs for field in fields]
+
+    def blocks(self, sheet_id: str, start_row: int, df: "pd.DataFrame") -> List[Block]:
+        """
+        The blocks that write each mapped field of df down its column from start_row (missing values are left blank)
+        """
+        missing = [field for field in self.fields if field not in df.columns]
+        if missing:
+            raise ValueError(f"Data has no {missing} fields to write")
+        blocks = []
+        for (start_column, fields) in self.runs:
+            frame = df[list(fields)].astype(object)
+            rows = frame.where(frame.notna(), None).values.tolist()
+            blocks.append(Block(sheet_id=sheet_id, start_row=start_row, start_column=start_column, rows=rows))
+        return blocks
+
+
+@dataclass
+class WriteResult:
+    '''
+    What a SheetsBatchWriter wrote, for throughput reporting
+    '''
+    cells: int = 0
+    requests: int = 0
+    responses: int = 0
+    seconds: float = 0.0
+
+    @property
+    def cells_per_second(self) -> float:
+        return self.cells / self.seconds if self.seconds > 0 else 0.0
+
+
+@dataclass
+class SheetsBatchWriter:
+    '''
+    Writes blocks of values with values.batchUpdate (or spreadsheets.batchUpdate, given the sheet's Grid), splitting
+    them into requests of at most max_cells_per_request cells, pacing requests to stay within writes_per_minute, and
+    retrying rate-limited (429) or unavailable (5xx) responses with exponential backoff. Other Sheets requests (e.g.
+    developer metadata) go through send, so they are paced and retried the same way.
+    '''
+    service: object
+    max_cells_per_request: int = 10000
+    writes_per_minute: int = 60  # The Sheets API's default per-user write quota
+    max_attempts: int = 5
+    backoff_base_seconds: float = 1.0
+    backoff_max_seconds: float = 32.0
+    sleep: Callable[[float], None] = time.sleep
+    clock: Callable[[], float] = time.monotonic
+    request_times: deque = field(default_factory=deque, repr=False)
+
+    def backoff_delay(self, attempt: int, retry_after: str = None) -> float:
+        """
+        Seconds to wait before retrying after the given (1-based) attempt: the server's Retry-After if it sent one,
+        otherwise exponential backoff with full jitter. Either way, capped at backoff_max_seconds.
+        """
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max_seconds)
+        ceiling = min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def wait_for_quota(self):
+        """
+        Sleeps, if need be, until another request would be within writes_per_minute over the last minute
+        """
+        now = self.clock()
+        while self.request_times and now - self.request_times[0] >= 60:
+            self.request_times.popleft()
+        if len(self.request_times) >= self.writes_per_minute:
+            delay = 60 - (now - self.request_times[0])
+            logger.info(f"At the write quota of {self.writes_per_minute}/minute, waiting {delay:.3f}s...")
+            metrics.add("sheets_quota_wait_ms", delay * 1000, MILLISECONDS)
+            self.sleep(delay)
+            self.request_times.popleft()
+        self.request_times.append(self.clock())
+
+    def send(self, build_request: Callable[[], object]) -> Dict[str, object]:
+        """
+        Executes the request returned by build_request (called again for each attempt), within the quota and
+        retrying 429 and 5xx responses up to max_attempts times
+        """
+        from googleapiclient.errors import HttpError  # Deferred along with the rest of the client (see app.py)
+        for attempt in range(1, self.max_attempts + 1):
+            self.wait_for_quota()
+            try:
+                return build_request().execute()
+            except HttpError as err:
+                if err.resp.status not in RETRY_STATUSES or attempt == self.max_attempts:
+                    raise
+                delay = self.backoff_delay(attempt, err.resp.get("retry-after"))
+                logger.warning(f"Sheets request attempt {attempt} failed (HTTP {err.resp.status}), "
+                               f"retrying in {delay:.3f}s...")
+                metrics.add("sheets_retries")
+                self.sleep(delay)
+
+    @metrics.timer("sheets_write")
+    def execute(self, spreadsheet_id: str, body: Dict[str, object]) -> Dict[str, object]:
+        """
+        Sends one values.batchUpdate
+        """
+        return self.send(lambda: self.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id, body=body))
+
+    @metrics.timer("sheets_write")
+    def execute_requests(self, spreadsheet_id: str, requests: List[Dict[str, object]]) -> Dict[str, object]:
+        """
+        Sends one spreadsheets.batchUpdate that writes values, along with any other requests
+        """
+        return self.send(lambda: self.service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={"requests": requests}))
+
+    @metrics.timer("sheets_metadata")
+    def update_spreadsheet(self, spreadsheet_id: str, requests: List[Dict[str, object]]) -> Dict[str, object]:
+        """
+        Sends one spreadsheets.batchUpdate of the given requests, e.g. to create or update developer metadata
+        """
+        return self.send(lambda: self.service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id, body={"requests": requests}))
+
+    def write_blocks(self, spreadsheet_id: str, blocks: List[Block], value_input_option: str = "RAW",
+                     grid: Optional[Grid] = None, requests: List[Dict[str, object]] = None) -> WriteResult:
+        """
+        Writes blocks, several to a request, in chunks of rows small enough to keep each request under
+        max_cells_per_request.
+
+        Given the grid of the blocks' sheet, each chunk is instead written with spreadsheets.batchUpdate (RAW values
+        only), growing the grid first if need be, and requests (e.g. developer metadata updates) go out with the last
+        chunk rather than in a request of their own.
+        """
+        result = WriteResult()
+        blocks = [block for block in blocks if block.rows]
+        if grid is not None and value_input_option != "RAW":
+            raise ValueError(f"Only RAW values can be written to a grid, not {value_input_option}")
+        if not blocks:
+            if requests:
+                self.update_spreadsheet(spreadsheet_id, requests)
+            return result
+        started = self.clock()
+        width = sum(block.width for block in blocks)
+        rows_per_request = max(1, self.max_cells_per_request // max(width, 1))
+        total_rows = max(len(block.rows) for block in blocks)
+        for offset in range(0, total_rows, rows_per_request):
+            chunk = [block for block in blocks if offset < len(block.rows)]
+            if grid is None:
+                data = [block.value_range(offset, rows_per_request) for block in chunk]
+                response = self.execute(spreadsheet_id, {"valueInputOption": value_input_option, "data": data})
+                result.cells += response.get("totalUpdatedCells", 0)
+                result.responses += len(response.get("responses", []))
+            else:
+                last_row = max(block.start_row + min(len(block.rows), offset + rows_per_request) - 1
+                               for block in chunk)
+                updates = []
+                if last_row > grid.row_count:
+                    updates.append({"appendDimension": {
+                        "sheetId": grid.grid_id, "dimension": "ROWS", "length": last_row - grid.row_count}})
+                updates += [block.update_cells(grid.grid_id, offset, rows_per_request) for block in chunk]
+                if offset + rows_per_request >= total_rows:
+                    updates += requests or []
+                self.execute_requests(spreadsheet_id, updates)
+                grid.row_count = max(grid.row_count, last_row)
+                result.cells += sum(value is not None for block in chunk
+                                    for row in block.rows[offset:offset + rows_per_request] for value in row)
+                result.responses += len(chunk)
+            result.requests += 1
+        if grid is None and requests:
+            self.update_spreadsheet(spreadsheet_id, requests)
+        result.seconds = self.clock() - started
+        metrics.add("sheets_cells_written", result.cells)
+        logger.info(f"Wrote {result.cells} cells in {result.requests} request(s), "
+                    f"{result.seconds:.3f}s ({result.cells_per_second:.0f} cells/s)")
+        return result
+
+    def write_frame(self, spreadsheet_id: str, sheet_id: str, start_row: int, df: "pd.DataFrame",
+                    column_map: ColumnMap, grid: Optional[Grid] = None,
+                    requests: List[Dict[str, object]] = None) -> WriteResult:
+        """
+        Writes the mapped fields of df down their columns from start_row (see write_blocks for grid and requests)
+        """
+        return self.write_blocks(spreadsheet_id, column_map.blocks(sheet_id, start_row, df), grid=grid,
+                                 requests=requests)
+
+    def write_columns(self, spreadsheet_id: str, sheet_id: str, start_row: int,
+                      columns: Dict[str, List[object]]) -> WriteResult:
+        """
+        Writes each list of values down its column (keyed by letter) from start_row, coalescing adjacent columns
+        """
+        import pandas as pd
+        column_map = ColumnMap.compile({letters: letters for letters in columns})
+        return self.write_frame(spreadsheet_id, sheet_id, start_row, pd.DataFrame(columns), column_map)
@@ -1,14 +1,22 @@
 # /usr/bin/env python
 
 import datetime
+import importlib.metadata
 import os
+import re
+import subprocess
+import sys
+from pathlib import Path
 
 import app as json_to_sheets
+import google.auth.credentials
 import pandas as pd
 import pytest
+from googleapiclient.errors import HttpError
+from sheets_writer import ColumnMap, SheetsBatchWriter
 
 from tests.settings import settings
-from tests.utils import GoogleDriveAPIHelper, translate_date_string
+from tests.utils import FakeSheetsService, GoogleDriveAPIHelper, translate_date_string
 
 
 @pytest.fixture
@@ -63,6 +71,289 @@ def test_latest_sheet_row_and_date(sheets_api, drive_api, header):
     assert latest_sheet_date == datetime.datetime(2020, 6, 1, 6, 0)
 
 
+def test_latest_sheet_row_and_date_from_marker(header):
+    """
+    Finds the last row by probing the tail of the grid, then from the marker left by an append, and falls back to
+    probing once rows are added by hand
+    """
+    rows = [header] + [[str(i), f"2020-01-01 {i % 12 + 1}:00 AM"] for i in range(250)]
+    service = FakeSheetsService(rows=rows, row_count=1000)
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    assert sheets_api.latest_sheet_row_and_date == (251, datetime.datetime(2020, 1, 1, 10, 0))
+    # Only ever reads windows of the column, never the whole thing
+    reads = [kwargs["range"] for (method, kwargs) in service.calls if method == "values.get"]
+    assert reads == ["Sheet1!B801:B1000", "Sheet1!B601:B800", "Sheet1!B401:B600", "Sheet1!B201:B400"]
+    # Cached from then on
+    calls = len(service.calls)
+    assert sheets_api.latest_sheet_row_and_date[0] == 251
+    assert len(service.calls) == calls
+
+    # Already known not to exist, so the marker is created without looking it up again
+    service.calls.clear()
+    sheets_api.write_latest_row_marker(251, datetime.datetime(2020, 1, 1, 10, 0))
+    assert [method for (method, kwargs) in service.calls] == ["spreadsheets.batchUpdate"]
+    cold_sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    service.calls.clear()
+    assert cold_sheets_api.latest_sheet_row_and_date == (251, datetime.datetime(2020, 1, 1, 10, 0))
+    assert [method for (method, kwargs) in service.calls] == ["spreadsheets.get", "values.get"]
+
+    service.rows.append(["by hand", "2020-01-02 6:00 AM"])
+    stale_sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    assert stale_sheets_api.latest_sheet_row_and_date == (252, datetime.datetime(2020, 1, 2, 6, 0))
+
+
+def test_latest_row_marker_retried(header):
+    """
+    Marker requests go through the writer, so they count against its quota and are retried like writes
+    """
+    service = FakeSheetsService(rows=[header], errors=[429, 503])
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    sleeps = []
+    sheets_api.writer = SheetsBatchWriter(service, sleep=sleeps.append)
+    sheets_api.write_latest_row_marker(1, datetime.datetime(2020, 1, 1))
+    methods = [method for (method, kwargs) in service.calls]
+    assert methods == ["spreadsheets.get"] * 3 + ["spreadsheets.batchUpdate"]
+    assert len(sleeps) == 2
+    service.errors = [500]
+    sheets_api.writer.update_spreadsheet("fake", [])
+    assert [method for (method, kwargs) in service.calls][4:] == ["spreadsheets.batchUpdate"] * 2
+    assert len(sleeps) == 3
+    assert len(sheets_api.writer.request_times) == 6
+    assert sheets_api.read_latest_row_marker() == 1
+
+
+def test_latest_sheet_row_and_date_empty(header):
+    """
+    An empty sheet appends from the first row, and one with only a header appends after it
+    """
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(service=FakeSheetsService(), sheet_id="Sheet1")
+    assert sheets_api.latest_sheet_row_and_date == (0, datetime.datetime(1, 1, 1))
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(service=FakeSheetsService(rows=[header]), sheet_id="Sheet1")
+    assert sheets_api.latest_sheet_row_and_date == (1, datetime.datetime(1, 1, 1))
+
+
+def test_write_encv_values_selects_new_dates(header):
+    """
+    Appends only the data points newer than the sheet's latest date, in date order, whatever order they arrive in
+    """
+    service = FakeSheetsService(rows=[header, ["1", "2020-12-23 12:00 AM"]])
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    data = pd.DataFrame.from_dict([
+        {"date": "2020-12-25 00:00:00", "codes_issued": 888, "codes_claimed": 777},
+        {"date": "2020-12-22 00:00:00", "codes_issued": 222, "codes_claimed": 111},
+        {"date": "2020-12-24 00:00:00", "codes_issued": 666, "codes_claimed": 555},
+        {"date": "2020-12-23 00:00:00", "codes_issued": 444, "codes_claimed": 333},
+    ])
+    assert sheets_api.write_encv_values("A:G", data)
+    assert data.date.tolist()[0] == "2020-12-25 00:00:00"  # The caller's frame is left alone
+    # Adjacent columns go out as one range, in the same request as the marker
+    writes = [kwargs["body"] for (method, kwargs) in service.calls if "batchUpdate" in method]
+    assert writes == [{"requests": [
+        {"updateCells": {
+            "range": {"sheetId": 0, "startRowIndex": 2, "endRowIndex": 4, "startColumnIndex": 1, "endColumnIndex": 4},
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": "2020-12-24 00:00 AM"}},
+                                 {"userEnteredValue": {"numberValue": 666}},
+                                 {"userEnteredValue": {"numberValue": 555}}]},
+                     {"values": [{"userEnteredValue": {"stringValue": "2020-12-25 00:00 AM"}},
+                                 {"userEnteredValue": {"numberValue": 888}},
+                                 {"userEnteredValue": {"numberValue": 777}}]}],
+            "fields": "userEnteredValue"}},
+        {"createDeveloperMetadata": {"developerMetadata": {
+            "metadataKey": "encv_latest_row:Sheet1", "metadataValue": "4", "location": {"spreadsheet": True},
+            "visibility": "DOCUMENT"}}},
+    ]}]
+    assert service.rows[2:] == [["", "2020-12-24 00:00 AM", 666, 555], ["", "2020-12-25 00:00 AM", 888, 777]]
+    assert sheets_api.latest_sheet_row_and_date == (4, datetime.datetime(2020, 12, 25))
+
+
+def test_write_encv_values_with_marker(header):
+    """
+    Appends in one spreadsheets.batchUpdate that grows the grid, writes the values and records the marker, so that
+    a run which finds the marker makes only three requests, and one which already knows the last row only one
+    """
+    def data(*days):
+        return pd.DataFrame.from_dict([{"date": f"2021-01-0{day} 00:00:00", "codes_issued": day, "codes_claimed": day}
+                                       for day in days])
+
+    # A full grid, which the appends must grow
+    service = FakeSheetsService(rows=[header, ["1", "2021-01-01 00:00 AM"]], row_count=2, grid_id=7)
+    assert json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service) \
+        .write_encv_values("A:G", data(1, 2))
+    assert service.row_count == 3
+
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    service.calls.clear()
+    assert sheets_api.write_encv_values("A:G", data(3, 4))
+    assert [method for (method, kwargs) in service.calls] == ["spreadsheets.get", "values.get",
+                                                              "spreadsheets.batchUpdate"]
+    requests = service.calls[-1][1]["body"]["requests"]
+    assert [list(request) for request in requests] == [["appendDimension"], ["updateCells"],
+                                                       ["updateDeveloperMetadata"]]
+    assert requests[0]["appendDimension"] == {"sheetId": 7, "dimension": "ROWS", "length": 2}
+    assert service.read("Sheet1!B4:C5") == [["2021-01-03 00:00 AM", 3], ["2021-01-04 00:00 AM", 4]]
+
+    # Split across requests, only the last of which carries the marker
+    sheets_api.writer = SheetsBatchWriter(service, max_cells_per_request=3)
+    service.calls.clear()
+    assert sheets_api.write_encv_values("A:G", data(5, 6))
+    assert [[name for request in kwargs["body"]["requests"] for name in request] for (_, kwargs) in service.calls] == [
+        ["appendDimension", "updateCells"], ["appendDimension", "updateCells", "updateDeveloperMetadata"]]
+    assert (service.row_count, service.developer_metadata["encv_latest_row:Sheet1"]["metadataValue"]) == (7, "7")
+    assert sheets_api.latest_sheet_row_and_date == (7, datetime.datetime(2021, 1, 6))
+
+
+def test_write_empty_export(header, monkeypatch):
+    """
+    Writes nothing, and reports success, when db_to_json had nothing new to export
+    """
+    service = FakeSheetsService(rows=[header])
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(spreadsheet_id="fake", sheet_id="Sheet1", service=service)
+    assert sheets_api.write_encv_values("A:G", pd.DataFrame.from_dict([]))
+    assert service.calls == []
+
+    def no_helper(**kwargs):
+        raise AssertionError("An empty export shouldn't initialize the sheet")
+
+    monkeypatch.setattr(json_to_sheets, "GoogleSheetsAPIHelper", no_helper)
+    response = json_to_sheets.lambda_handler({"body": {"data": [], "watermark": None}}, None)
+    assert response["body"]["success"]
+
+
+def test_sheets_batch_writer(header):
+    """
+    Splits a large write into bounded requests, retries rate limiting with backoff, paces requests to the write
+    quota, and reports throughput
+    """
+    service = FakeSheetsService(errors=[429, 503])
+    sleeps = []
+    now = [0.0]
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    writer = SheetsBatchWriter(service, max_cells_per_request=30, writes_per_minute=5, backoff_base_seconds=0.5,
+                               sleep=sleep, clock=lambda: now[0])
+    columns = {"B": [f"date {i}" for i in range(25)], "C": list(range(25)), "D": list(range(25)), "F": ["x"] * 25}
+    result = writer.write_columns("fake", "Sheet1", 2, columns)
+    # 4 columns wide, so 7 rows per request; B:D coalesce, F can't
+    requests = [kwargs["body"]["data"] for (method, kwargs) in service.calls if method == "values.batchUpdate"]
+    assert [[update["range"] for update in data] for data in requests[2:]] == [
+        ["Sheet1!B2:D8", "Sheet1!F2:F8"], ["Sheet1!B9:D15", "Sheet1!F9:F15"],
+        ["Sheet1!B16:D22", "Sheet1!F16:F22"], ["Sheet1!B23:D26", "Sheet1!F23:F26"]]
+    assert (result.requests, result.cells) == (4, 100)
+    assert service.read("Sheet1!B2:F26")[-1] == ["date 24", 24, 24, "", "x"]
+    # Two retries within the first backoff ceilings, then (failed attempts count too) a wait for the 5-per-minute
+    # quota before the last write
+    assert len(sleeps) == 3
+    assert 0 <= sleeps[0] <= 0.5 and 0 <= sleeps[1] <= 1.0
+    assert sleeps[2] == pytest.approx(60 - sleeps[0] - sleeps[1])
+    assert result.cells_per_second == pytest.approx(100 / sum(sleeps))
+
+    with pytest.raises(HttpError):
+        SheetsBatchWriter(FakeSheetsService(errors=[400]), sleep=sleep).write_columns("fake", "Sheet1", 1, columns)
+
+
+def test_sheets_writer_defers_heavy_imports():
+    """
+    Imports sheets_writer in a fresh interpreter, as a cold start would, and confirms pandas and the Google API client
+    are left for the code paths that use them
+    """
+    importtime = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sheets_writer"],
+        cwd=Path(__file__).parent.parent, capture_output=True, text=True, check=True
+    ).stderr
+    imported = {line.split("|")[-1].strip() for line in importtime.splitlines() if line.startswith("import time:")}
+    assert "sheets_writer" in imported
+    assert not {"pandas", "googleapiclient"} & imported
+
+
+def test_write_all_stats(header):
+    """
+    Writes every ENCVStat metric in one request, as one contiguous range per run of adjacent columns
+    """
+    service = FakeSheetsService(rows=[header])
+    sheets_api = json_to_sheets.GoogleSheetsAPIHelper(
+        spreadsheet_id="fake", sheet_id="Sheet1", service=service,
+        column_map=ColumnMap.compile(json_to_sheets.ALL_STATS_SHEET_COLUMN_MAP))
+    data = pd.DataFrame.from_dict([
+        {"date": "2020-12-22 00:00:00", "codes_issued": 1, "codes_claimed": 2, "codes_invalid": 3,
+         "code_claim_mean_age_seconds": 4, "tokens_claimed": 5, "tokens_invalid": None},
+    ])
+    assert sheets_api.write_encv_values("A:K", data)
+    (body,) = [kwargs["body"] for (method, kwargs) in service.calls if method == "spreadsheets.batchUpdate"]
+    assert [list(request) for request in body["requests"]] == [["updateCells"], ["updateCells"],
+                                                               ["createDeveloperMetadata"]]
+    assert service.rows[1] == ["", "2020-12-22 00:00 AM", 1, 2, "", "", "", 3, 4, 5, ""]
+    with pytest.raises(ValueError, match="tokens_claimed"):
+        sheets_api.write_encv_values("A:K", data.assign(date="2020-12-23 00:00:00").drop(columns=["tokens_claimed"]))
+    with pytest.raises(ValueError, match="column C"):
+        ColumnMap.compile({"codes_issued": "C", "codes_invalid": "C"})
+
+
+class FakeCredentials(google.auth.credentials.Credentials):
+    def __init__(self):
+        super().__init__()
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"token {self.refreshes}"
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+def test_cached_credentials_and_service(monkeypatch):
+    """
+    Loads credentials and builds the service from the static discovery document once per process, and only
+    refreshes the token when it has expired
+    """
+    credentials = FakeCredentials()
+    loads = []
+    monkeypatch.setattr(json_to_sheets, "load_credentials", lambda: loads.append(1) or credentials)
+    json_to_sheets.cache.invalidate()
+    try:
+        first = json_to_sheets.GoogleSheetsAPIHelper(sheet_id="Sheet1")
+        second = json_to_sheets.GoogleSheetsAPIHelper(sheet_id="Sheet1")
+        assert first.service is second.service
+        assert (len(loads), credentials.refreshes) == (1, 1)
+        # Built from the vendored document, with no discovery fetch
+        assert first.service._baseUrl == "https://sheets.googleapis.com/"
+        assert hasattr(first.service.spreadsheets(), "developerMetadata")
+
+        credentials.expiry = datetime.datetime.utcnow()  # The token has expired
+        json_to_sheets.GoogleSheetsAPIHelper(sheet_id="Sheet1")
+        assert (len(loads), credentials.refreshes) == (1, 2)
+    finally:
+        json_to_sheets.cache.invalidate()
+
+
+def test_discovery_document_matches_locked_client():
+    """
+    Confirms the client installed is the one locked in poetry.lock, that the vendored discovery document is the copy
+    it ships, and that every method the helpers call builds from it
+    """
+    import googleapiclient
+    from googleapiclient.discovery import build_from_document
+
+    lock = (Path(__file__).parent.parent / "poetry.lock").read_text()
+    locked = re.search(r'name = "google-api-python-client"\nversion = "([^"]+)"', lock).group(1)
+    assert importlib.metadata.version("google-api-python-client") == locked, "Run the tests with poetry run pytest"
+
+    shipped = Path(googleapiclient.__file__).parent / "discovery_cache" / "documents" / "sheets.v4.json"
+    vendored = Path(json_to_sheets.SHEETS_DISCOVERY_DOCUMENT)
+    assert vendored.read_bytes() == shipped.read_bytes()
+
+    spreadsheets = build_from_document(vendored.read_text(), credentials=FakeCredentials()).spreadsheets()
+    requests = [
+        spreadsheets.get(spreadsheetId="fake", fields="sheets.properties.gridProperties.rowCount"),
+        spreadsheets.batchUpdate(spreadsheetId="fake", body={"requests": []}),
+        spreadsheets.values().get(spreadsheetId="fake", range="Sheet1!B:B"),
+        spreadsheets.values().batchUpdate(spreadsheetId="fake", body={"data": []}),
+    ]
+    for request in requests:
+        assert request.uri.startswith("https://sheets.googleapis.com/v4/spreadsheets/fake")
+
+
 def test_populate_sheet(drive_api, sheets_api, header):
     data = [
         {"id": '31', "date": "2020-12-22 00:00:00",
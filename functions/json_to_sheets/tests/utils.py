@@ -3,11 +3,15 @@
 import datetime
 import logging
 import os
+import re
 from pprint import pformat
+from typing import Dict, List, Optional, Tuple
 
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 logger = logging.getLogger()
 logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO"))
@@ -81,3 +85,160 @@ def translate_date_string(helper: GoogleDriveAPIHelper, date_string: str) -> str
     translated_date_string = datetime.datetime.strftime(
         parsed_date, helper.destination_date_format)
     return translated_date_string
+
+
+def parse_a1_range(range_name: str) -> Tuple[str, int, int, Optional[int], Optional[int]]:
+    """
+    Splits e.g. "Sheet1!B2:C" into the sheet name and 0-indexed first row and column and last row and column (None
+    when open-ended)
+    """
+    (sheet, _, cells) = range_name.rpartition("!")
+    match = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", cells)
+    (start_column, start_row, end_column, end_row) = match.groups()
+
+    def column_index(letters):
+        index = 0
+        for letter in letters:
+            index = index * 26 + ord(letter) - ord("A") + 1
+        return index - 1
+
+    return (sheet,
+            int(start_row) - 1 if start_row else 0,
+            column_index(start_column),
+            int(end_row) - 1 if end_row else None,
+            column_index(end_column or start_column))
+
+
+class FakeRequest:
+    def __init__(self, result: Dict[str, object]):
+        self.result = result
+
+    def execute(self) -> Dict[str, object]:
+        return self.result
+
+
+class FakeSheetsService:
+    """
+    An in-memory stand-in for the parts of the Sheets v4 API used by GoogleSheetsAPIHelper, holding a single sheet
+    and recording each request made (as (method, kwargs) in calls). Writes and spreadsheets.get requests fail with the
+    HTTP statuses queued in errors, one per request, before succeeding.
+    """
+
+    def __init__(self, rows: List[List[str]] = None, row_count: int = 1000, errors: List[int] = None,
+                 grid_id: int = 0):
+        self.rows = [list(row) for row in rows or []]
+        self.row_count = row_count
+        self.grid_id = grid_id
+        self.developer_metadata = {}
+        self.calls = []
+        self.errors = list(errors or [])
+
+    def raise_queued_error(self):
+        if self.errors:
+            raise HttpError(httplib2.Response({"status": self.errors.pop(0)}), b"")
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    def read(self, range_name: str) -> List[List[str]]:
+        (_, start_row, start_column, end_row, end_column) = parse_a1_range(range_name)
+        rows = self.rows[start_row:None if end_row is None else end_row + 1]
+        values = [row[start_column:end_column + 1] for row in rows]
+        values = [row[:max([i + 1 for i, cell in enumerate(row) if cell not in (None, "")], default=0)]
+                  for row in values]
+        while values and not values[-1]:
+            values.pop()  # Like the real API, trailing empty rows are left out
+        return values
+
+    def write_cell(self, row: int, column: int, value: str):
+        while len(self.rows) <= row:
+            self.rows.append([])
+        while len(self.rows[row]) <= column:
+            self.rows[row].append("")
+        self.rows[row][column] = value
+        self.row_count = max(self.row_count, len(self.rows))
+
+    def update_cells(self, request: Dict[str, object]):
+        """
+        Applies an UpdateCellsRequest, which unlike a value write fails beyond the grid rather than growing it
+        """
+        grid_range = request["range"]
+        if grid_range["sheetId"] != self.grid_id or grid_range["endRowIndex"] > self.row_count:
+            raise HttpError(httplib2.Response({"status": 400}), b"Range exceeds grid limits")
+        for i, row in enumerate(request["rows"]):
+            for j, cell in enumerate(row["values"]):
+                value = next(iter(cell["userEnteredValue"].values())) if "userEnteredValue" in cell else ""
+                self.write_cell(grid_range["startRowIndex"] + i, grid_range["startColumnIndex"] + j, value)
+
+
+class FakeSpreadsheets:
+    def __init__(self, service: FakeSheetsService):
+        self.service = service
+
+    def values(self):
+        return FakeValues(self.service)
+
+    def get(self, **kwargs):
+        self.service.calls.append(("spreadsheets.get", kwargs))
+        self.service.raise_queued_error()
+        # Like the real API, default values (e.g. the first sheet's ID of 0) are left out
+        properties = {"gridProperties": {"rowCount": self.service.row_count}}
+        if self.service.grid_id:
+            properties["sheetId"] = self.service.grid_id
+        result = {"sheets": [{"properties": properties}]}
+        if self.service.developer_metadata:
+            result["developerMetadata"] = [{"metadataKey": metadata["metadataKey"],
+                                            "metadataValue": metadata["metadataValue"]}
+                                           for metadata in self.service.developer_metadata.values()]
+        return FakeRequest(result)
+
+    def batchUpdate(self, spreadsheetId: str, body: Dict[str, object]):
+        self.service.calls.append(("spreadsheets.batchUpdate", {"spreadsheetId": spreadsheetId, "body": body}))
+        self.service.raise_queued_error()
+        for request in body["requests"]:
+            if "createDeveloperMetadata" in request:
+                metadata = request["createDeveloperMetadata"]["developerMetadata"]
+                self.service.developer_metadata[metadata["metadataKey"]] = dict(metadata)
+            elif "updateDeveloperMetadata" in request:
+                metadata = request["updateDeveloperMetadata"]["developerMetadata"]
+                self.service.developer_metadata[metadata["metadataKey"]].update(metadata)
+            elif "appendDimension" in request:
+                self.service.row_count += request["appendDimension"]["length"]
+            elif "updateCells" in request:
+                self.service.update_cells(request["updateCells"])
+        return FakeRequest({"replies": [{} for request in body["requests"]]})
+
+
+class FakeValues:
+    def __init__(self, service: FakeSheetsService):
+        self.service = service
+
+    def get(self, spreadsheetId: str, range: str):
+        self.service.calls.append(("values.get", {"spreadsheetId": spreadsheetId, "range": range}))
+        return FakeRequest({"range": range, "values": self.service.read(range)})
+
+    def update(self, spreadsheetId: str, range: str, valueInputOption: str, body: Dict[str, object]):
+        self.service.calls.append(("values.update", {"spreadsheetId": spreadsheetId, "range": range, "body": body}))
+        (_, start_row, start_column, _, _) = parse_a1_range(range)
+        for i, row in enumerate(body["values"]):
+            for j, value in enumerate(row):
+                self.service.write_cell(start_row + i, start_column + j, value)
+        return FakeRequest({"updatedRange": range})
+
+    def batchUpdate(self, spreadsheetId: str, body: Dict[str, object]):
+        self.service.calls.append(("values.batchUpdate", {"spreadsheetId": spreadsheetId, "body": body}))
+        self.service.raise_queued_error()
+        updated_cells = 0
+        for data in body["data"]:
+            (_, start_row, start_column, _, _) = parse_a1_range(data["range"])
+            values = data["values"]
+            if data.get("majorDimension") == "COLUMNS":
+                values = [[column[i] if column and i < len(column) else None for column in values]
+                          for i in range(max([len(column) for column in values if column], default=0))]
+            for i, row in enumerate(values):
+                for j, value in enumerate(row):
+                    if value is not None:
+                        self.service.write_cell(start_row + i, start_column + j, value)
+                        updated_cells += 1
+        return FakeRequest({"totalUpdatedCells": updated_cells, "responses": [{} for data in body["data"]]})
+
@@ -7,19 +7,41 @@ It relies on the following configuration parameters:
 * ENCV API a string with the API key for encv.org.
 or
 * ENCV_SECRET_NAME and ENCV_SECRET_KEY the secret name and key in AWS secrets manager which holds the encv.org API key.
+or
+* ENCV_TARGETS a JSON list of targets to collect concurrently, each with a "realm", an "endpoint" (default
+  "realm.json") and either an "api_key" or a "secret_name" and "secret_key". Results are tagged with realm and endpoint.
+
+Optionally:
+* ENCV_SNAPSHOT_LOCATION an s3://bucket/prefix URL or local directory used to remember the previous response of each
+  target. If set, only the entries that changed since the previous run are returned (pass {"full_refresh": true} as the
+  event to get them all). New snapshots are only staged, and listed in the response's "snapshots"; they take effect
+  once that list is passed back as {"commit_snapshots": [...]}, which the state machine does after the changed days
+  have been stored. So if anything downstream fails, the next run returns the same days again. Staged snapshots are
+  kept under the location's pending/ prefix, and deleted once committed.
+* CLAIM_CHECK_LOCATION an s3://bucket/prefix URL or local directory. If set, results larger than
+  CLAIM_CHECK_THRESHOLD_BYTES are written there and only a reference to them is returned (see claim_check.py).
 
 """
 
 
+import hashlib
 import json
 import logging
-from typing import Dict
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from requests.exceptions import HTTPError
 
+from claim_check import offload_if_large
+from collector import collect_encv_stats
+from http_session import create_http_session, request_with_retries
+from metrics import metrics
+from resources import cache
 from secrets_manager import SecretsManager
-from settings import settings
+from settings import ENCVTarget, settings
+from snapshot import SnapshotStore
 
 logging.basicConfig(
     level=settings.log_level
@@ -27,25 +49,26 @@ logging.basicConfig(
 logger = logging.getLogger()
 
 
-def get_encv_stats() -> Dict[str, object]:
-    """
-    Retrieve statistics concerning issued codes, as outlined here:
-    https://github.com/google/exposure-notifications-verification-server/blob/main/docs/api.md#apistats-preview
+DEFAULT_ENCV_STATS_URL = "https://adminapi.encv.org/api/stats/realm.json"
 
-    Includes data for the previous month.
+
+def request_encv_stats(api_key: str, extra_headers: Dict[str, str] = None,
+                       encv_stats_url: str = DEFAULT_ENCV_STATS_URL) -> requests.Response:
+    """
+    Calls an ENCV stats API (by default, the realm stats), returning the raw response
     """
-    base_url = "adminapi.encv.org"
-    encv_stats_url = f"https://{base_url}/api/stats/realm.json"
     headers = {
         "content-type": "application/json",
         "accept": "application/json",
-        "x-api-key": settings.encv_api_key,
+        "x-api-key": api_key,
+        **(extra_headers or {}),
     }
     try:
         logger.info("Calling ENCV API...")
-        response = requests.get(encv_stats_url, headers=headers)
+        session = cache.get("http_session", create_http_session)
+        response = request_with_retries(session, "GET", encv_stats_url, headers=headers)
         response.raise_for_status()
-        return response.json().get("statistics")
+        return response
     except HTTPError as http_err:
         logger.error(f"HTTP error occurred: {http_err}")
         raise
@@ -56,18 +79,186 @@ def get_encv_stats() -> Dict[str, object]:
         logger.info("encv call completed")
 
 
+def get_encv_stats(api_key: str, encv_stats_url: str = DEFAULT_ENCV_STATS_URL) -> List[Dict[str, object]]:
+    """
+    Retrieve statistics concerning issued codes, as outlined here:
+    https://github.com/google/exposure-notifications-verification-server/blob/main/docs/api.md#apistats-preview
+
+    Includes data for the previous month.
+    """
+    return request_encv_stats(api_key, encv_stats_url=encv_stats_url).json().get("statistics")
+
+
+def get_changed_encv_stats(api_key: str, store: SnapshotStore, full_refresh: bool = False,
+                           encv_stats_url: str = DEFAULT_ENCV_STATS_URL
+                           ) -> Tuple[List[Dict[str, object]], Optional[Dict[str, object]]]:
+    """
+    Retrieve statistics as get_encv_stats does, but only return the entries that differ from the snapshot of the
+    previous response held in store. The request is conditional on the previous ETag / Last-Modified, and a
+    response whose content hash matches the previous one is treated as unchanged, so both yield an empty list.
+
+    Also returns the snapshot of this response, or None if it was unchanged. store is left as it was: the new
+    snapshot must only be saved once the changed days have been stored (see commit_snapshots).
+
+    full_refresh ignores the previous snapshot and returns every day, e.g. to recover from a failed downstream run.
+    """
+    previous = {} if full_refresh else (store.load() or {})
+    conditional_headers = {}
+    if previous.get("etag"):
+        conditional_headers["if-none-match"] = previous["etag"]
+    if previous.get("last_modified"):
+        conditional_headers["if-modified-since"] = previous["last_modified"]
+    response = request_encv_stats(api_key, conditional_headers, encv_stats_url=encv_stats_url)
+    if response.status_code == 304:
+        logger.info("ENCV stats not modified since the previous run")
+        return ([], None)
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if content_hash == previous.get("content_hash"):
+        logger.info("ENCV stats identical to the previous run")
+        return ([], None)
+    statistics = response.json().get("statistics")
+    entry_hashes = [entry_hash(entry) for entry in statistics]
+    previous_entries = set(previous.get("entries", []))
+    changed = [entry for (entry, digest) in zip(statistics, entry_hashes) if digest not in previous_entries]
+    logger.info(f"{len(changed)} of {len(statistics)} entries changed since the previous run")
+    metrics.add("days_unchanged", len(statistics) - len(changed))
+    return (changed, {
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "content_hash": content_hash,
+        "entries": sorted(set(entry_hashes)),
+    })
+
+
+def entry_hash(entry: Dict[str, object]) -> str:
+    """
+    Identifies a statistics entry by its whole content rather than by its date, since the per-user and
+    per-external-issuer endpoints return several entries for each day
+    """
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+
+def configured_targets() -> List[ENCVTarget]:
+    """
+    Returns the targets to collect: those in ENCV_TARGETS, or else the single realm configured by ENCV_API_KEY /
+    ENCV_SECRET_NAME
+    """
+    if settings.encv_targets:
+        return settings.encv_targets
+    return [ENCVTarget(realm=settings.encv_realm, api_key=settings.encv_api_key,
+                       secret_name=settings.encv_secret_name, secret_key=settings.encv_secret_key)]
+
+
+def get_encv_api_key(target: ENCVTarget) -> str:
+    """
+    Returns the target's ENCV API key, or reads it from secrets manager, where it is cached between invocations
+    """
+    if target.api_key:
+        return target.api_key
+    logger.info(f"ENCV API key for realm {target.realm} not found, querying secrets manager...")
+    secrets_manager = cache.get(
+        "secrets_manager", lambda: SecretsManager(ttl_seconds=settings.secrets_ttl_seconds))
+    return secrets_manager.get(secret_name=target.secret_name, secret_key=target.secret_key)
+
+
+def snapshot_store(location: str) -> SnapshotStore:
+    return cache.get(f"snapshot_store:{location}", lambda: SnapshotStore(location))
+
+
+def fetch_target_stats(target: ENCVTarget, full_refresh: bool = False
+                       ) -> Tuple[List[Dict[str, object]], Dict[str, Dict[str, object]]]:
+    """
+    Fetches a single target's statistics, only returning changed days if ENCV_SNAPSHOT_LOCATION is set. Also returns
+    the target's new snapshot, if there is one, keyed by the location it is to be committed to.
+    """
+    api_key = get_encv_api_key(target)
+    if not settings.encv_snapshot_location:
+        return (get_encv_stats(api_key, encv_stats_url=target.url), {})
+    location = f"{settings.encv_snapshot_location.rstrip('/')}/{target.realm}/{target.endpoint}"
+    (changed, snapshot) = get_changed_encv_stats(api_key, snapshot_store(location), full_refresh=full_refresh,
+                                                 encv_stats_url=target.url)
+    return (changed, {location: snapshot} if snapshot is not None else {})
+
+
+def pending_location(location: str, run_id: str) -> str:
+    """
+    Returns where a run stages the snapshot for location: under ENCV_SNAPSHOT_LOCATION's pending/ prefix, so those a
+    failed run abandons can be expired all together (see PayloadBucket in template.yaml)
+    """
+    root = settings.encv_snapshot_location.rstrip("/")
+    return f"{root}/pending/{run_id}/{location[len(root):].lstrip('/')}"
+
+
+def stage_snapshots(snapshots: Dict[str, Dict[str, object]]) -> List[Dict[str, str]]:
+    """
+    Saves each new snapshot without replacing the current one yet, returning the references commit_snapshots needs
+    to do so
+    """
+    run_id = uuid.uuid4().hex
+    staged = []
+    for (location, snapshot) in snapshots.items():
+        pending = pending_location(location, run_id)
+        SnapshotStore(pending).save(snapshot)
+        staged.append({"location": location, "pending": pending})
+    return staged
+
+
+def commit_snapshots(staged: List[Dict[str, str]]):
+    """
+    Makes staged snapshots current, once the days they were compared against have been stored downstream. Every
+    staged snapshot is read before any is saved, so one that can't be read doesn't leave the others half committed,
+    and they are only deleted once all of them have been saved.
+    """
+    snapshots = [(entry["location"], SnapshotStore(entry["pending"]).load()) for entry in staged]
+    missing = [entry["pending"] for entry, (_, snapshot) in zip(staged, snapshots) if snapshot is None]
+    if missing:
+        raise ValueError(f"Staged snapshots {missing} not found")
+    for (location, snapshot) in snapshots:
+        logger.info(f"Committing snapshot for {location}...")
+        snapshot_store(location).save(snapshot)
+    for entry in staged:
+        try:
+            SnapshotStore(entry["pending"]).delete()
+        except Exception as err:
+            # Committed all the same; the pending/ lifecycle rule expires whatever is left behind
+            logger.warning(f"Could not delete staged snapshot {entry['pending']}: {err}")
+
+
+@metrics.invocation("query_encv")
 def lambda_handler(event, context):
-    secrets_manager = SecretsManager()
-    if not settings.encv_api_key:
-        logger.info("ENCV API key not found, querying secrets manager...")
-        settings.encv_api_key = secrets_manager.get(
-            secret_name=settings.ENCV_SECRET_NAME, secret_key=settings.ENCV_SECRET_KEY)
-    data = get_encv_stats()
+    if event and "commit_snapshots" in event:
+        commit_snapshots(event["commit_snapshots"])
+        return {"statusCode": 200, "body": {"committed": len(event["commit_snapshots"])}}
+    full_refresh = bool(event and event.get("full_refresh"))
+    targets = configured_targets()
+    # Gathered from every target, but only staged once all of them have succeeded. Otherwise a target that failed
+    # would fail the run, and the retry would no longer return the changes of those that didn't.
+    snapshots = {}
+    snapshots_lock = threading.Lock()
+
+    def fetch(target: ENCVTarget) -> List[Dict[str, object]]:
+        (statistics, snapshot) = fetch_target_stats(target, full_refresh=full_refresh)
+        with snapshots_lock:
+            snapshots.update(snapshot)
+        return statistics
+
+    data = collect_encv_stats(
+        targets,
+        fetch,
+        max_workers=settings.encv_max_workers,
+        per_host_concurrency=settings.encv_per_host_concurrency
+    )
+    metrics.add("targets", len(targets))
+    metrics.add("rows_out", len(data))
+    body = {
+        "data": offload_if_large(data, settings.claim_check_location, settings.claim_check_threshold_bytes),
+        "changed": len(data) > 0
+    }
+    # Only staged once everything else has succeeded, and only committed once the data has been stored
+    body["snapshots"] = stage_snapshots(snapshots)
     return {
         "statusCode": 200,
-        "body": {
-            "data": data
-        }
+        "body": body
     }
 
 
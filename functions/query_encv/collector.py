@@ -0,0 +1,38 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from urllib.parse import urlparse
+
+from settings import ENCVTarget
+
+logger = logging.getLogger()
+
+
+def collect_encv_stats(targets: List[ENCVTarget], fetch: Callable[[ENCVTarget], List[Dict[str, object]]],
+                       max_workers: int, per_host_concurrency: int) -> List[Dict[str, object]]:
+    """
+    Fetches the statistics of every target concurrently, on a pool of at most max_workers threads, with no more than
+    per_host_concurrency requests in flight to any one host. Wall-clock time is therefore bounded by the slowest
+    targets rather than the sum of all of them.
+
+    Returns the statistics of all targets merged into one list, in target order, with each entry tagged with the
+    realm and endpoint it came from.
+    """
+    if not targets:
+        return []
+    host_limits = {host: threading.BoundedSemaphore(per_host_concurrency)
+                   for host in {urlparse(target.url).netloc for target in targets}}
+
+    def fetch_limited(target: ENCVTarget) -> List[Dict[str, object]]:
+        with host_limits[urlparse(target.url).netloc]:
+            logger.info(f"Collecting {target.endpoint} for realm {target.realm}...")
+            return fetch(target)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+        results = list(executor.map(fetch_limited, targets))
+    return [
+        {**entry, "realm": target.realm, "endpoint": target.endpoint}
+        for target, statistics in zip(targets, results)
+        for entry in statistics
+    ]
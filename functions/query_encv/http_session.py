@@ -0,0 +1,69 @@
+import logging
+import random
+import time
+from typing import Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from metrics import BYTES, metrics
+from settings import settings
+
+logger = logging.getLogger()
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def create_http_session() -> requests.Session:
+    """
+    Creates a session whose connections are pooled and kept alive, so repeated calls (and warm invocations, when the
+    session is cached) skip the TCP and TLS handshakes
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=settings.http_pool_size, pool_maxsize=settings.http_pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def backoff_delay(attempt: int, retry_after: str = None) -> float:
+    """
+    Seconds to wait before retrying after the given (1-based) attempt: the server's Retry-After if it sent one,
+    otherwise exponential backoff with full jitter. Either way, capped at http_backoff_max_seconds.
+    """
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), settings.http_backoff_max_seconds)
+    ceiling = min(settings.http_backoff_max_seconds, settings.http_backoff_base_seconds * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+@metrics.timer("http_request")
+def request_with_retries(session: requests.Session, method: str, url: str,
+                         sleep: Callable[[float], None] = time.sleep, **kwargs) -> requests.Response:
+    """
+    Sends a request with a bounded timeout, retrying connection errors, timeouts and 429/5xx responses up to
+    http_max_attempts times. Returns the last response, which the caller should still check for errors.
+    """
+    attempts = settings.http_max_attempts
+    total_delay = 0.0
+    for attempt in range(1, attempts + 1):
+        try:
+            response = session.request(method, url, timeout=settings.http_timeout_seconds, **kwargs)
+        except (ConnectionError, Timeout) as err:
+            if attempt == attempts:
+                logger.error(f"{method} {url} failed after {attempt} attempts, {total_delay:.3f}s backoff: {err}")
+                raise
+            reason, delay = repr(err), backoff_delay(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == attempts:
+                break
+            reason, delay = f"HTTP {response.status_code}", backoff_delay(attempt, response.headers.get("retry-after"))
+        logger.warning(f"{method} {url} attempt {attempt} failed ({reason}), retrying in {delay:.3f}s...")
+        metrics.add("http_retries")
+        total_delay += delay
+        sleep(delay)
+    logger.info(f"{method} {url} returned {response.status_code} after {attempt} attempt(s), "
+                f"{total_delay:.3f}s backoff")
+    metrics.add("http_response_bytes", len(response.content), BYTES)
+    return response
@@ -1,12 +1,43 @@
 import os
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings
+
+
+class ENCVTarget(BaseModel):
+    """
+    One stats endpoint to collect, for one realm, along with the API key (or the secret holding it) for that realm
+    """
+    realm: str
+    endpoint: str = "realm.json"  # Path under /api/stats/, e.g. realm.json, realm/users.json, realm/external-issuers.json
+    api_key: Optional[str] = None
+    secret_name: Optional[str] = None
+    secret_key: Optional[str] = None
+    base_url: str = "https://adminapi.encv.org"
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/api/stats/{self.endpoint}"
 
 
 class Settings(BaseSettings):
     encv_api_key: Optional[str] = None
+    encv_secret_name: Optional[str] = None  # If encv_api_key is not supplied, read it from this secret in secrets manager
+    encv_secret_key: Optional[str] = None  # ... under this key
+    encv_realm: str = "default"  # The realm name to tag results with, when encv_targets is not supplied
+    encv_targets: List[ENCVTarget] = []  # If supplied, a JSON list of targets to collect instead of the above
+    encv_max_workers: int = 8  # How many targets are fetched at once
+    encv_per_host_concurrency: int = 4  # ... of which at most this many from the same host
+    encv_snapshot_location: Optional[str] = None  # If supplied, only stats that changed since the last run are returned
+    http_timeout_seconds: float = 10  # Connect / read timeout for each ENCV API request
+    http_max_attempts: int = 4  # Including the first attempt
+    http_backoff_base_seconds: float = 0.05  # Backoff ceiling for the first retry, doubling on each one after that
+    http_backoff_max_seconds: float = 2
+    http_pool_size: int = 10
+    claim_check_location: Optional[str] = None  # If supplied (s3://bucket/prefix or a local directory), large payloads are offloaded here
+    claim_check_threshold_bytes: int = 128 * 1024  # ... once their serialized size exceeds this; Step Functions allows 256 KB
+    secrets_ttl_seconds: int = 300  # How long secrets are cached for between warm invocations
     log_level: str = "INFO"
 
     class Config:
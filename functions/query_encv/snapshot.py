@@ -0,0 +1,68 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from metrics import metrics
+
+logger = logging.getLogger()
+
+
+class SnapshotStore:
+    """
+    Persists a small JSON snapshot of the previous ENCV response between runs, so the next run can tell what changed.
+
+    location is either an s3://bucket/key URL, or a path on the local filesystem (useful for tests and local runs).
+    """
+
+    def __init__(self, location: str):
+        self.location = location
+        parsed = urlparse(location)
+        if parsed.scheme == "s3":
+            import boto3  # Deferred so that local snapshots don't pay for importing it
+            self.client = boto3.client("s3")
+            self.bucket = parsed.netloc
+            self.key = parsed.path.lstrip("/")
+        else:
+            self.client = None
+            self.path = Path(location)
+
+    @metrics.timer("snapshot_load")
+    def load(self) -> Optional[Dict[str, object]]:
+        """
+        Returns the stored snapshot, or None if there isn't one yet
+        """
+        logger.info(f"Loading snapshot from {self.location}...")
+        if self.client is None:
+            if not self.path.exists():
+                return None
+            return json.loads(self.path.read_text())
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "NoSuchKey":
+                return None
+            raise
+        return json.loads(response["Body"].read())
+
+    @metrics.timer("snapshot_save")
+    def save(self, snapshot: Dict[str, object]):
+        logger.info(f"Saving snapshot to {self.location}...")
+        body = json.dumps(snapshot)
+        if self.client is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(body)
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body.encode())
+
+    def delete(self):
+        """
+        Removes the stored snapshot, if there is one
+        """
+        logger.info(f"Deleting snapshot at {self.location}...")
+        if self.client is None:
+            self.path.unlink(missing_ok=True)
+        else:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
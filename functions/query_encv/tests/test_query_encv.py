@@ -6,9 +6,300 @@ This code is most easily invoked using pytest:
 """
 
 import json
+import threading
+import time
 
 import app as encv_to_db
 import pytest
+from collector import collect_encv_stats
+from http_session import request_with_retries
+from metrics import metrics
+from requests.exceptions import ConnectionError
+from secrets_manager import SecretsManager
+from settings import ENCVTarget
+
 
 def test_query_data():
-    pass
\ No newline at end of file
+    pass
+
+
+class StubSecretsClient:
+    """
+    Stands in for the boto3 secretsmanager client, counting calls and returning a new secret version on each one
+    """
+
+    def __init__(self, delay: float = 0):
+        self.calls = []
+        self.delay = delay
+
+    def get_secret_value(self, SecretId: str, VersionStage: str):
+        self.calls.append((SecretId, VersionStage))
+        time.sleep(self.delay)
+        return {"SecretString": json.dumps({"key": f"{SecretId}-{VersionStage}-{len(self.calls)}"})}
+
+
+@pytest.fixture
+def clock():
+    class Clock:
+        now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    return Clock()
+
+
+def test_secrets_cached_until_ttl(clock):
+    client = StubSecretsClient()
+    secrets_manager = SecretsManager(client=client, ttl_seconds=60, clock=clock)
+    assert secrets_manager.get("encv", secret_key="key") == "encv-AWSCURRENT-1"
+    clock.now = 59
+    assert secrets_manager.get("encv", secret_key="key") == "encv-AWSCURRENT-1"
+    assert len(client.calls) == 1
+    clock.now = 60
+    assert secrets_manager.get("encv", secret_key="key") == "encv-AWSCURRENT-2"
+    secrets_manager.invalidate("encv")
+    assert secrets_manager.get("encv", secret_key="key") == "encv-AWSCURRENT-3"
+
+
+def test_secrets_cached_per_version_stage(clock):
+    client = StubSecretsClient()
+    secrets_manager = SecretsManager(client=client, ttl_seconds=60, clock=clock)
+    assert secrets_manager.get("encv", secret_key="key") == "encv-AWSCURRENT-1"
+    assert secrets_manager.get("encv", secret_key="key", version_stage="AWSPENDING") == "encv-AWSPENDING-2"
+    assert secrets_manager.get("encv") == {"key": "encv-AWSCURRENT-1"}
+    assert client.calls == [("encv", "AWSCURRENT"), ("encv", "AWSPENDING")]
+
+
+def test_secrets_single_flight_refresh():
+    client = StubSecretsClient(delay=0.05)
+    secrets_manager = SecretsManager(client=client, ttl_seconds=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(secrets_manager.get("encv", secret_key="key")))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["encv-AWSCURRENT-1"] * 10
+    assert len(client.calls) == 1
+
+
+class FakeResponse:
+    def __init__(self, statistics=None, status_code: int = 200, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps({"statistics": statistics}).encode() if statistics is not None else b""
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def test_changed_encv_stats(monkeypatch, tmp_path):
+    """
+    Runs an incremental fetch several times against a changing payload, and confirms only changed days are returned
+    """
+    statistics = [{"date": f"2021-02-0{day}T00:00:00Z", "data": {"codes_issued": day}} for day in range(1, 4)]
+    requests = []
+
+    def fake_request(api_key, extra_headers=None, encv_stats_url=None):
+        requests.append(extra_headers)
+        if extra_headers.get("if-none-match") == "unchanged":
+            return FakeResponse(status_code=304)
+        return FakeResponse(statistics, headers={"etag": "v1"})
+
+    monkeypatch.setattr(encv_to_db, "request_encv_stats", fake_request)
+    store = encv_to_db.SnapshotStore(str(tmp_path / "snapshot.json"))
+
+    def get_changed(**kwargs):
+        (changed, snapshot) = encv_to_db.get_changed_encv_stats("key", store, **kwargs)
+        if snapshot is not None:
+            store.save(snapshot)  # As commit_snapshots would, once the changes were stored
+        return changed
+
+    assert get_changed() == statistics
+    assert requests[-1] == {}
+    assert get_changed() == []
+    assert requests[-1] == {"if-none-match": "v1"}
+
+    statistics[1] = {"date": "2021-02-02T00:00:00Z", "data": {"codes_issued": 20}}
+    statistics.append({"date": "2021-02-04T00:00:00Z", "data": {"codes_issued": 4}})
+    assert get_changed() == statistics[1:2] + statistics[3:]
+    assert get_changed(full_refresh=True) == statistics
+
+    store.save({**store.load(), "etag": "unchanged"})
+    assert get_changed() == []
+
+
+def test_changed_encv_stats_several_entries_per_day(monkeypatch, tmp_path):
+    """
+    Confirms that entries sharing a date, as the per-user endpoint returns, are compared individually
+    """
+    statistics = [{"date": "2021-02-01T00:00:00Z", "user_id": user_id, "data": {"codes_issued": 1}}
+                  for user_id in (1, 2)]
+    monkeypatch.setattr(encv_to_db, "request_encv_stats",
+                        lambda api_key, extra_headers=None, encv_stats_url=None: FakeResponse(statistics))
+    store = encv_to_db.SnapshotStore(str(tmp_path / "snapshot.json"))
+
+    (changed, snapshot) = encv_to_db.get_changed_encv_stats("key", store)
+    assert changed == statistics
+    store.save(snapshot)
+
+    statistics[0] = {**statistics[0], "data": {"codes_issued": 5}}
+    (changed, snapshot) = encv_to_db.get_changed_encv_stats("key", store)
+    assert changed == statistics[:1]
+    store.save(snapshot)
+    assert encv_to_db.get_changed_encv_stats("key", store) == ([], None)
+
+
+class FakeSession:
+    """
+    Stands in for a requests.Session, replaying a scripted sequence of responses / exceptions
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(kwargs)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_request_retries_transient_failures():
+    session = FakeSession(ConnectionError("reset"), FakeResponse(status_code=503),
+                          FakeResponse(status_code=429, headers={"retry-after": "1"}), FakeResponse([]))
+    delays = []
+    response = request_with_retries(session, "GET", "https://encv", sleep=delays.append)
+    assert response.status_code == 200
+    assert len(session.calls) == 4
+    assert all(call["timeout"] for call in session.calls)
+    assert len(delays) == 3 and delays[2] == 1
+
+
+def test_request_gives_up_after_max_attempts():
+    session = FakeSession(*[FakeResponse(status_code=500) for _ in range(4)], FakeResponse([]))
+    response = request_with_retries(session, "GET", "https://encv", sleep=lambda delay: None)
+    assert response.status_code == 500
+    assert len(session.calls) == 4
+
+    session = FakeSession(*[ConnectionError("reset") for _ in range(4)])
+    with pytest.raises(ConnectionError):
+        request_with_retries(session, "GET", "https://encv", sleep=lambda delay: None)
+
+
+def test_request_does_not_retry_client_errors():
+    session = FakeSession(FakeResponse(status_code=403), FakeResponse([]))
+    response = request_with_retries(session, "GET", "https://encv", sleep=lambda delay: None)
+    assert response.status_code == 403
+    assert len(session.calls) == 1
+
+
+def test_collect_encv_stats():
+    """
+    Collects several targets across two hosts, and confirms requests ran concurrently, within each host's limit,
+    and that the results are merged and tagged in target order.
+    """
+    targets = [ENCVTarget(realm=f"realm{i}", endpoint=endpoint, api_key="key", base_url=f"https://host{i % 2}")
+               for i in range(4) for endpoint in ("realm.json", "realm/users.json")]
+    lock = threading.Lock()
+    in_flight = {"total": 0, "https://host0": 0, "https://host1": 0}
+    peak = dict(in_flight)
+
+    def fetch(target):
+        with lock:
+            for key in ("total", target.base_url):
+                in_flight[key] += 1
+                peak[key] = max(peak[key], in_flight[key])
+        time.sleep(0.05)
+        with lock:
+            for key in ("total", target.base_url):
+                in_flight[key] -= 1
+        return [{"date": "2021-02-01T00:00:00Z", "data": {"url": target.url}}]
+
+    data = collect_encv_stats(targets, fetch, max_workers=8, per_host_concurrency=2)
+    assert peak["https://host0"] == peak["https://host1"] == 2
+    assert peak["total"] == 4
+    assert [(entry["realm"], entry["endpoint"], entry["data"]["url"]) for entry in data] == [
+        (target.realm, target.endpoint, target.url) for target in targets]
+
+
+def test_invocation_emits_one_metrics_line(monkeypatch):
+    """
+    Runs the handler against a scripted session, and confirms it emits a single EMF line with its rows and retries
+    """
+    lines = []
+    monkeypatch.setattr(metrics, "emit", lines.append)
+    session = FakeSession(FakeResponse(status_code=503), FakeResponse([{"date": "2021-02-01T00:00:00Z", "data": {}}]))
+    monkeypatch.setattr(encv_to_db, "configured_targets",
+                        lambda: [ENCVTarget(realm="realm", api_key="key", base_url="https://encv")])
+    monkeypatch.setattr(encv_to_db, "fetch_target_stats", lambda target, full_refresh: (request_with_retries(
+        session, "GET", target.url, sleep=lambda delay: None).json()["statistics"], {}))
+
+    encv_to_db.lambda_handler(None, None)
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["function"]]
+    assert {"Name": "invocation_ms", "Unit": "Milliseconds"} in directive["Metrics"]
+    assert document["function"] == "query_encv"
+    assert (document["rows_out"], document["http_retries"], document["http_request_calls"]) == (1, 1, 1)
+    assert document["http_response_bytes"] > 0
+
+
+def test_snapshots_committed_after_downstream(monkeypatch, tmp_path):
+    """
+    Runs the handler, lets the downstream stage fail, and confirms the retry still returns the changed days. Only
+    once the snapshots it returns are committed are those days treated as unchanged.
+    """
+    statistics = [{"date": f"2021-02-0{day}T00:00:00Z", "data": {"codes_issued": day}} for day in range(1, 4)]
+    monkeypatch.setattr(encv_to_db.settings, "encv_snapshot_location", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(encv_to_db, "configured_targets", lambda: [ENCVTarget(realm="realm", api_key="key")])
+    monkeypatch.setattr(encv_to_db, "request_encv_stats", lambda api_key, extra_headers=None, encv_stats_url=None:
+                        FakeResponse(statistics, headers={"etag": "v1"}))
+
+    first = encv_to_db.lambda_handler(None, None)["body"]
+    assert first["data"] == [{**entry, "realm": "realm", "endpoint": "realm.json"} for entry in statistics]
+    # encv_to_db fails, so the snapshots aren't committed and the state machine retries
+    retried = encv_to_db.lambda_handler(None, None)["body"]
+    assert retried["data"] == first["data"]
+
+    pending = tmp_path / "snapshots" / "pending"
+    for entry in first["snapshots"] + retried["snapshots"]:
+        assert entry["pending"].startswith(f"{pending}/")
+
+    encv_to_db.lambda_handler({"commit_snapshots": retried["snapshots"]}, None)
+    assert encv_to_db.lambda_handler(None, None)["body"]["changed"] is False
+    # Only the snapshot staged by the failed run is left, for the lifecycle rule to expire
+    assert [path.relative_to(pending).parts[1:] for path in pending.rglob("*.json")] == [("realm", "realm.json")]
+
+
+def test_failed_target_commits_no_snapshots(monkeypatch, tmp_path):
+    """
+    Collects two targets, one of which fails, and confirms that no snapshot is staged or saved, so the retry still
+    returns the other target's changes.
+    """
+    statistics = [{"date": "2021-02-01T00:00:00Z", "data": {"codes_issued": 1}}]
+    failing = {"realm-b"}
+
+    def fake_request(api_key, extra_headers=None, encv_stats_url=None):
+        if api_key in failing:
+            raise ConnectionError("reset")
+        return FakeResponse(statistics, headers={"etag": "v1"})
+
+    monkeypatch.setattr(encv_to_db.settings, "encv_snapshot_location", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(encv_to_db, "configured_targets", lambda: [
+        ENCVTarget(realm=realm, api_key=realm) for realm in ("realm-a", "realm-b")])
+    monkeypatch.setattr(encv_to_db, "request_encv_stats", fake_request)
+
+    with pytest.raises(ConnectionError):
+        encv_to_db.lambda_handler(None, None)
+    assert not (tmp_path / "snapshots").exists()
+
+    failing.clear()
+    body = encv_to_db.lambda_handler(None, None)["body"]
+    assert [entry["realm"] for entry in body["data"]] == ["realm-a", "realm-b"]
+    assert len(body["snapshots"]) == 2
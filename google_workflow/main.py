@@ -10,10 +10,11 @@ import logging
 import sys
 from typing import Dict
 
-import pandas as pd
 from flask import jsonify
 
-from encv_to_db.models import ENCVStat
+from encv_to_db.ingest import claim_age_histogram_to_df, statistics_to_df
+from encv_to_db.models import ENCVClaimAgeHistogram, ENCVStat
+from encv_to_db.payload_log import Payload
 from encv_to_db.settings import settings
 from encv_to_db.SQLAlchemyDB import SQLAlchemyDB
 
@@ -36,7 +37,7 @@ def get_credentials_info() -> Dict[str, str] :
     else:
         logger.info("No credentials supplied! Exiting")
         sys.exit()
-    logger.debug(f"Credentials info: {credentials_info}")
+    logger.debug("Credentials info: %s", Payload(credentials_info))
     return credentials_info
 
 project = "co-metrics-workflow" # "covidtech-public-assets"
@@ -48,27 +49,21 @@ db = SQLAlchemyDB(database_path=database_path, credentials_info=credentials_info
 # [END functions_encv_to_db_setup]
 
 
-def flatten_data(entry: Dict[str, object]):
-    new_obj = {}
-    new_obj["date"] = entry["date"]
-    for data_point, val in entry["data"].items():
-        new_obj[data_point] = val
-    del new_obj["code_claim_age_distribution"]
-    return new_obj
-
 # [START functions_encv_to_db]
 def encv_to_db(request):
     global db 
     
     request_json = request.get_json(silent=True)
 
-    logger.info(f"Incoming event: {request_json}")
-    data = map(flatten_data, request_json)
-    stats_df = pd.json_normalize(data)
+    logger.info("Incoming event: %s", Payload(request_json))
+    stats_df = statistics_to_df(request_json)
+    histogram_df = claim_age_histogram_to_df(request_json)
 
     db.create_tables()
-    success = db.upsert(stats_df=stats_df, Table=ENCVStat)
-    return jsonify({"success": success})
+    result = db.upsert(stats_df=stats_df, Table=ENCVStat)
+    histogram_result = db.upsert(stats_df=histogram_df, Table=ENCVClaimAgeHistogram)
+    result.success = result.success and histogram_result.success
+    return jsonify({"success": result.success, "inserted": result.inserted, "updated": result.updated})
 # [END functions_encv_to_db]
 
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Reports how long each function's handler module takes to import in a fresh interpreter, i.e. its share of a Lambda
+cold start, along with its most expensive direct imports. Timings come from `python -X importtime`.
+
+Run it (e.g. with `make importtime`) from an environment with each function's dependencies installed, and with any
+settings a module reads at import time (e.g. PGHOST and friends for db_to_json) set:
+
+    python scripts/importtime_report.py functions/query_encv functions/db_to_json
+
+A module other than the handler can be given after the directory, e.g. functions/json_to_sheets:sheets_writer.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+
+def import_times(function_dir: str, module: str = "app") -> List[Tuple[int, int, str]]:
+    """
+    Imports module from function_dir in a new interpreter, returning (depth, cumulative microseconds, name) for every
+    module imported, in the order importtime reports them (each module after everything it imported)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=function_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} from {function_dir} failed:\n{result.stderr}")
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        (_, cumulative, name) = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((depth, int(cumulative), name.strip()))
+    return times
+
+
+def report(target: str, module: str = "app", top: int = 10) -> Dict[str, object]:
+    (function_dir, _, target_module) = target.partition(":")
+    module = target_module or module
+    times = import_times(function_dir, module)
+    index = max(i for i, (depth, _, name) in enumerate(times) if depth == 0 and name == module)
+    # The handler's direct imports are the depth 1 entries between the previous top-level import and the handler
+    start = max([i + 1 for i, (depth, _, _) in enumerate(times[:index]) if depth == 0], default=0)
+    direct = sorted(((cumulative, name) for depth, cumulative, name in times[start:index] if depth == 1),
+                    reverse=True)
+    return {
+        "function": target,
+        "total_ms": times[index][1] / 1000,
+        "imports_ms": {name: cumulative / 1000 for cumulative, name in direct[:top]},
+    }
+
+
+def parse_arguments():
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('function_dirs', nargs='+',
+                           help="directories containing a handler module, optionally followed by :<module>")
+    my_parser.add_argument('-m', '--module', action='store', default="app", dest='module')
+    my_parser.add_argument('-n', '--top', action='store', type=int, default=10, dest='top',
+                           help="how many of the most expensive direct imports to list")
+    my_parser.add_argument('--json', action='store_true', dest='as_json', help="print the reports as JSON")
+    return my_parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    reports = [report(function_dir, args.module, args.top) for function_dir in args.function_dirs]
+    if args.as_json:
+        print(json.dumps(reports, indent=2))
+        return
+    for function_report in reports:
+        print(f"{function_report['function']}: {function_report['total_ms']:.1f} ms")
+        for name, milliseconds in function_report["imports_ms"].items():
+            print(f"  {milliseconds:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()